@@ -0,0 +1,144 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Process-wide Bedrock client registry keyed by (credential, region, runtime/control-plane)
+"""
+import os
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+import boto3
+import pandas as pd
+from botocore.config import Config
+from dotenv import load_dotenv
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 每个client的urllib3连接池大小，需要不小于单个凭证上的并发流数量
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.environ.get("BEDROCK_MAX_POOL_CONNECTIONS", 100))
+BEDROCK_TCP_KEEPALIVE = os.environ.get("BEDROCK_TCP_KEEPALIVE", "1") in ["1", "true", "True"]
+BEDROCK_READ_TIMEOUT = int(os.environ.get("BEDROCK_READ_TIMEOUT", 600))
+
+DEFAULT_CREDENTIAL = "default"
+
+
+class BedrockCredential:
+    """One account from credentials.csv"""
+
+    def __init__(self, ak: str, sk: str, region: str = ''):
+        self.ak = ak
+        self.sk = sk
+        self.region = region
+
+    @property
+    def key(self) -> str:
+        return self.ak or DEFAULT_CREDENTIAL
+
+
+class BedrockClientRegistry:
+    """Build each boto3 client once and share it across all sessions.
+
+    boto3 clients are thread-safe, so a single client (and its urllib3 pool) per
+    (credential, region, service) is reused by every request and retry.
+    """
+
+    def __init__(self, max_pool_connections: int = BEDROCK_MAX_POOL_CONNECTIONS,
+                 tcp_keepalive: bool = BEDROCK_TCP_KEEPALIVE,
+                 read_timeout: int = BEDROCK_READ_TIMEOUT):
+        self.max_pool_connections = max_pool_connections
+        self.tcp_keepalive = tcp_keepalive
+        self.read_timeout = read_timeout
+        self._clients: Dict[Tuple[str, str, bool], object] = {}
+        # id(client) -> (credential key, region)
+        self._client_keys: Dict[int, Tuple[str, str]] = {}
+        self._credential_files: Dict[str, List[BedrockCredential]] = {}
+        self._lock = threading.RLock()
+
+    def _config(self) -> Config:
+        return Config(
+            retries={
+                "max_attempts": 3,
+                "mode": "standard",
+            },
+            read_timeout=self.read_timeout,
+            max_pool_connections=self.max_pool_connections,
+            tcp_keepalive=self.tcp_keepalive,
+        )
+
+    def get_client(self, ak: str = '', sk: str = '', region: str = '', runtime: bool = True):
+        """Get (or build once) the client for the credential; empty ak/sk uses the default chain"""
+        region = region or os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION') or 'us-east-1'
+        key = (ak or DEFAULT_CREDENTIAL, region, runtime)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                # boto3的默认session不是线程安全的，每次构建使用独立session
+                session = boto3.session.Session(aws_access_key_id=ak or None,
+                                                aws_secret_access_key=sk or None,
+                                                region_name=region)
+                client = session.client(
+                    service_name='bedrock-runtime' if runtime else 'bedrock',
+                    config=self._config(),
+                )
+                self._clients[key] = client
+                self._client_keys[id(client)] = (key[0], region)
+                logger.info(f"Created bedrock {'runtime' if runtime else 'control-plane'} client for region {region}")
+        return client
+
+    def load_credentials(self, credential_file: str) -> List[BedrockCredential]:
+        """Read credentials.csv once per process"""
+        credentials = self._credential_files.get(credential_file)
+        if credentials is not None:
+            return credentials
+        with self._lock:
+            credentials = self._credential_files.get(credential_file)
+            if credentials is None:
+                credentials = []
+                seen = set()
+                rows = pd.read_csv(credential_file)
+                for _, row in rows.iterrows():
+                    if row['ak'] in seen:
+                        continue
+                    seen.add(row['ak'])
+                    region = row['region'] if 'region' in rows.columns and isinstance(row['region'], str) else ''
+                    credentials.append(BedrockCredential(ak=row['ak'], sk=row['sk'], region=region))
+                self._credential_files[credential_file] = credentials
+                logger.info(f"Loaded {len(credentials)} bedrock credentials from {credential_file}")
+        return credentials
+
+    def get_pool_clients(self, credential_file: str, runtime: bool = True) -> list:
+        """Shared runtime clients for every account in the credential file"""
+        return [self.get_client(ak=c.ak, sk=c.sk, region=c.region, runtime=runtime)
+                for c in self.load_credentials(credential_file)]
+
+    def credential_key(self, client) -> Optional[Tuple[str, str]]:
+        """(credential, region) of a registry-built client"""
+        return self._client_keys.get(id(client))
+
+    def warm_up(self, credential_file: str = ''):
+        """Build the default client and the credential pool at startup"""
+        self.get_client()
+        if credential_file and os.path.exists(credential_file):
+            self.get_pool_clients(credential_file)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "clients": len(self._clients),
+            "credentials": sum(len(c) for c in self._credential_files.values()),
+            "max_pool_connections": self.max_pool_connections,
+        }
+
+
+# 进程内共享的client注册表
+client_registry = BedrockClientRegistry()
@@ -0,0 +1,234 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Content-addressed store for image and document bytes referenced from conversation history
+"""
+import os
+import asyncio
+import hashlib
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Union
+from dotenv import load_dotenv
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 常驻内存的二进制内容上限（MB），超出后把最久未用的内容转存到磁盘
+BLOB_MEMORY_MB = float(os.environ.get("BLOB_MEMORY_MB", 512))
+# 转存目录，为空时不转存，所有内容都常驻内存；每个worker进程使用以pid命名的子目录
+BLOB_SPILL_DIR = os.environ.get("BLOB_SPILL_DIR", "")
+# 小于该字节数的内容直接保留在消息中
+BLOB_MIN_BYTES = int(os.environ.get("BLOB_MIN_BYTES", 1024))
+
+
+class BlobRef:
+    """Reference to a payload in the BlobStore, kept in messages in place of the raw bytes.
+
+    Identical payloads share one BlobRef. The payload is released when the last message
+    holding the reference is gone; `data` reads it back from disk if it was spilled.
+    """
+    __slots__ = ("digest", "size", "_data", "_store", "__weakref__")
+
+    def __init__(self, digest: str, data: bytes, store: "BlobStore"):
+        self.digest = digest
+        self.size = len(data)
+        self._data: Optional[bytes] = data
+        self._store = store
+
+    @property
+    def data(self) -> bytes:
+        return self._store.read(self)
+
+    @property
+    def resident(self) -> bool:
+        return self._data is not None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __repr__(self) -> str:
+        return f"BlobRef({self.digest[:12]}, {self.size} bytes)"
+
+
+class BlobStore:
+    """Deduplicates payloads by sha256 and bounds the bytes held in memory.
+
+    Live references are tracked in a WeakValueDictionary, so a payload uploaded again
+    while an earlier copy is still in some history is stored once. Resident payloads are
+    kept in least-recently-read order; with a spill directory, the oldest ones are written
+    to `<spill_dir>/<pid>/<sha256>` and dropped from memory once the memory budget is exceeded.
+    Spilling runs in a worker thread when called from the event loop, and reading a spilled
+    payload does file I/O, so `data` of a spilled BlobRef should be read off the loop as well.
+    """
+
+    def __init__(self, memory_budget_mb: float = BLOB_MEMORY_MB, spill_dir: str = BLOB_SPILL_DIR,
+                 min_size: int = BLOB_MIN_BYTES):
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.spill_dir = spill_dir
+        self.min_size = min_size
+        self.refs: "weakref.WeakValueDictionary[str, BlobRef]" = weakref.WeakValueDictionary()
+        # digest -> size，常驻内存的内容，按最近读取顺序排列
+        self.resident: "OrderedDict[str, int]" = OrderedDict()
+        self.resident_bytes = 0
+        # resident在事件循环和转存线程中都会修改
+        self._lock = threading.Lock()
+        self._spilling = False
+        # counters
+        self.stored = 0
+        self.deduplicated = 0
+        self.spilled = 0
+        self.loaded = 0
+
+    def intern(self, data: Union[bytes, bytearray, BlobRef]) -> Union[bytes, BlobRef]:
+        """The shared reference for `data`; payloads below min_size are returned unchanged"""
+        if isinstance(data, BlobRef) or len(data) < self.min_size:
+            return data
+        data = bytes(data)
+        digest = hashlib.sha256(data).hexdigest()
+        ref = self.refs.get(digest)
+        if ref is not None:
+            self.deduplicated += 1
+            return ref
+        ref = BlobRef(digest, data, self)
+        self.refs[digest] = ref
+        weakref.finalize(ref, self._release, digest)
+        with self._lock:
+            self.resident[digest] = ref.size
+            self.resident_bytes += ref.size
+        self.stored += 1
+        self._schedule_spill()
+        return ref
+
+    def read(self, ref: BlobRef) -> bytes:
+        data = ref._data
+        if data is not None:
+            with self._lock:
+                if ref.digest in self.resident:
+                    self.resident.move_to_end(ref.digest)
+            return data
+        # 转存到磁盘的内容只在发送请求时临时读取，不再放回内存
+        self.loaded += 1
+        with open(self._path(ref.digest), 'rb') as f:
+            return f.read()
+
+    def _path(self, digest: str) -> str:
+        # 各worker分别释放自己的引用，不能共用同一个文件
+        return os.path.join(self.spill_dir, str(os.getpid()), digest)
+
+    def _schedule_spill(self):
+        if not self.spill_dir or self.memory_budget <= 0:
+            return
+        with self._lock:
+            if self._spilling or self.resident_bytes <= self.memory_budget:
+                return
+            self._spilling = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._spill()
+            return
+        # 写文件可能有数MB，不在事件循环中执行
+        loop.run_in_executor(None, self._spill)
+
+    def _spill(self):
+        try:
+            while True:
+                with self._lock:
+                    if self.resident_bytes <= self.memory_budget or not self.resident:
+                        return
+                    digest, size = self.resident.popitem(last=False)
+                    self.resident_bytes -= size
+                ref = self.refs.get(digest)
+                data = ref._data if ref is not None else None
+                if data is None:
+                    continue
+                path = self._path(digest)
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    if not os.path.exists(path):
+                        tmp_path = f"{path}.{os.getpid()}.tmp"
+                        with open(tmp_path, 'wb') as f:
+                            f.write(data)
+                        os.replace(tmp_path, path)
+                except OSError as e:
+                    logger.error(f"Spill blob {digest[:12]} failed: {e}")
+                    # 写盘失败时保留在内存中，不再继续转存
+                    with self._lock:
+                        self.resident[digest] = size
+                        self.resident.move_to_end(digest, last=False)
+                        self.resident_bytes += size
+                    return
+                ref._data = None
+                self.spilled += 1
+        finally:
+            with self._lock:
+                self._spilling = False
+
+    def _remove(self, digest: str):
+        try:
+            os.remove(self._path(digest))
+        except OSError:
+            pass
+
+    def _release(self, digest: str):
+        with self._lock:
+            size = self.resident.pop(digest, None)
+            if size is not None:
+                self.resident_bytes -= size
+        if size is None and self.spill_dir and digest not in self.refs:
+            self._remove(digest)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "blobs": len(self.refs),
+            "resident_mb": round(self.resident_bytes / 1024 / 1024, 2),
+            "stored": self.stored,
+            "deduplicated": self.deduplicated,
+            "spilled": self.spilled,
+            "loaded": self.loaded,
+        }
+
+
+def as_bytes(value: Union[bytes, BlobRef]) -> bytes:
+    return value.data if isinstance(value, BlobRef) else value
+
+
+def intern_blobs(blocks: list) -> list:
+    """Replace the image and document bytes of converse messages or content blocks with BlobRefs in place"""
+    for block in blocks:
+        if not isinstance(block, dict):
+            continue
+        if isinstance(block.get("content"), list):
+            intern_blobs(block["content"])
+        if isinstance(block.get("toolResult"), dict):
+            intern_blobs(block["toolResult"].get("content") or [])
+        for kind in ("image", "document"):
+            source = block[kind].get("source") if isinstance(block.get(kind), dict) else None
+            if source and isinstance(source.get("bytes"), (bytes, bytearray)):
+                source["bytes"] = blob_store.intern(source["bytes"])
+    return blocks
+
+
+def resolve_blobs(value: Any) -> Any:
+    """Copy of a request structure with every BlobRef replaced by its bytes, for serialization"""
+    if isinstance(value, BlobRef):
+        return value.data
+    if isinstance(value, dict):
+        return {key: resolve_blobs(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve_blobs(item) for item in value]
+    return value
+
+
+# 进程内共享的二进制内容存储
+blob_store = BlobStore()
@@ -6,14 +6,16 @@ import os
 import sys
 import asyncio
 import logging
-from typing import Dict,AsyncGenerator
-import boto3
+from typing import Dict,AsyncGenerator,Optional
 import base64
-from botocore.config import Config
 from dotenv import load_dotenv
-from mcp_client import MCPClient
-from utils import maybe_filter_to_n_most_recent_images,filter_tool_use_result
-import pandas as pd
+from mcp_client import MCPClient, ToolNameRegistry, gather_tool_config
+from stream_engine import run_blocking
+from utils import HistoryIndex,filter_tool_use_result
+from bedrock_client_registry import client_registry
+from prompt_cache_planner import CachePointPlanner
+from usage_tracker import UsageAccumulator
+from blob_store import blob_store, intern_blobs, resolve_blobs
 load_dotenv()  # load environment variables from .env
 
 
@@ -30,8 +32,6 @@ CLAUDE_4_OPUS_MODEL_ID = 'us.anthropic.claude-opus-4-20250514-v1:0'
 class ChatClient:
     """Bedrock simple chat wrapper"""
 
-    bedrock_client_pool = []
-
     def __init__(self, credential_file='', access_key_id='', secret_access_key='', region=''):
         self.env = {
             'AWS_ACCESS_KEY_ID': access_key_id or os.environ.get('AWS_ACCESS_KEY_ID'),
@@ -42,68 +42,56 @@ class ChatClient:
         # self.max_history = int(os.environ.get('MAX_HISTORY_TURN',5))*2
         self.messages = [] # History messages without system message
         self.system = None
-        self.cache_checkpoint = 0
-        self.reset_checkpoint = 0
+        # prompt cache checkpoint按token数规划，状态随会话保存
+        self.cache_planner = CachePointPlanner()
+        # 会话内按服务器集合缓存合并后的工具列表
+        self.tool_config_cache = {}
+        # 会话内LLM工具名与(server_id, MCP工具名)的映射，随会话释放
+        self.tool_names = ToolNameRegistry()
         
-        if credential_file:
-            credentials = pd.read_csv(credential_file)
-            for index, row in credentials.iterrows():
-                self.bedrock_client_pool.append(self._get_bedrock_client(ak=row['ak'],sk=row['sk']))
-            logger.info(f"Loaded {len(self.bedrock_client_pool)} bedrock clients from {credential_file}")
+        # 凭证池中的client由进程级注册表统一构建和复用，不随会话增长
+        self.bedrock_client_pool = client_registry.get_pool_clients(credential_file) if credential_file else []
 
     def _get_bedrock_client(self, ak='', sk='', region='', runtime=True):
         if ak and sk:
-            bedrock_client = boto3.client(
-                service_name='bedrock-runtime' if runtime else 'bedrock',
-                aws_access_key_id=ak,
-                aws_secret_access_key=sk,
-                region_name=region or os.environ.get('AWS_REGION'),
-                config=Config(
-                    retries={
-                        "max_attempts": 3,
-                        "mode": "standard",
-                    },
-                    read_timeout=600,
-                )
-            )
+            return client_registry.get_client(ak=ak, sk=sk, region=region, runtime=runtime)
         if self.env['AWS_ACCESS_KEY_ID'] and self.env['AWS_SECRET_ACCESS_KEY']:
-            bedrock_client = boto3.client(
-                service_name='bedrock-runtime' if runtime else 'bedrock',
-                aws_access_key_id=self.env['AWS_ACCESS_KEY_ID'],
-                aws_secret_access_key=self.env['AWS_SECRET_ACCESS_KEY'],
-                region_name=self.env['AWS_REGION'],
-                config=Config(
-                    retries={
-                        "max_attempts": 3,
-                        "mode": "standard",
-                    },
-                    read_timeout=600,
-                )
-            )
-        else:
-            bedrock_client = boto3.client(
-                service_name='bedrock-runtime' if runtime else 'bedrock',
-                region_name=self.env['AWS_REGION'],
-                config=Config(
-                    retries={
-                        "max_attempts": 3,
-                        "mode": "standard",
-                    },
-                    read_timeout=600,
-                ))
-
-        return bedrock_client
+            return client_registry.get_client(ak=self.env['AWS_ACCESS_KEY_ID'],
+                                              sk=self.env['AWS_SECRET_ACCESS_KEY'],
+                                              region=region or self.env['AWS_REGION'],
+                                              runtime=runtime)
+        return client_registry.get_client(region=region or self.env['AWS_REGION'], runtime=runtime)
     
+    @staticmethod
+    def get_throttle_key(bedrock_client):
+        """Throttle state is shared per (credential, region)"""
+        return client_registry.credential_key(bedrock_client) or ('anonymous', bedrock_client.meta.region_name)
+
     def clear_history(self):
         """clear session message of this client"""
         self.messages = []
         self.system = None
-        self.cache_checkpoint = 0
-        self.reset_checkpoint = 0
-        
+        self.cache_planner.reset()
+
+    def export_state(self) -> Dict:
+        """History and prompt cache state of the session, to be kept in the session store"""
+        return {
+            "messages": self.messages,
+            "system": self.system,
+            "cache_planner": self.cache_planner.export_state(self.messages),
+        }
+
+    def restore_state(self, state: Dict):
+        """Continue a session whose state was exported by this or another worker"""
+        # 其他worker保存的历史中是原始bytes，恢复时重新去重
+        self.messages = intern_blobs(state.get("messages") or [])
+        self.system = state.get("system")
+        self.cache_planner.restore_state(state.get("cache_planner") or {}, self.messages)
+
     async def process_query(self, 
             model_id="amazon.nova-lite-v1:0", max_tokens=1024, temperature=0.1,max_turns=30,
-            messages=[], system=[], mcp_clients=None, mcp_server_ids=[],extra_params={},keep_session=None) -> AsyncGenerator[Dict, None]:
+            messages=[], system=[], mcp_clients=None, mcp_server_ids=[],extra_params={},keep_session=None,
+            usage: Optional[UsageAccumulator] = None) -> AsyncGenerator[Dict, None]:
         """Submit user query or history messages, and then get the response answer.
 
         Note the specified mcp servers' tool maybe used.
@@ -113,13 +101,14 @@ class ChatClient:
             system = self.system if self.system else system
         else:
             self.clear_history()
+        # 用量按请求累计，由调用方传入，同一会话的并发请求互不影响
+        if usage is None:
+            usage = UsageAccumulator()
             
         # get tools from mcp server
         tool_config = {"tools": []}
         if mcp_clients is not None:        
-            for mcp_server_id in mcp_server_ids:
-                tool_config_response = await mcp_clients[mcp_server_id].get_tool_config(server_id=mcp_server_id)
-                tool_config['tools'].extend(tool_config_response["tools"])
+            tool_config, _ = await gather_tool_config(mcp_clients, mcp_server_ids, self.tool_names, cache=self.tool_config_cache)
 
         logger.info(f"tool_config: {tool_config}")
         bedrock_client = self._get_bedrock_client()
@@ -145,6 +134,10 @@ class ChatClient:
         # 如新一轮对话里没有启用mcp server，则需要清除之前的tool use content，否则会报错
         if len(messages) > 0 and not tool_config['tools']:
             messages = filter_tool_use_result(messages)
+        history_index = HistoryIndex(messages)
+        # 后续轮次原地追加到messages，调用方提前结束迭代时会话历史也是完整的
+        self.messages = messages
+        self.system = system
             
         requestParams = dict(
                     modelId=model_id,
@@ -158,10 +151,12 @@ class ChatClient:
         # logger.info(f"requestParams: {requestParams}")
 
         # invoke bedrock llm with user query
-        response = bedrock_client.converse(
-                    **requestParams
-        )
+        # 历史中的图片和文档只保存引用，发送请求时才在工作线程中取出内容（转存的内容需要读文件）
+        response = await run_blocking(lambda: bedrock_client.converse(
+                    **{**requestParams, "messages": resolve_blobs(requestParams["messages"])}
+        ))
         logger.info(f"response: {response}")
+        usage.add(response.get('usage'))
 
         # the response may or not request tool use
         output_message = response['output']['message']
@@ -196,14 +191,14 @@ class ChatClient:
                         if tool_args == "":
                             tool_args = {}
                         #parse the tool_name
-                        server_id, llm_tool_name = MCPClient.get_tool_name4mcp(tool_name)
+                        server_id, llm_tool_name = self.tool_names.resolve(tool_name)
                         mcp_client = mcp_clients.get(server_id)
                         if mcp_client is None:
                             raise Exception(f"mcp_client is None, server_id:{server_id}")
                                     
                         result = await mcp_client.call_tool(llm_tool_name, tool_args)
                         result_content = [{"text": "\n".join([x.text for x in result.content if x.type == 'text'])}]
-                        image_content =  [{"image":{"format":x.mimeType.replace('image/',''), "source":{"bytes":base64.b64decode(x.data)} } } for x in result.content if x.type == 'image']
+                        image_content =  [{"image":{"format":x.mimeType.replace('image/',''), "source":{"bytes":blob_store.intern(base64.b64decode(x.data))} } } for x in result.content if x.type == 'image']
                         return  [{ 
                                                 "toolUseId": tool['toolUseId'],
                                                 "content": result_content+image_content
@@ -240,8 +235,7 @@ class ChatClient:
                 messages.append(tool_result_message)
                 
                 if only_n_most_recent_images:
-                    maybe_filter_to_n_most_recent_images(
-                        messages,
+                    history_index.filter_images(
                         only_n_most_recent_images,
                         min_removal_threshold=image_truncation_threshold,
                 )
@@ -249,9 +243,10 @@ class ChatClient:
                 yield tool_result_message
 
                 # send the tool results to the model.
-                response = bedrock_client.converse(
-                   **requestParams
-                )
+                response = await run_blocking(lambda: bedrock_client.converse(
+                   **{**requestParams, "messages": resolve_blobs(requestParams["messages"])}
+                ))
+                usage.add(response.get('usage'))
                 stop_reason = response['stopReason']
                 output_message = response['output']['message']
                 messages.append(output_message)
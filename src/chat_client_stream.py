@@ -7,17 +7,21 @@ import sys
 import asyncio
 import logging
 from typing import Dict, AsyncGenerator, Optional, List, AsyncIterator
+from contextlib import aclosing
 import json
 import boto3
 from botocore.config import Config 
 from dotenv import load_dotenv
 from chat_client import ChatClient
 import base64
-from mcp_client import MCPClient
-from utils import maybe_filter_to_n_most_recent_images,remove_cache_checkpoint,filter_tool_use_result,maybe_redact_old_text_content
+from mcp_client import MCPClient, gather_tool_config
+from stream_engine import run_blocking, iterate_in_thread, run_until_stopped, drain_until_done
+from throttle_scheduler import throttle_scheduler
+from credential_balancer import credential_balancer
+from utils import HistoryIndex,filter_tool_use_result
+from prompt_cache_planner import prompt_cache_metrics
+from blob_store import blob_store, resolve_blobs
 from botocore.exceptions import ClientError
-import random
-import time
 load_dotenv()  # load environment variables from .env
 
 logging.basicConfig(
@@ -41,16 +45,13 @@ class ChatClientStream(ChatClient):
         self.max_retries = 10 # Maximum number of retry attempts
         self.base_delay = 10 # Initial backoff delay in seconds
         self.max_delay = 60 # Maximum backoff delay in seconds
-        self.client_index = 0
         self.stop_flags = {} # Dict to track stop flags for streams
+        self.stop_events = {} # stream_id -> (event loop, asyncio.Event) used to cancel in-flight tool calls
     
-    def get_bedrock_client_from_pool(self):
+    def get_bedrock_client_from_pool(self, exclude=None):
+        """Pick the pooled credential with the most headroom, skipping `exclude` if possible"""
         if self.bedrock_client_pool:
-            logger.info(f"get_bedrock_client_from_pool index: [{self.client_index}]")
-            if self.client_index and self.client_index %(len(self.bedrock_client_pool)-1) == 0:
-                self.client_index = 0
-            bedrock_client = self.bedrock_client_pool[self.client_index]
-            self.client_index += 1
+            bedrock_client = credential_balancer.pick(self.bedrock_client_pool, exclude=exclude)
         else:
             bedrock_client = self._get_bedrock_client()
         return bedrock_client
@@ -58,65 +59,62 @@ class ChatClientStream(ChatClient):
         
     async def _process_stream_response(self, stream_id:str,response) -> AsyncIterator[Dict]:
         """Process the raw response from converse_stream"""
-        last_yield_time = time.time()
-        for event in response['stream']:
-            current_time = time.time()
-            if current_time - last_yield_time > 0.1:  # 每100ms让出一次控制权，避免阻塞
-                await asyncio.sleep(0.001)
-                last_yield_time = current_time
-            # Check if we need to stop
-            if stream_id and stream_id in self.stop_flags and self.stop_flags[stream_id]:
-                logger.info(f"Stream {stream_id} was requested to stop")
-                yield {"type": "stopped", "data": {"message": "Stream stopped by user request"}}
-                break
-            # logger.infos(event)
-            # Handle message start
-            if "messageStart" in event:
-                yield {"type": "message_start", "data": event["messageStart"]}
-                continue
+        # botocore的EventStream是阻塞读取的，放到工作线程中迭代，通过有界队列把事件交回事件循环
+        event_stream = response['stream']
+        async with aclosing(iterate_in_thread(event_stream, on_close=event_stream.close)) as events:
+            async for event in events:
+                # Check if we need to stop
+                if stream_id and stream_id in self.stop_flags and self.stop_flags[stream_id]:
+                    logger.info(f"Stream {stream_id} was requested to stop")
+                    yield {"type": "stopped", "data": {"message": "Stream stopped by user request"}}
+                    break
+                # logger.infos(event)
+                # Handle message start
+                if "messageStart" in event:
+                    yield {"type": "message_start", "data": event["messageStart"]}
+                    continue
 
-            # Handle content block start
-            if "contentBlockStart" in event:
-                block_start = event["contentBlockStart"]
-                yield {"type": "block_start", "data": block_start}
-                continue 
+                # Handle content block start
+                if "contentBlockStart" in event:
+                    block_start = event["contentBlockStart"]
+                    yield {"type": "block_start", "data": block_start}
+                    continue 
 
-            # Handle content block delta
-            if "contentBlockDelta" in event:
-                delta = event["contentBlockDelta"]
-                yield {"type": "block_delta", "data": delta}
-                continue
+                # Handle content block delta
+                if "contentBlockDelta" in event:
+                    delta = event["contentBlockDelta"]
+                    yield {"type": "block_delta", "data": delta}
+                    continue
 
-            # Handle content block stop
-            if "contentBlockStop" in event:
-                yield {"type": "block_stop", "data": event["contentBlockStop"]}
-                continue
+                # Handle content block stop
+                if "contentBlockStop" in event:
+                    yield {"type": "block_stop", "data": event["contentBlockStop"]}
+                    continue
 
-            # Handle message stop
-            if "messageStop" in event:
-                yield {"type": "message_stop", "data": event["messageStop"]}
-                continue
+                # Handle message stop
+                if "messageStop" in event:
+                    yield {"type": "message_stop", "data": event["messageStop"]}
+                    continue
 
-            # Handle metadata
-            if "metadata" in event:
-                yield {"type": "metadata", "data": event["metadata"]}
-                continue
+                # Handle metadata
+                if "metadata" in event:
+                    yield {"type": "metadata", "data": event["metadata"]}
+                    continue
             
-    def exponential_backoff(self, attempt):
-        """Calculate exponential backoff delay with jitter"""
-        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
-        jitter = random.uniform(0, 0.1 * delay)  # 10% jitter
-        return delay + jitter
-    
     def register_stream(self, stream_id):
         """Register a new stream with a stop flag"""
         self.stop_flags[stream_id] = False
+        self.stop_events[stream_id] = (asyncio.get_running_loop(), asyncio.Event())
         logger.info(f"Registered stream: {stream_id}")
         
     def stop_stream(self, stream_id):
         """Set the stop flag for a stream to terminate it"""
         if stream_id in self.stop_flags:
             self.stop_flags[stream_id] = True
+            # stop_stream可能在线程池中被调用，通过事件循环唤醒正在等待工具调用的协程
+            if stream_id in self.stop_events:
+                loop, stop_event = self.stop_events[stream_id]
+                loop.call_soon_threadsafe(stop_event.set)
             # Signal any waiting code immediately without waiting for next check in the streaming loop
             logger.info(f"Stopping stream: {stream_id}")
             return True
@@ -127,6 +125,7 @@ class ChatClientStream(ChatClient):
         """Clean up the stop flag after a stream completes"""
         if stream_id in self.stop_flags:
             del self.stop_flags[stream_id]
+            self.stop_events.pop(stream_id, None)
             logger.info(f"Unregistered stream: {stream_id}")
             
     async def process_query_stream(self, 
@@ -148,22 +147,19 @@ class ChatClientStream(ChatClient):
         logger.info(f'llm input message list length:{len(messages)}')
             
         prompt_cache = True if model_id in [CLAUDE_37_SONNET_MODEL_ID,CLAUDE_35_HAIKU_MODEL_ID,CLAUDE_4_SONNET_MODEL_ID,CLAUDE_4_OPUS_MODEL_ID] else False
-        prompt_cache_for_tool = True if model_id in [CLAUDE_37_SONNET_MODEL_ID,CLAUDE_35_HAIKU_MODEL_ID,CLAUDE_4_SONNET_MODEL_ID,CLAUDE_4_OPUS_MODEL_ID] else False
         cache_window = 2048 if model_id == CLAUDE_35_HAIKU_MODEL_ID else 1024
 
         # get tools from mcp server
         tool_config = {"tools": []}
         if mcp_clients is not None:
-            for mcp_server_id in mcp_server_ids:
-                tool_config_response = await mcp_clients[mcp_server_id].get_tool_config(server_id=mcp_server_id)
-                if tool_config_response:
-                    tool_config['tools'].extend(tool_config_response["tools"])
-                else:
-                    yield {"type": "stopped", "data": {"message": f"Get tool config from {mcp_server_id} failed, please restart the MCP server"}}
+            tool_config, failed_server_ids = await gather_tool_config(mcp_clients, mcp_server_ids, self.tool_names, cache=self.tool_config_cache)
+            for mcp_server_id in failed_server_ids:
+                yield {"type": "stopped", "data": {"message": f"Get tool config from {mcp_server_id} failed, please restart the MCP server"}}
         logger.info(f"Tool config: {tool_config}")
         
         use_client_pool = True if self.bedrock_client_pool else False
 
+        # 每轮新对话选择余量最大的凭证；同一对话内的工具调用轮次沿用该凭证以保持prompt cache命中，仅在限流时切换
         bedrock_client = self.get_bedrock_client_from_pool()
         
         # Track the current tool use state
@@ -194,6 +190,8 @@ class ChatClientStream(ChatClient):
         if len(messages) > 0 and not tool_config['tools']:
             messages = filter_tool_use_result(messages)
             logger.info(f"clear tool use result for new turn")
+        # 增量维护历史中的图片和长文本索引，每轮只扫描新增消息
+        history_index = HistoryIndex(messages)
             
         requestParams = dict(
                     modelId=model_id,
@@ -204,27 +202,13 @@ class ChatClientStream(ChatClient):
         )
         requestParams = {**requestParams, 'toolConfig': tool_config} if tool_config['tools'] else requestParams
             
-        if prompt_cache and self.cache_checkpoint == 0:
-            if 'toolConfig' in requestParams and prompt_cache_for_tool:
-                tools_str = json.dumps(requestParams['toolConfig']['tools'],ensure_ascii=False)
-                if len(tools_str) >= 5000:##will replace by token count in future
-                    requestParams['toolConfig'] = {"tools":requestParams['toolConfig']['tools'] + [{"cachePoint": {"type": "default"}}]}
-                    self.cache_checkpoint += 1
-                    self.reset_checkpoint += 1
-                    logger.info(f"add checkpoint number:{self.cache_checkpoint} for tool config")
-            # Skip cache for system because it usually short.
-            if len(system) > 0 and len(system[0]['text']) >= 5000: ##will replace by token count in future
-                requestParams['system'] = requestParams['system']+[{"cachePoint": {"type": "default"}}]
-                self.cache_checkpoint += 1
-                self.reset_checkpoint += 1
-                logger.info(f"add checkpoint number:{self.cache_checkpoint} for system prompt")
+        if prompt_cache:
+            self.cache_planner.plan_request(requestParams, min_tokens=cache_window)
         
         # Register this stream if an ID is provided
         if stream_id:
             self.register_stream(stream_id)
         
-        tokens_need_cache = 0
-        
         while turn_i <= max_turns and stop_reason != 'end_turn':
             # Check if we need to stop
             if stream_id and stream_id in self.stop_flags and self.stop_flags[stream_id]:
@@ -235,47 +219,42 @@ class ChatClientStream(ChatClient):
             thinking_text = ''
             thinking_signature = ''
             # invoke bedrock llm with user query
+            in_flight_client = None
             try:
                 attempt = 0
-                pool_attempt = 0
-                while attempt <= self.max_retries:
+                # 使用凭证池时，允许先把池里的每个凭证都轮巡一次
+                max_attempts = self.max_retries + (len(self.bedrock_client_pool) if use_client_pool else 0)
+                while True:
+                    throttle_key = self.get_throttle_key(bedrock_client)
+                    # 只有当前凭证处于限流冷却时才会在这里异步等待，不影响其他凭证和其他用户的请求
+                    await throttle_scheduler.acquire(throttle_key)
+                    credential_balancer.acquire(bedrock_client)
+                    in_flight_client = bedrock_client
                     try:
-                        response = bedrock_client.converse_stream(
-                            **requestParams
-                        )
+                        # 历史中的图片和文档只保存引用，发送请求时才在工作线程中取出内容（转存的内容需要读文件）
+                        response = await run_blocking(lambda: bedrock_client.converse_stream(
+                            **{**requestParams, "messages": resolve_blobs(requestParams["messages"])}
+                        ))
+                        throttle_scheduler.record_success(throttle_key)
+                        credential_balancer.record_success(bedrock_client)
                         break
                     except ClientError as error:
+                        credential_balancer.release(bedrock_client)
+                        in_flight_client = None
                         logger.info(str(error))
-                        if error.response['Error']['Code'] in ['ThrottlingException','serviceUnavailableException'] :
-                            if use_client_pool:
-                                bedrock_client = self.get_bedrock_client_from_pool()
-            
-                                if pool_attempt > len(self.bedrock_client_pool): # 如果都轮巡了一遍
-                                    delay = self.exponential_backoff(attempt)
-                                    msg = f"Throttling exception encountered. Retrying in {delay:.2f} seconds (attempt {attempt+1}/{self.max_retries})\n"
-                                    logger.warning(msg)
-                                    time.sleep(delay)
-                                    attempt += 1
-                                    attempt = min(attempt,2) ##最多退2步
-                                    pool_attempt = 0 #重置一下
-                                pool_attempt+=1
-                                continue
-                            else:
-                                bedrock_client = self._get_bedrock_client()
-                                if attempt < self.max_retries:
-                                    delay = self.exponential_backoff(attempt)
-                                    msg = f"Throttling exception encountered. Retrying in {delay:.2f} seconds (attempt {attempt+1}/{self.max_retries})\n"
-                                    logger.warning(msg)
-                                    # yield {"type": "error", "data": {"error":msg}}
-
-                                    time.sleep(delay)
-                                    attempt += 1
-                                else:
-                                    logger.error(f"Maximum retry attempts ({self.max_retries}) reached. Throttling persists.")
-                                    raise Exception("Maximum retry attempts reached. Service is still throttling requests.")
-                        else:
+                        if error.response['Error']['Code'] not in ['ThrottlingException','serviceUnavailableException']:
                             raise error
-                        
+                        credential_balancer.record_throttle(bedrock_client)
+                        delay = throttle_scheduler.record_throttle(throttle_key, self.base_delay, self.max_delay)
+                        if attempt >= max_attempts:
+                            logger.error(f"Maximum retry attempts ({max_attempts}) reached. Throttling persists.")
+                            raise Exception("Maximum retry attempts reached. Service is still throttling requests.")
+                        attempt += 1
+                        throttle_scheduler.record_retry(throttle_key)
+                        logger.warning(f"Throttling exception encountered. Credential cooling down for {delay:.2f} seconds (attempt {attempt}/{max_attempts})")
+                        if use_client_pool:
+                            # 换容量最充足的凭证重试，被限流的凭证处于熔断冷却中
+                            bedrock_client = self.get_bedrock_client_from_pool(exclude=bedrock_client)
 
                 turn_i += 1
                 # 收集所有需要调用的工具请求
@@ -283,9 +262,11 @@ class ChatClientStream(ChatClient):
                 async for event in self._process_stream_response(stream_id,response):
                     # logger.info(event)
                     if event['type'] == 'metadata':
-                        tokens_need_cache += event['data']['usage']['inputTokens'] + event['data']['usage']['outputTokens']
+                        usage = event['data']['usage']
+                        credential_balancer.record_usage(bedrock_client, usage.get('totalTokens', 0))
+                        self.cache_planner.record_usage(usage)
+                        prompt_cache_metrics.record(usage)
                         logger.info(event)
-                        logger.info(f"Tokens need cache: {tokens_need_cache}")
                         
                     yield event
                     # Handle tool use in content block start
@@ -328,6 +309,8 @@ class ChatClientStream(ChatClient):
                         # Handle tool use if needed
                         if stop_reason == "tool_use" and tool_calls:
                             # 并行执行所有工具调用
+                            # 工具执行期间MCP服务器发来的进度和日志通知
+                            progress_events = asyncio.Queue()
                             async def execute_tool_call(tool):
                                 logger.info("Call tool: %s" % tool)
                                 try:
@@ -335,15 +318,17 @@ class ChatClientStream(ChatClient):
                                     if tool_args == "":
                                         tool_args = {}
                                     #parse the tool_name
-                                    server_id, llm_tool_name = MCPClient.get_tool_name4mcp(tool_name)
+                                    server_id, llm_tool_name = self.tool_names.resolve(tool_name)
                                     mcp_client = mcp_clients.get(server_id)
                                     if mcp_client is None:
                                         raise Exception(f"mcp_client is None, server_id:{server_id}")
                                     
-                                    result = await mcp_client.call_tool(llm_tool_name, tool_args)
+                                    def on_progress(update, tool=tool):
+                                        progress_events.put_nowait({"toolUseId": tool['toolUseId'], "name": tool['name'], **update})
+                                    result = await mcp_client.call_tool(llm_tool_name, tool_args, on_progress=on_progress)
                                     # logger.info(f"call_tool result:{result}")
                                     result_content = [{"text": "\n".join([x.text for x in result.content if x.type == 'text'])}]
-                                    image_content =  [{"image":{"format":x.mimeType.replace('image/',''), "source":{"bytes":base64.b64decode(x.data)} } } for x in result.content if x.type == 'image']
+                                    image_content =  [{"image":{"format":x.mimeType.replace('image/',''), "source":{"bytes":blob_store.intern(base64.b64decode(x.data))} } } for x in result.content if x.type == 'image']
                                     
                                     #content block for json serializable.
                                     image_content_base64 =  [{"image":{"format":x.mimeType.replace('image/',''), "source":{"base64":x.data} } } for x in result.content if x.type == 'image']
@@ -370,7 +355,18 @@ class ChatClientStream(ChatClient):
                                                 "status": 'error'
                                             }]*3
                             # 使用 asyncio.gather 并行执行所有工具调用
-                            call_results = await asyncio.gather(*[execute_tool_call(tool) for tool in tool_calls])
+                            # 停止请求或客户端断开时取消所有进行中的工具调用
+                            stop_event = self.stop_events[stream_id][1] if stream_id in self.stop_events else None
+                            tool_task = asyncio.ensure_future(run_until_stopped(
+                                asyncio.gather(*[execute_tool_call(tool) for tool in tool_calls]), stop_event))
+                            # 长时间运行的工具在执行期间实时输出进度，同时避免连接因空闲被代理断开
+                            async with aclosing(drain_until_done(tool_task, progress_events)) as updates:
+                                async for update in updates:
+                                    yield {"type": "tool_progress", "data": update}
+                            completed, call_results = tool_task.result()
+                            if not completed:
+                                logger.info(f"Stream {stream_id} stopped while calling tools")
+                                break
                             # Correctly unpack the results - each call_result is a list of [tool_result, tool_text_result]
                             tool_results = []
                             tool_results_serializable = []
@@ -390,18 +386,8 @@ class ChatClientStream(ChatClient):
                                 "role": "user",
                                 "content": tool_results_content
                             }
-                            if prompt_cache and tokens_need_cache >= cache_window:
-                                if self.cache_checkpoint < 4:
-                                    tool_result_message["content"] += [{"cachePoint": {"type": "default"}}]
-                                    self.cache_checkpoint += 1
-                                    logger.info(f"Write message cache: {tokens_need_cache}, checkpoint number :{self.cache_checkpoint}")
-                                    tokens_need_cache = 0
-                                else: # reset checkpoint
-                                    messages = remove_cache_checkpoint(messages)
-                                    tool_result_message["content"] += [{"cachePoint": {"type": "default"}}]
-                                    self.cache_checkpoint = self.reset_checkpoint + 1
-                                    logger.info(f"Reset prompt cache checkpoint to {self.reset_checkpoint}, Write message cache: {tokens_need_cache}, checkpoint number :{self.cache_checkpoint}")
-                                    tokens_need_cache = 0
+                            if prompt_cache:
+                                self.cache_planner.plan_tool_result(tool_result_message)
                                     
                             # output tool results
                             event["data"]["tool_results"] = [item for pair in zip(tool_calls, tool_results_serializable) for item in pair]
@@ -443,14 +429,11 @@ class ChatClientStream(ChatClient):
                             messages.append(tool_result_message)
                             
                             if only_n_most_recent_images:
-                                messages = maybe_filter_to_n_most_recent_images(
-                                    messages,
+                                history_index.filter_images(
                                     only_n_most_recent_images,
                                     min_removal_threshold=image_truncation_threshold,
                             )
-                            messages = maybe_redact_old_text_content(
-                                messages,
-                            )
+                            history_index.redact_old_text()
 
                             logger.info(f"Call new turn : message length:{len(messages)}")
                             # logger.info(f"Call new turn : message:{messages}")
@@ -475,6 +458,9 @@ class ChatClientStream(ChatClient):
                 yield {"type": "error", "data": {"error": str(e)}}
                 turn_i = max_turns
                 break
+            finally:
+                if in_flight_client:
+                    credential_balancer.release(in_flight_client)
         
         # Save the max history to session
         self.messages = messages
@@ -7,12 +7,17 @@ import asyncio
 import logging
 import json
 import base64
-from typing import Dict, AsyncGenerator, List, Any
+import hashlib
+from typing import Dict, AsyncGenerator, List, Any, Optional
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, RateLimitError, APIStatusError
 from chat_client import ChatClient
-from mcp_client import MCPClient
-from utils import maybe_filter_to_n_most_recent_images
+from mcp_client import MCPClient, gather_tool_config
+from stream_engine import run_blocking
+from throttle_scheduler import throttle_scheduler
+from utils import HistoryIndex
+from usage_tracker import UsageAccumulator
+from blob_store import blob_store, as_bytes
 from deepseek_r1_client import *
 
 load_dotenv()  # load environment variables from .env
@@ -39,6 +44,10 @@ class CompatibleChatClient(ChatClient):
         self.base_delay = 10  # Initial backoff delay in seconds
         self.max_delay = 60  # Maximum backoff delay in seconds
         
+        # Throttle state is shared per (api key, api base) across all sessions
+        api_key_id = hashlib.sha256(self.api_key.encode('utf-8')).hexdigest()[:16] if self.api_key else 'anonymous'
+        self.throttle_key = (api_key_id, self.api_base or 'openai')
+        
         # Create OpenAI client with custom base URL if provided
         if self.api_base:
             self.openai_client = OpenAI(
@@ -50,6 +59,20 @@ class CompatibleChatClient(ChatClient):
                 api_key=self.api_key
             )
     
+    @staticmethod
+    def is_throttle_error(error):
+        """Rate limited (429) or temporarily unavailable (503) responses are retried"""
+        return isinstance(error, RateLimitError) or (isinstance(error, APIStatusError) and error.status_code == 503)
+
+    async def _create_chat_completion(self, create_fn, **request_payload):
+        """Invoke the chat completions API off the event loop under the shared throttle scheduler"""
+        return await throttle_scheduler.call(self.throttle_key, run_blocking, create_fn,
+                                             is_throttle=self.is_throttle_error,
+                                             max_retries=self.max_retries,
+                                             base_delay=self.base_delay,
+                                             max_delay=self.max_delay,
+                                             **request_payload)
+
     def _convert_messages_to_openai_format(self, messages, system=None):
         """Convert Bedrock message format to OpenAI format"""
         openai_messages = []
@@ -83,7 +106,7 @@ class CompatibleChatClient(ChatClient):
                         elif "image" in item and "source" in item["image"]:
                             img_source = item["image"]["source"]
                             if "bytes" in img_source:
-                                img_base64 = base64.b64encode(img_source["bytes"]).decode('utf-8')
+                                img_base64 = base64.b64encode(as_bytes(img_source["bytes"])).decode('utf-8')
                                 img_format = item["image"].get("format", "png")
                                 content.append({
                                     "type": "image_url",
@@ -241,7 +264,8 @@ class CompatibleChatClient(ChatClient):
     
     async def process_query(self, 
             model_id="gpt-4o", max_tokens=1024, temperature=0.1, max_turns=30,
-            messages=[], system=[], mcp_clients=None, mcp_server_ids=[], extra_params={}, keep_session=None) -> AsyncGenerator[Dict, None]:
+            messages=[], system=[], mcp_clients=None, mcp_server_ids=[], extra_params={}, keep_session=None,
+            usage: Optional[UsageAccumulator] = None) -> AsyncGenerator[Dict, None]:
         """Submit user query or history messages, and then get the response answer.
         
         This implementation uses OpenAI's API instead of Bedrock.
@@ -251,29 +275,30 @@ class CompatibleChatClient(ChatClient):
             system = self.system if self.system else system
         else:
             self.clear_history()
+        # 用量按请求累计，由调用方传入，同一会话的并发请求互不影响
+        if usage is None:
+            usage = UsageAccumulator()
             
         logger.info(f'llm input message list length: {len(messages)}')
         
         # Get tools from MCP server
         tool_config = {"tools": []}
         if mcp_clients is not None:        
-            for mcp_server_id in mcp_server_ids:
-                tool_config_response = await mcp_clients[mcp_server_id].get_tool_config(server_id=mcp_server_id)
-                if tool_config_response:
-                    tool_config['tools'].extend(tool_config_response["tools"])
+            tool_config, _ = await gather_tool_config(mcp_clients, mcp_server_ids, self.tool_names, cache=self.tool_config_cache)
 
         #logger.info(f"tool_config: {tool_config}")
         
         # Convert Bedrock format to OpenAI format
-        openai_messages = self._convert_messages_to_openai_format(messages, system)
+        # 转存到磁盘的图片需要读文件，base64编码也较耗时，放到工作线程中执行
+        openai_messages = await run_blocking(self._convert_messages_to_openai_format, messages, system)
         openai_tools = self._convert_tools_config(tool_config)
         
         # Process image filtering if needed
         only_n_most_recent_images = extra_params.get('only_n_most_recent_images', 3)
         image_truncation_threshold = only_n_most_recent_images or 0
+        history_index = HistoryIndex(messages)
         if only_n_most_recent_images:
-            maybe_filter_to_n_most_recent_images(
-                messages,
+            history_index.filter_images(
                 only_n_most_recent_images,
                 min_removal_threshold=image_truncation_threshold,
             )
@@ -307,12 +332,14 @@ class CompatibleChatClient(ChatClient):
                 #logger.info(f"Payload: {request_payload}")
 
                 # Make the API request using the OpenAI SDK
-                response = deepseek_r1_chat(**request_payload) if "deepseek-r1" in model_id.lower() else self.openai_client.chat.completions.create(**request_payload)
+                create_fn = deepseek_r1_chat if "deepseek-r1" in model_id.lower() else self.openai_client.chat.completions.create
+                response = await self._create_chat_completion(create_fn, **request_payload)
                 
                 # Convert OpenAI response to Bedrock format
                 bedrock_response = self._convert_openai_response_to_bedrock_format(response, model_id)
                 
                 logger.info(f"bedrock format response: {bedrock_response}")
+                usage.add(bedrock_response.get('usage'))
 
                 # Extract message and add to history
                 output_message = bedrock_response['output']['message']
@@ -347,14 +374,14 @@ class CompatibleChatClient(ChatClient):
                             if tool_args == "":
                                 tool_args = {}
                             # Parse the tool name
-                            server_id, llm_tool_name = MCPClient.get_tool_name4mcp(tool_name)
+                            server_id, llm_tool_name = self.tool_names.resolve(tool_name)
                             mcp_client = mcp_clients.get(server_id)
                             if mcp_client is None:
                                 raise Exception(f"mcp_client is None, server_id:{server_id}")
                                         
                             result = await mcp_client.call_tool(llm_tool_name, tool_args)
                             result_content = [{"text": "\n".join([x.text for x in result.content if x.type == 'text'])}]
-                            image_content = [{"image":{"format":x.mimeType.replace('image/',''), "source":{"bytes":base64.b64decode(x.data)} } } for x in result.content if x.type == 'image']
+                            image_content = [{"image":{"format":x.mimeType.replace('image/',''), "source":{"bytes":blob_store.intern(base64.b64decode(x.data))} } } for x in result.content if x.type == 'image']
                             
                             # Include serializable version for logging/debugging
                             image_content_base64 = [{"image":{"format":x.mimeType.replace('image/',''), "source":{"base64":x.data} } } for x in result.content if x.type == 'image']
@@ -407,14 +434,13 @@ class CompatibleChatClient(ChatClient):
                     yield tool_result_message
                     
                     # Update OpenAI messages for the next request
-                    openai_messages = self._convert_messages_to_openai_format(messages, system)
+                    openai_messages = await run_blocking(self._convert_messages_to_openai_format, messages, system)
 
                     request_payload["messages"] = openai_messages
                     
                     # Filter images if needed after tool calls
                     if only_n_most_recent_images:
-                        maybe_filter_to_n_most_recent_images(
-                            messages,
+                        history_index.filter_images(
                             only_n_most_recent_images,
                             min_removal_threshold=image_truncation_threshold,
                         )
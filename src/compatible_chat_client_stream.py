@@ -11,6 +11,7 @@ import time
 import random
 import base64
 from typing import Dict, AsyncGenerator, Optional, List, AsyncIterator, Any, override
+from contextlib import aclosing
 import boto3
 from botocore.config import Config
 from botocore.exceptions import ClientError
@@ -22,8 +23,10 @@ from compatible_chat_client import CompatibleChatClient
 from deepseek_r1_client import *
 import re
 
-from mcp_client import MCPClient
-from utils import maybe_filter_to_n_most_recent_images, remove_cache_checkpoint
+from mcp_client import MCPClient, gather_tool_config
+from stream_engine import run_blocking, iterate_in_thread, run_until_stopped, drain_until_done
+from utils import HistoryIndex, remove_cache_checkpoint
+from blob_store import blob_store
 
 load_dotenv()  # load environment variables from .env
 
@@ -43,16 +46,22 @@ class CompatibleChatClientStream(CompatibleChatClient):
         super().__init__(credential_file, access_key_id, secret_access_key, region, api_key, api_base)
         # Stream-specific properties
         self.stop_flags = {}  # Dict to track stop flags for streams
+        self.stop_events = {} # stream_id -> (event loop, asyncio.Event) used to cancel in-flight tool calls
         
     def register_stream(self, stream_id):
         """Register a new stream with a stop flag"""
         self.stop_flags[stream_id] = False
+        self.stop_events[stream_id] = (asyncio.get_running_loop(), asyncio.Event())
         logger.info(f"Registered stream: {stream_id}")
     
     def stop_stream(self, stream_id):
         """Set the stop flag for a stream to terminate it"""
         if stream_id in self.stop_flags:
             self.stop_flags[stream_id] = True
+            # stop_stream可能在线程池中被调用，通过事件循环唤醒正在等待工具调用的协程
+            if stream_id in self.stop_events:
+                loop, stop_event = self.stop_events[stream_id]
+                loop.call_soon_threadsafe(stop_event.set)
             # Signal any waiting code immediately without waiting for next check in the streaming loop
             logger.info(f"Stopping stream: {stream_id}")
             return True
@@ -63,6 +72,7 @@ class CompatibleChatClientStream(CompatibleChatClient):
         """Clean up the stop flag after a stream completes"""
         if stream_id in self.stop_flags:
             del self.stop_flags[stream_id]
+            self.stop_events.pop(stream_id, None)
             logger.info(f"Unregistered stream: {stream_id}")
             
     async def _process_openai_stream_response(self, stream_id:str, stream_response, model_id) -> AsyncIterator[Dict]:
@@ -78,229 +88,225 @@ class CompatibleChatClientStream(CompatibleChatClient):
             try:
                 # For SDK streamed responses, we iterate through the chunks
                 tool_index=0
-                last_yield_time = time.time()
-                for chunk in stream_response:
-                    current_time = time.time()
-                    if current_time - last_yield_time > 0.1:  # 每100ms让出一次控制权，避免阻塞
-                        await asyncio.sleep(0.001)
-                        last_yield_time = current_time
-                
-                    # Process stream termination
-                    if stream_id and stream_id in self.stop_flags and self.stop_flags[stream_id]:
-                        logger.info(f"Stream {stream_id} was requested to stop")
-                        yield {"type": "stopped", "data": {"message": "Stream stopped by user request"}}
-                        break
+                # OpenAI SDK的流是阻塞读取的，放到工作线程中迭代，避免阻塞事件循环
+                async with aclosing(iterate_in_thread(stream_response, on_close=getattr(stream_response, 'close', None))) as chunk_events:
+                    async for chunk in chunk_events:
+                        # Process stream termination
+                        if stream_id and stream_id in self.stop_flags and self.stop_flags[stream_id]:
+                            logger.info(f"Stream {stream_id} was requested to stop")
+                            yield {"type": "stopped", "data": {"message": "Stream stopped by user request"}}
+                            break
                 
-                    # Process deepseek-r1 chunk
-                    if "deepseek-r1" in model_id.lower() and not TOOL_USE_SUPPORT:
-                        if hasattr(chunk, 'choices') and chunk.choices:
-                            choice = chunk.choices[0]
+                        # Process deepseek-r1 chunk
+                        if "deepseek-r1" in model_id.lower() and not TOOL_USE_SUPPORT:
+                            if hasattr(chunk, 'choices') and chunk.choices:
+                                choice = chunk.choices[0]
 
-                            # Initial role message
-                            # Generate this msg for every chunk
-                            if hasattr(choice, 'delta') and hasattr(choice.delta, 'role'):
-                                yield {"type": "message_start", "data": {"role": choice.delta.role}}
+                                # Initial role message
+                                # Generate this msg for every chunk
+                                if hasattr(choice, 'delta') and hasattr(choice.delta, 'role'):
+                                    yield {"type": "message_start", "data": {"role": choice.delta.role}}
                         
-                            # Thinking delta
-                            if hasattr(choice, 'delta') and hasattr(choice.delta, 'reasoning_content') and choice.delta.reasoning_content is not None:
-                                think_content = choice.delta.reasoning_content
-                                if think_content:
-                                    yield {
-                                    "type": "block_delta",
-                                    "data": {"delta": {"reasoningContent": {"text": think_content}}}
-                                }
+                                # Thinking delta
+                                if hasattr(choice, 'delta') and hasattr(choice.delta, 'reasoning_content') and choice.delta.reasoning_content is not None:
+                                    think_content = choice.delta.reasoning_content
+                                    if think_content:
+                                        yield {
+                                        "type": "block_delta",
+                                        "data": {"delta": {"reasoningContent": {"text": think_content}}}
+                                    }
                         
-                            # Content delta
-                            if hasattr(choice, 'delta') and hasattr(choice.delta, 'content') and choice.delta.content is not None:
-                                answer = choice.delta.content
-                                # logger.info(f"Chunk content: {answer}")
+                                # Content delta
+                                if hasattr(choice, 'delta') and hasattr(choice.delta, 'content') and choice.delta.content is not None:
+                                    answer = choice.delta.content
+                                    # logger.info(f"Chunk content: {answer}")
         
-                                # Collect all "content" values for extracting tool-use command
-                                # pay attention to the sequence of code execution, it counts
-                                if choice.delta.content:
-                                    r1_content += answer
+                                    # Collect all "content" values for extracting tool-use command
+                                    # pay attention to the sequence of code execution, it counts
+                                    if choice.delta.content:
+                                        r1_content += answer
 
-                                # Check if text response ends
-                                if answer and "<" in answer and outputing_text and not txt_tmp:
-                                    # Handle senario that <t> is outputed separately in two chunks: first <, then t>
-                                    # 1. Handle senario like </html> as the final output
-                                    # 2. txt_tmp is empty, but < output appears as part of <t> or <tr>
-                                    # 3. txt_tmp is not empty which means < in it. Concat two chunks and check whether <t> is in
-                                    if txt_tmp == "" and choice.finish_reason == "stop":
+                                    # Check if text response ends
+                                    if answer and "<" in answer and outputing_text and not txt_tmp:
+                                        # Handle senario that <t> is outputed separately in two chunks: first <, then t>
+                                        # 1. Handle senario like </html> as the final output
+                                        # 2. txt_tmp is empty, but < output appears as part of <t> or <tr>
+                                        # 3. txt_tmp is not empty which means < in it. Concat two chunks and check whether <t> is in
+                                        if txt_tmp == "" and choice.finish_reason == "stop":
+                                            # logger.info(f"Answer text: {answer}")
+                                            outputing_text = False
+                                            yield {"type": "block_delta", "data": {"delta": {"text": answer}}}
+                                        elif txt_tmp == "":
+                                            txt_tmp += answer
+                                    elif txt_tmp and outputing_text:
+                                        txt_tmp += answer
+                                        if "<t>" in txt_tmp:
+                                            match = re.search(r"(.*)<t>", txt_tmp, re.DOTALL)
+                                            match_chunk_text = match.group(1)
+                                            r1_text_response += match_chunk_text
+                                            outputing_text = False
+                                            logger.info(f"Last answer before tool: {match_chunk_text}")
+                                            if match_chunk_text: yield {"type": "block_delta", "data": {"delta": {"text": match_chunk_text}}}
+                                        elif "<t>" not in txt_tmp:
+                                            # logger.info(f"Answer text: {txt_tmp}")
+                                            yield {"type": "block_delta", "data": {"delta": {"text": txt_tmp}}}
+                                        txt_tmp = ""
+                                    elif answer and outputing_text:
                                         # logger.info(f"Answer text: {answer}")
-                                        outputing_text = False
                                         yield {"type": "block_delta", "data": {"delta": {"text": answer}}}
-                                    elif txt_tmp == "":
-                                        txt_tmp += answer
-                                elif txt_tmp and outputing_text:
-                                    txt_tmp += answer
-                                    if "<t>" in txt_tmp:
-                                        match = re.search(r"(.*)<t>", txt_tmp, re.DOTALL)
-                                        match_chunk_text = match.group(1)
-                                        r1_text_response += match_chunk_text
-                                        outputing_text = False
-                                        logger.info(f"Last answer before tool: {match_chunk_text}")
-                                        if match_chunk_text: yield {"type": "block_delta", "data": {"delta": {"text": match_chunk_text}}}
-                                    elif "<t>" not in txt_tmp:
-                                        # logger.info(f"Answer text: {txt_tmp}")
-                                        yield {"type": "block_delta", "data": {"delta": {"text": txt_tmp}}}
-                                    txt_tmp = ""
-                                elif answer and outputing_text:
-                                    # logger.info(f"Answer text: {answer}")
-                                    yield {"type": "block_delta", "data": {"delta": {"text": answer}}}
                                 
-                                # check whether there is a tool_call
-                                # if tool call exists, extract and return
-                                if choice.finish_reason == "stop":
-                                    if "<t>" in r1_content:
-                                        extracted_toolcall = re.search("<t>(.*?)</t>", r1_content.strip(), re.DOTALL).group(1)
-                                        dict_r1_content = json.loads(extracted_toolcall)
-                                        if dict_r1_content["tool_calls"]: 
-                                            r1_status = "tool_calls"
+                                    # check whether there is a tool_call
+                                    # if tool call exists, extract and return
+                                    if choice.finish_reason == "stop":
+                                        if "<t>" in r1_content:
+                                            extracted_toolcall = re.search("<t>(.*?)</t>", r1_content.strip(), re.DOTALL).group(1)
+                                            dict_r1_content = json.loads(extracted_toolcall)
+                                            if dict_r1_content["tool_calls"]: 
+                                                r1_status = "tool_calls"
+                                            else:
+                                                r1_status = "regular_stop"
                                         else:
                                             r1_status = "regular_stop"
-                                    else:
-                                        r1_status = "regular_stop"
                                 
-                                    if r1_status == "tool_calls":
-                                        func_name = dict_r1_content["tool_calls"][0]["tool_name"]
-                                        func_id = uuid.uuid4().hex
-                                        func_input = dict_r1_content["tool_calls"][0]["parameters"]  # dict
-                                        # Return tool name
-                                        yield {
-                                    "type": "block_start",
-                                        "data": {
-                                            "start": {
-                                                "toolUse": {
-                                                    "name": func_name,
-                                                    "toolUseId": func_id,
-                                                    "input": ""
+                                        if r1_status == "tool_calls":
+                                            func_name = dict_r1_content["tool_calls"][0]["tool_name"]
+                                            func_id = uuid.uuid4().hex
+                                            func_input = dict_r1_content["tool_calls"][0]["parameters"]  # dict
+                                            # Return tool name
+                                            yield {
+                                        "type": "block_start",
+                                            "data": {
+                                                "start": {
+                                                    "toolUse": {
+                                                        "name": func_name,
+                                                        "toolUseId": func_id,
+                                                        "input": ""
+                                                    }
                                                 }
                                             }
                                         }
-                                    }
-                                        # Return tool input
-                                        yield {
-                                    "type": "block_delta",
-                                        "data": {
-                                            "delta": {
-                                                "toolUse": {
-                                                    "input": json.dumps(func_input)   # convert dict to json string for subsequent processing
+                                            # Return tool input
+                                            yield {
+                                        "type": "block_delta",
+                                            "data": {
+                                                "delta": {
+                                                    "toolUse": {
+                                                        "input": json.dumps(func_input)   # convert dict to json string for subsequent processing
+                                                    }
                                                 }
                                             }
                                         }
-                                    }
-                                        # Block stop
-                                        yield {"type": "block_stop", "data":{}}
-                                        yield {"type": "message_stop", "data": {"stopReason": "tool_use"}}
-                                    elif r1_status == "regular_stop":
-                                        # Block stop
-                                        yield {"type": "block_stop", "data":{}}
-                                        yield {"type": "message_stop", "data": {"stopReason": "stop"}}
+                                            # Block stop
+                                            yield {"type": "block_stop", "data":{}}
+                                            yield {"type": "message_stop", "data": {"stopReason": "tool_use"}}
+                                        elif r1_status == "regular_stop":
+                                            # Block stop
+                                            yield {"type": "block_stop", "data":{}}
+                                            yield {"type": "message_stop", "data": {"stopReason": "stop"}}
 
-                        if hasattr(chunk, 'usage'):
-                            yield {
-                        "type": "metadata",
-                        "data": {
-                            "usage": {
-                                "inputTokens": chunk.usage.prompt_tokens if hasattr(chunk.usage, 'prompt_tokens') else 0,
-                                "outputTokens": chunk.usage.completion_tokens if hasattr(chunk.usage, 'completion_tokens') else 0
+                            if hasattr(chunk, 'usage'):
+                                yield {
+                            "type": "metadata",
+                            "data": {
+                                "usage": {
+                                    "inputTokens": chunk.usage.prompt_tokens if hasattr(chunk.usage, 'prompt_tokens') else 0,
+                                    "outputTokens": chunk.usage.completion_tokens if hasattr(chunk.usage, 'completion_tokens') else 0
+                                }
                             }
-                        }
-                        }       
-                    else:
-                        # Process each chunk from the stream (for tool-use supporting models)
-                        if hasattr(chunk, 'choices') and chunk.choices:
-                            choice = chunk.choices[0]
-                            # logger.info(choice)
+                            }       
+                        else:
+                            # Process each chunk from the stream (for tool-use supporting models)
+                            if hasattr(chunk, 'choices') and chunk.choices:
+                                choice = chunk.choices[0]
+                                # logger.info(choice)
                     
-                            # Initial role message
-                            if hasattr(choice, 'delta') and hasattr(choice.delta, 'role'):
-                                yield {"type": "message_start", "data": {"role": choice.delta.role}}
+                                # Initial role message
+                                if hasattr(choice, 'delta') and hasattr(choice.delta, 'role'):
+                                    yield {"type": "message_start", "data": {"role": choice.delta.role}}
                     
-                            # Content delta
-                            if hasattr(choice, 'delta') and hasattr(choice.delta, 'content') and choice.delta.content is not None:
-                                content = choice.delta.content
-                                if content:
-                                    yield {
-                                "type": "block_delta",
-                                "data": {"delta": {"text": content}}
-                            }
+                                # Content delta
+                                if hasattr(choice, 'delta') and hasattr(choice.delta, 'content') and choice.delta.content is not None:
+                                    content = choice.delta.content
+                                    if content:
+                                        yield {
+                                    "type": "block_delta",
+                                    "data": {"delta": {"text": content}}
+                                }
                             
-                            # Thinking delta
-                            if hasattr(choice, 'delta') and hasattr(choice.delta, 'reasoning_content') and choice.delta.reasoning_content is not None:
-                                content = choice.delta.reasoning_content
-                                if content:
-                                    yield {
-                                "type": "block_delta",
-                                "data": {"delta": {"reasoningContent": {"text": content}}}
-                            }
+                                # Thinking delta
+                                if hasattr(choice, 'delta') and hasattr(choice.delta, 'reasoning_content') and choice.delta.reasoning_content is not None:
+                                    content = choice.delta.reasoning_content
+                                    if content:
+                                        yield {
+                                    "type": "block_delta",
+                                    "data": {"delta": {"reasoningContent": {"text": content}}}
+                                }
                             
-                            # Tool calls
-                            if hasattr(choice, 'delta') and hasattr(choice.delta, 'tool_calls') and choice.delta.tool_calls:
-                                for tool_call in choice.delta.tool_calls:
-                                    if hasattr(tool_call,'index'):
-                                        # 如果index变化，说明是新的tool call，需要发送一个block stop标志
-                                        if not tool_index == tool_call.index:
-                                            tool_index = tool_call.index
-                                            yield {
-                                        "type": "block_stop",
-                                        "data":{}
-                                    }
+                                # Tool calls
+                                if hasattr(choice, 'delta') and hasattr(choice.delta, 'tool_calls') and choice.delta.tool_calls:
+                                    for tool_call in choice.delta.tool_calls:
+                                        if hasattr(tool_call,'index'):
+                                            # 如果index变化，说明是新的tool call，需要发送一个block stop标志
+                                            if not tool_index == tool_call.index:
+                                                tool_index = tool_call.index
+                                                yield {
+                                            "type": "block_stop",
+                                            "data":{}
+                                        }
                                     
-                                    if hasattr(tool_call, 'function'):
-                                        function = tool_call.function
+                                        if hasattr(tool_call, 'function'):
+                                            function = tool_call.function
                                 
-                                        if hasattr(function, 'name') and function.name:
-                                            # Tool use start
-                                            yield {
-                                        "type": "block_start",
-                                        "data": {
-                                            "start": {
-                                                "toolUse": {
-                                                    "name": function.name,
-                                                    "toolUseId": tool_call.id,
-                                                    "input": ""
+                                            if hasattr(function, 'name') and function.name:
+                                                # Tool use start
+                                                yield {
+                                            "type": "block_start",
+                                            "data": {
+                                                "start": {
+                                                    "toolUse": {
+                                                        "name": function.name,
+                                                        "toolUseId": tool_call.id,
+                                                        "input": ""
+                                                    }
                                                 }
                                             }
                                         }
-                                    }
                                 
-                                        if hasattr(function, 'arguments') and function.arguments:
-                                            # Tool input delta
-                                            yield {
-                                        "type": "block_delta",
-                                        "data": {
-                                            "delta": {
-                                                "toolUse": {
-                                                    "input": function.arguments
+                                            if hasattr(function, 'arguments') and function.arguments:
+                                                # Tool input delta
+                                                yield {
+                                            "type": "block_delta",
+                                            "data": {
+                                                "delta": {
+                                                    "toolUse": {
+                                                        "input": function.arguments
+                                                    }
                                                 }
                                             }
                                         }
-                                    }
                     
-                            # Finish reason
-                            if hasattr(choice, 'finish_reason') and choice.finish_reason:
-                                yield {
-                                "type": "block_stop",
-                                "data":{}
-                            }
-                                if choice.finish_reason == 'tool_calls':
-                                    yield {"type": "message_stop", "data": {"stopReason": "tool_use"}}
-                                else:
-                                    yield {"type": "message_stop", "data": {"stopReason": choice.finish_reason}}
+                                # Finish reason
+                                if hasattr(choice, 'finish_reason') and choice.finish_reason:
+                                    yield {
+                                    "type": "block_stop",
+                                    "data":{}
+                                }
+                                    if choice.finish_reason == 'tool_calls':
+                                        yield {"type": "message_stop", "data": {"stopReason": "tool_use"}}
+                                    else:
+                                        yield {"type": "message_stop", "data": {"stopReason": choice.finish_reason}}
                 
-                        # Usage and metadata - this might come in the final chunk
-                        if hasattr(chunk, 'usage'):
-                            yield {
-                        "type": "metadata",
-                        "data": {
-                            "usage": {
-                                "inputTokens": chunk.usage.prompt_tokens if hasattr(chunk.usage, 'prompt_tokens') else 0,
-                                "outputTokens": chunk.usage.completion_tokens if hasattr(chunk.usage, 'completion_tokens') else 0
+                            # Usage and metadata - this might come in the final chunk
+                            if hasattr(chunk, 'usage'):
+                                yield {
+                            "type": "metadata",
+                            "data": {
+                                "usage": {
+                                    "inputTokens": chunk.usage.prompt_tokens if hasattr(chunk.usage, 'prompt_tokens') else 0,
+                                    "outputTokens": chunk.usage.completion_tokens if hasattr(chunk.usage, 'completion_tokens') else 0
+                                }
                             }
                         }
-                    }
             
                 # End of stream
                 yield {"type": "message_stop", "data": {"stopReason": "end_turn"}}
@@ -332,9 +338,7 @@ class CompatibleChatClientStream(CompatibleChatClient):
         # get tools from mcp server
         tool_config = {'tools': []}
         if mcp_clients is not None:
-            for mcp_server_id in mcp_server_ids:
-                tool_config_response = await mcp_clients[mcp_server_id].get_tool_config(server_id=mcp_server_id)
-                tool_config['tools'].extend(tool_config_response["tools"])
+            tool_config, _ = await gather_tool_config(mcp_clients, mcp_server_ids, self.tool_names, cache=self.tool_config_cache)
         #logger.info(f"Tool config: {tool_config}")
         
         # Register this stream if an ID is provided
@@ -342,7 +346,7 @@ class CompatibleChatClientStream(CompatibleChatClient):
             self.register_stream(stream_id)
         
         # Convert Bedrock format to OpenAI format
-        openai_messages = self._convert_messages_to_openai_format(messages, system)
+        openai_messages = await run_blocking(self._convert_messages_to_openai_format, messages, system)
         openai_tools = self._convert_tools_config(tool_config)
         
         # Convert Bedrock request parameters to OpenAI parameters
@@ -378,6 +382,7 @@ class CompatibleChatClientStream(CompatibleChatClient):
         
         only_n_most_recent_images = extra_params.get('only_n_most_recent_images', 3)
         image_truncation_threshold = only_n_most_recent_images or 0
+        history_index = HistoryIndex(messages)
         
         while turn_i <= max_turns and stop_reason != 'end_turn':
             # Check if we need to stop
@@ -388,7 +393,8 @@ class CompatibleChatClientStream(CompatibleChatClient):
                 
             try:
                 # Make the API request using the OpenAI SDK directly
-                response = deepseek_r1_chat_stream(**request_payload) if "deepseek-r1" in model_id.lower() and not TOOL_USE_SUPPORT else self.openai_client.chat.completions.create(**request_payload)
+                create_fn = deepseek_r1_chat_stream if "deepseek-r1" in model_id.lower() and not TOOL_USE_SUPPORT else self.openai_client.chat.completions.create
+                response = await self._create_chat_completion(create_fn, **request_payload)
                 
                 # Process the streaming response
                 # yield twice (event+tool_result)
@@ -438,6 +444,8 @@ class CompatibleChatClientStream(CompatibleChatClient):
                         # Handle tool use if needed
                         if stop_reason == "tool_use" and tool_calls:
                             # Execute all tool calls in parallel
+                            # 工具执行期间MCP服务器发来的进度和日志通知
+                            progress_events = asyncio.Queue()
                             async def execute_tool_call(tool):
                                 logger.info("Call tool: %s" % tool)
                                 try:
@@ -445,14 +453,16 @@ class CompatibleChatClientStream(CompatibleChatClient):
                                     if tool_args == "":
                                         tool_args = {}
                                     # Parse the tool name
-                                    server_id, llm_tool_name = MCPClient.get_tool_name4mcp(tool_name)
+                                    server_id, llm_tool_name = self.tool_names.resolve(tool_name)
                                     mcp_client = mcp_clients.get(server_id)
                                     if mcp_client is None:
                                         raise Exception(f"mcp_client is None, server_id:{server_id}")
                                     
-                                    result = await mcp_client.call_tool(llm_tool_name, tool_args)
+                                    def on_progress(update, tool=tool):
+                                        progress_events.put_nowait({"toolUseId": tool['toolUseId'], "name": tool['name'], **update})
+                                    result = await mcp_client.call_tool(llm_tool_name, tool_args, on_progress=on_progress)
                                     result_content = [{"text": "\n".join([x.text for x in result.content if x.type == 'text'])}]
-                                    image_content = [{"image":{"format":x.mimeType.replace('image/',''), "source":{"bytes":base64.b64decode(x.data)} } } for x in result.content if x.type == 'image']
+                                    image_content = [{"image":{"format":x.mimeType.replace('image/',''), "source":{"bytes":blob_store.intern(base64.b64decode(x.data))} } } for x in result.content if x.type == 'image']
                                     
                                     # Content block for json serializable
                                     image_content_base64 = [{"image":{"format":x.mimeType.replace('image/',''), "source":{"base64":x.data} } } for x in result.content if x.type == 'image']
@@ -478,7 +488,18 @@ class CompatibleChatClientStream(CompatibleChatClient):
                                             }]*3
                             
                             # Execute all tool calls in parallel
-                            call_results = await asyncio.gather(*[execute_tool_call(tool) for tool in tool_calls])
+                            # 停止请求或客户端断开时取消所有进行中的工具调用
+                            stop_event = self.stop_events[stream_id][1] if stream_id in self.stop_events else None
+                            tool_task = asyncio.ensure_future(run_until_stopped(
+                                asyncio.gather(*[execute_tool_call(tool) for tool in tool_calls]), stop_event))
+                            # 长时间运行的工具在执行期间实时输出进度，同时避免连接因空闲被代理断开
+                            async with aclosing(drain_until_done(tool_task, progress_events)) as updates:
+                                async for update in updates:
+                                    yield {"type": "tool_progress", "data": update}
+                            completed, call_results = tool_task.result()
+                            if not completed:
+                                logger.info(f"Stream {stream_id} stopped while calling tools")
+                                break
                             
                             tool_results = []
                             tool_results_serializable = []
@@ -525,14 +546,13 @@ class CompatibleChatClientStream(CompatibleChatClient):
                             
                             # Filter images if needed
                             if only_n_most_recent_images:
-                                maybe_filter_to_n_most_recent_images(
-                                    messages,
+                                history_index.filter_images(
                                     only_n_most_recent_images,
                                     min_removal_threshold=image_truncation_threshold,
                                 )
                             
                             # Update OpenAI messages format for the next request
-                            openai_messages = self._convert_messages_to_openai_format(messages, system)
+                            openai_messages = await run_blocking(self._convert_messages_to_openai_format, messages, system)
                             # logger.info(openai_messages)
                             request_payload["messages"] = openai_messages
                             
@@ -0,0 +1,164 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Throttle-aware, least-loaded balancer over the Bedrock credential pool
+"""
+import os
+import time
+import logging
+from collections import deque
+from typing import Any, Dict, Hashable, List, Optional
+from dotenv import load_dotenv
+from bedrock_client_registry import client_registry
+from throttle_scheduler import format_throttle_key
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 单个凭证每分钟可用的token数（按账号配额配置），用于估算剩余容量
+CREDENTIAL_TPM_LIMIT = int(os.environ.get("CREDENTIAL_TPM_LIMIT", 400000))
+# 单个凭证期望的最大并发流数量
+CREDENTIAL_MAX_STREAMS = int(os.environ.get("CREDENTIAL_MAX_STREAMS", 20))
+# 被限流后熔断冷却时间（秒），连续限流时指数增长
+CREDENTIAL_COOLDOWN = float(os.environ.get("CREDENTIAL_COOLDOWN", 15))
+CREDENTIAL_MAX_COOLDOWN = float(os.environ.get("CREDENTIAL_MAX_COOLDOWN", 120))
+
+TPM_WINDOW = 60
+
+
+class CredentialLoad:
+    """Outstanding streams, observed tokens per minute and breaker state of one credential"""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.usage = deque()  # (timestamp, tokens)
+        self.window_tokens = 0
+        self.open_until = 0.0
+        self.half_open_probe = False
+        # 半开状态下放行的探测请求的截止时间，与已在进行中的长流无关
+        self.probe_until = 0.0
+        self.consecutive_throttles = 0
+        self.last_pick = 0.0
+        # counters
+        self.picks = 0
+        self.throttles = 0
+
+    def tokens_per_minute(self, now: float) -> int:
+        while self.usage and self.usage[0][0] < now - TPM_WINDOW:
+            self.window_tokens -= self.usage.popleft()[1]
+        return self.window_tokens
+
+    def is_open(self, now: float) -> bool:
+        """Open breaker rejects new turns; after the cool-down one probe is let through"""
+        if now < self.open_until:
+            return True
+        return self.half_open_probe and now < self.probe_until
+
+
+class CredentialBalancer:
+    """Route new turns to the credential with the most headroom.
+
+    Headroom combines the remaining share of the per-credential TPM budget and the
+    free stream slots. A ThrottlingException opens the credential's circuit breaker
+    for an exponentially growing cool-down; after it expires the credential is
+    half-open and receives a single probe before taking full load again.
+    """
+
+    def __init__(self, tpm_limit: int = CREDENTIAL_TPM_LIMIT, max_streams: int = CREDENTIAL_MAX_STREAMS,
+                 cooldown: float = CREDENTIAL_COOLDOWN, max_cooldown: float = CREDENTIAL_MAX_COOLDOWN):
+        self.tpm_limit = tpm_limit
+        self.max_streams = max_streams
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.loads: Dict[Hashable, CredentialLoad] = {}
+
+    @staticmethod
+    def _key(bedrock_client) -> Hashable:
+        return client_registry.credential_key(bedrock_client) or id(bedrock_client)
+
+    def _load(self, bedrock_client) -> CredentialLoad:
+        key = self._key(bedrock_client)
+        load = self.loads.get(key)
+        if load is None:
+            load = self.loads[key] = CredentialLoad()
+        return load
+
+    def headroom(self, bedrock_client, now: Optional[float] = None) -> float:
+        now = now or time.monotonic()
+        load = self._load(bedrock_client)
+        tpm_headroom = 1 - load.tokens_per_minute(now) / self.tpm_limit
+        stream_headroom = 1 - load.in_flight / self.max_streams
+        return min(tpm_headroom, stream_headroom)
+
+    def pick(self, clients: List, exclude=None) -> Any:
+        """Choose the client with the most headroom among those whose breaker is closed"""
+        now = time.monotonic()
+        candidates = [c for c in clients if c is not exclude] or clients
+        available = [c for c in candidates if not self._load(c).is_open(now)]
+        if available:
+            # 容量相同则选择最久未被选中的凭证，保证均匀分布
+            client = max(available, key=lambda c: (self.headroom(c, now), -self._load(c).last_pick))
+        else:
+            # 全部熔断时选择最早恢复的凭证
+            client = min(candidates, key=lambda c: self._load(c).open_until)
+        load = self._load(client)
+        load.last_pick = now
+        load.picks += 1
+        if now >= load.open_until and load.half_open_probe and now >= load.probe_until:
+            # 探测请求的结果由record_success/record_throttle上报；请求未能上报结果时，冷却时间后再放行下一个探测
+            load.probe_until = now + self.cooldown
+            logger.info(f"Probe half-open credential {format_throttle_key(self._key(client))}")
+        return client
+
+    def acquire(self, bedrock_client):
+        self._load(bedrock_client).in_flight += 1
+
+    def release(self, bedrock_client):
+        load = self._load(bedrock_client)
+        load.in_flight = max(0, load.in_flight - 1)
+
+    def record_usage(self, bedrock_client, tokens: int):
+        """Feed token usage from converse_stream metadata events"""
+        load = self._load(bedrock_client)
+        load.usage.append((time.monotonic(), tokens))
+        load.window_tokens += tokens
+
+    def record_success(self, bedrock_client):
+        load = self._load(bedrock_client)
+        load.consecutive_throttles = 0
+        load.half_open_probe = False
+        load.probe_until = 0.0
+
+    def record_throttle(self, bedrock_client):
+        load = self._load(bedrock_client)
+        cooldown = min(self.max_cooldown, self.cooldown * (2 ** load.consecutive_throttles))
+        load.consecutive_throttles += 1
+        load.throttles += 1
+        load.open_until = time.monotonic() + cooldown
+        load.half_open_probe = True
+        load.probe_until = 0.0
+        logger.warning(f"Credential {format_throttle_key(self._key(bedrock_client))} throttled, breaker open for {cooldown:.1f}s")
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        result = {}
+        for key, load in self.loads.items():
+            result[format_throttle_key(key)] = {
+                "in_flight": load.in_flight,
+                "tokens_per_minute": load.tokens_per_minute(now),
+                "breaker": "open" if now < load.open_until else ("half_open" if load.half_open_probe else "closed"),
+                "picks": load.picks,
+                "throttles": load.throttles,
+            }
+        return result
+
+
+# 进程内共享的凭证负载均衡器
+credential_balancer = CredentialBalancer()
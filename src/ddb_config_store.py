@@ -0,0 +1,314 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Write-behind DynamoDB persistence of user MCP server configs, one attribute per (user, server)
+"""
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional
+import boto3
+from dotenv import load_dotenv
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+DDB_TABLE = os.environ.get("ddb_table")  # DynamoDB表名，用于存储用户配置
+# 自定义DynamoDB地址，例如本地的DynamoDB Local，为空时使用AWS区域的默认地址
+DDB_ENDPOINT_URL = os.environ.get("DDB_ENDPOINT_URL", "")
+# 修改在内存中合并多久后写入DynamoDB（秒）
+DDB_FLUSH_INTERVAL = float(os.environ.get("DDB_FLUSH_INTERVAL", 0.5))
+# 一次刷新中并发执行的UpdateItem数量
+DDB_FLUSH_CONCURRENCY = int(os.environ.get("DDB_FLUSH_CONCURRENCY", 8))
+# 写入失败后重试间隔按指数增长的上限（秒）
+DDB_FLUSH_MAX_BACKOFF = float(os.environ.get("DDB_FLUSH_MAX_BACKOFF", 30))
+
+# 每个服务器的配置保存在用户记录的一个独立属性中
+SERVER_ATTR_PREFIX = "server:"
+# 旧版本把用户的全部配置序列化后保存在data属性中，读取时迁移
+LEGACY_DATA_ATTR = "data"
+_UNKNOWN = object()
+
+
+class DDBConfigStore:
+    """User MCP configs in a DynamoDB table keyed by userId.
+
+    Each server's config is a JSON string attribute `server:<server_id>` of the user's
+    item, so a change is a single-attribute UpdateItem instead of a read and a put of the
+    whole blob. put/delete only queue the change, and a background flusher writes each
+    user's pending changes with one UpdateItem after DDB_FLUSH_INTERVAL, backing off
+    exponentially while writes fail. All boto3 calls run in worker threads.
+
+    A write is skipped only when it equals a change of this process that is still queued
+    or being written, or the `previous` value the caller read in the same call. The
+    table may be written by other workers, so values read earlier are never trusted
+    for skipping.
+    """
+
+    def __init__(self, table_name: Optional[str] = DDB_TABLE, endpoint_url: str = DDB_ENDPOINT_URL,
+                 flush_interval: float = DDB_FLUSH_INTERVAL, concurrency: int = DDB_FLUSH_CONCURRENCY,
+                 max_backoff: float = DDB_FLUSH_MAX_BACKOFF):
+        self.table_name = table_name
+        self.endpoint_url = endpoint_url
+        self.flush_interval = flush_interval
+        self.concurrency = concurrency
+        self.max_backoff = max_backoff
+        self._table = None
+        # user_id -> server_id -> 配置JSON，None表示删除
+        self.pending: Dict[str, Dict[str, Optional[str]]] = {}
+        # 正在写入DynamoDB的修改，结构同pending
+        self.inflight: Dict[str, Dict[str, Optional[str]]] = {}
+        # user_id -> server_id -> 最近一次读到或写入的配置JSON，只在读取失败时作为后备，不用于跳过写入
+        self.persisted: Dict[str, Dict[str, str]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        # 连续写入失败的次数，决定下次刷新前的退避时间
+        self._failures = 0
+        # counters
+        self.writes = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.reads = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.table_name)
+
+    def table(self):
+        if self._table is None:
+            resource = boto3.resource('dynamodb', region_name=os.environ.get('AWS_REGION', 'us-east-1'),
+                                      endpoint_url=self.endpoint_url or None)
+            self._table = resource.Table(self.table_name)
+            logger.info(f"已连接到DynamoDB, 表名: {self.table_name}")
+        return self._table
+
+    @staticmethod
+    def _encode(config: Dict) -> str:
+        return json.dumps(config, sort_keys=True, ensure_ascii=False)
+
+    def _current(self, user_id: str, server_id: str):
+        """The latest value this process has queued or is writing, _UNKNOWN if none"""
+        for changes in (self.pending, self.inflight):
+            if server_id in changes.get(user_id, {}):
+                return changes[user_id][server_id]
+        return _UNKNOWN
+
+    def _queue(self, user_id: str, server_id: str, value: Optional[str], previous=_UNKNOWN) -> bool:
+        current = self._current(user_id, server_id)
+        if current is _UNKNOWN:
+            current = previous
+        if current == value:
+            self.skipped += 1
+            return False
+        pending = self.pending.setdefault(user_id, {})
+        if server_id in pending:
+            self.coalesced += 1
+        pending[server_id] = value
+        self._schedule()
+        return True
+
+    def put(self, user_id: str, server_id: str, config: Dict, previous: Optional[Dict] = None) -> bool:
+        """Queue a config write; False if it is known to change nothing.
+
+        `previous` is the stored config the caller has just read, if any.
+        """
+        return self._queue(user_id, server_id, self._encode(config),
+                           self._encode(previous) if previous is not None else _UNKNOWN)
+
+    def delete(self, user_id: str, server_id: str) -> bool:
+        return self._queue(user_id, server_id, None)
+
+    def _schedule(self):
+        if self._flusher is None or self._flusher.done():
+            self._wakeup = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_loop())
+        self._wakeup.set()
+
+    def _delay(self) -> float:
+        if not self._failures:
+            return self.flush_interval
+        return min(self.max_backoff, self.flush_interval * 2 ** self._failures)
+
+    async def _flush_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # 等待一个刷新间隔，把这段时间内的修改合并成一次写入；写入失败时间隔指数增长
+            await asyncio.sleep(self._delay())
+            await self.flush()
+
+    async def flush(self):
+        """Write all pending changes now, one UpdateItem per user"""
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        semaphore = asyncio.Semaphore(self.concurrency)
+        failed = False
+
+        async def write(user_id: str, changes: Dict[str, Optional[str]]):
+            nonlocal failed
+            async with semaphore:
+                # 写入期间的put与正在写入的值比较，而不是与旧值比较
+                self.inflight[user_id] = {**self.inflight.get(user_id, {}), **changes}
+                try:
+                    await asyncio.to_thread(self._update_item, user_id, changes)
+                except asyncio.CancelledError:
+                    self._requeue(user_id, changes)
+                    raise
+                except Exception as e:
+                    self.errors += 1
+                    failed = True
+                    logger.error(f"保存用户 {user_id} 配置到DynamoDB失败: {e}")
+                    self._requeue(user_id, changes)
+                    return
+                finally:
+                    self._finish(user_id, changes)
+                self.writes += 1
+                persisted = self.persisted.get(user_id)
+                if persisted is not None:
+                    for server_id, value in changes.items():
+                        if value is None:
+                            persisted.pop(server_id, None)
+                        else:
+                            persisted[server_id] = value
+
+        await asyncio.gather(*[write(user_id, changes) for user_id, changes in batch.items()])
+        self._failures = self._failures + 1 if failed else 0
+        if failed:
+            logger.warning(f"DynamoDB写入失败，{self._delay():.1f}秒后重试")
+            self._schedule()
+
+    def _finish(self, user_id: str, changes: Dict[str, Optional[str]]):
+        inflight = self.inflight.get(user_id, {})
+        for server_id, value in changes.items():
+            # 同一服务器的更新值可能由另一次并发刷新写入，只移除本次写入的值
+            if server_id in inflight and inflight[server_id] == value:
+                del inflight[server_id]
+        if not inflight:
+            self.inflight.pop(user_id, None)
+
+    def _requeue(self, user_id: str, changes: Dict[str, Optional[str]]):
+        # 未写入的修改放回队列，期间更新的修改优先
+        pending = self.pending.setdefault(user_id, {})
+        for server_id, value in changes.items():
+            pending.setdefault(server_id, value)
+
+    def _update_item(self, user_id: str, changes: Dict[str, Optional[str]]):
+        names = {"#ts": "timestamp"}
+        values: Dict[str, Any] = {":ts": datetime.now().isoformat()}
+        sets = ["#ts = :ts"]
+        removes = []
+        for index, (server_id, value) in enumerate(changes.items()):
+            names[f"#s{index}"] = SERVER_ATTR_PREFIX + server_id
+            if value is None:
+                removes.append(f"#s{index}")
+            else:
+                values[f":s{index}"] = value
+                sets.append(f"#s{index} = :s{index}")
+        expression = "SET " + ", ".join(sets) + (" REMOVE " + ", ".join(removes) if removes else "")
+        self.table().update_item(Key={"userId": user_id}, UpdateExpression=expression,
+                                 ExpressionAttributeNames=names, ExpressionAttributeValues=values)
+
+    def _parse_item(self, item: Dict) -> Dict[str, str]:
+        """server_id -> config JSON, migrating a legacy whole-blob item in place"""
+        stored = {name[len(SERVER_ATTR_PREFIX):]: value for name, value in item.items()
+                  if name.startswith(SERVER_ATTR_PREFIX)}
+        if LEGACY_DATA_ATTR not in item:
+            return stored
+        try:
+            legacy = json.loads(item[LEGACY_DATA_ATTR])
+        except json.JSONDecodeError as e:
+            logger.error(f"解析用户 {item.get('userId')} 的DynamoDB数据失败: {e}")
+            return stored
+        migrated = {server_id: self._encode(config) for server_id, config in legacy.items() if server_id not in stored}
+        names = {"#legacy": LEGACY_DATA_ATTR}
+        values = {}
+        sets = []
+        for index, (server_id, value) in enumerate(migrated.items()):
+            names[f"#s{index}"] = SERVER_ATTR_PREFIX + server_id
+            values[f":s{index}"] = value
+            sets.append(f"#s{index} = :s{index}")
+        expression = ("SET " + ", ".join(sets) + " " if sets else "") + "REMOVE #legacy"
+        params = {"ExpressionAttributeValues": values} if values else {}
+        self.table().update_item(Key={"userId": item["userId"]}, UpdateExpression=expression,
+                                 ExpressionAttributeNames=names, **params)
+        logger.info(f"已把用户 {item['userId']} 的 {len(migrated)} 个服务器配置迁移为独立属性")
+        return {**stored, **migrated}
+
+    def _get_item(self, user_id: str) -> Dict[str, str]:
+        response = self.table().get_item(Key={"userId": user_id})
+        return self._parse_item(response["Item"]) if "Item" in response else {}
+
+    def _merge_pending(self, user_id: str, stored: Dict[str, str]) -> Dict[str, Dict]:
+        merged = {**stored, **self.inflight.get(user_id, {}), **self.pending.get(user_id, {})}
+        return {server_id: json.loads(value) for server_id, value in merged.items() if value is not None}
+
+    async def load(self, user_id: str) -> Dict[str, Dict]:
+        """All server configs of a user, including changes not yet flushed"""
+        self.reads += 1
+        try:
+            stored = await asyncio.to_thread(self._get_item, user_id)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"从DynamoDB获取用户 {user_id} 配置失败: {e}")
+            return self._merge_pending(user_id, self.persisted.get(user_id, {}))
+        self.persisted[user_id] = stored
+        return self._merge_pending(user_id, stored)
+
+    def _scan(self) -> Dict[str, Dict[str, str]]:
+        table = self.table()
+        configs = {}
+        scan_params = {}
+        while True:
+            response = table.scan(**scan_params)
+            for item in response.get('Items', []):
+                if 'userId' in item:
+                    configs[item['userId']] = self._parse_item(item)
+            start_key = response.get('LastEvaluatedKey')
+            if start_key is None:
+                return configs
+            scan_params['ExclusiveStartKey'] = start_key
+
+    async def load_all(self) -> Dict[str, Dict[str, Dict]]:
+        """Configs of all users, handling scan pagination"""
+        stored = await asyncio.to_thread(self._scan)
+        self.persisted.update(stored)
+        logger.info(f"已从DynamoDB扫描到 {len(stored)} 个用户的配置")
+        return {user_id: self._merge_pending(user_id, servers) for user_id, servers in stored.items()}
+
+    async def close(self):
+        """Stop the flusher and write what is still pending"""
+        flusher, self._flusher = self._flusher, None
+        if flusher is not None:
+            flusher.cancel()
+            try:
+                await flusher
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": sum(len(changes) for changes in self.pending.values()),
+            "inflight": sum(len(changes) for changes in self.inflight.values()),
+            "consecutive_failures": self._failures,
+            "writes": self.writes,
+            "skipped": self.skipped,
+            "coalesced": self.coalesced,
+            "reads": self.reads,
+            "errors": self.errors,
+        }
+
+
+# 进程内共享的用户MCP配置DynamoDB存储
+ddb_config_store = DDBConfigStore()
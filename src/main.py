@@ -48,7 +48,21 @@ from mcp.shared.exceptions import McpError
 from fastapi import APIRouter
 from websocket_manager import connection_manager
 from nova_sonic_manager import WebSocketAudioProcessor
-from utils import is_endpoint_sse
+from throttle_scheduler import throttle_scheduler
+from bedrock_client_registry import client_registry
+from credential_balancer import credential_balancer
+from prompt_cache_planner import prompt_cache_metrics
+from usage_tracker import UsageAccumulator, usage_counter
+from sse_encoder import SSEEncoder, SSEStreamingResponse, SSE_DONE
+from stream_engine import iterate_with_deadline
+from mcp_server_pool import shared_server_pool
+from tool_result_cache import tool_result_cache
+from mcp_warm_pool import warm_pool
+from mcp_http_pool import http_pool
+from session_store import session_store
+from session_lru import SessionLRU, estimate_session_bytes
+from blob_store import blob_store
+from ddb_config_store import ddb_config_store
 
 
 logging.basicConfig(
@@ -63,16 +77,26 @@ logger = logging.getLogger(__name__)
 load_dotenv()  # load env vars from .env
 llm_model_list = {}
 shared_mcp_server_list = {}  # 共享的MCP服务器描述信息
-# 用户会话存储
-user_sessions = {}
-# 活跃流式请求的字典，用于跟踪可以停止的请求
-active_streams = {}
-# 使用独立的锁来保护active_streams字典
-active_streams_lock = asyncio.Lock()
+# 用户会话存储，按最近活跃顺序排列，超出数量或内存预算时淘汰最久未用的会话
+user_sessions = SessionLRU()
+# 会话超出预算时唤醒清理任务
+session_budget_exceeded = asyncio.Event()
+# 本worker上正在进行的流式请求 stream_id -> UserSession
+local_streams = {}
 MAX_TURNS = int(os.environ.get("MAX_TURNS",200))
 INACTIVE_TIME = int(os.environ.get("INACTIVE_TIME",60*24))  #mins
+# 单个MCP服务器启动连接的截止时间（秒）
+MCP_CONNECT_TIMEOUT = float(os.environ.get("MCP_CONNECT_TIMEOUT", 30))
+# 延迟连接：用户服务器在首次使用时才连接，最近使用过的若干个在后台预热
+MCP_LAZY_CONNECT = os.environ.get("MCP_LAZY_CONNECT", "0") in ["1", "true", "True"]
+MCP_WARM_RECENT = int(os.environ.get("MCP_WARM_RECENT", 3))
+# 全局MCP服务器和模型配置文件，多worker模式下每个worker启动时各自加载
+MCP_CONF_FILE = os.environ.get("MCP_CONF_FILE", "")
+# 检查其他worker转发来的停止请求的间隔（秒）
+STOP_POLL_INTERVAL = float(os.environ.get("STOP_POLL_INTERVAL", 0.5))
 DDB_TABLE = os.environ.get("ddb_table")  # DynamoDB表名，用于存储用户配置
 API_KEY = os.environ.get("API_KEY")
+CREDENTIAL_FILE = "conf/credentials.csv"
 
 security = HTTPBearer()
 
@@ -82,20 +106,31 @@ class UserSession:
     def __init__(self, user_id):
         self.user_id = user_id
         if os.environ.get('use_bedrock',"1") in [1,'1']:
-            if os.path.exists("conf/credentials.csv"):
-                self.chat_client = ChatClientStream(credential_file="conf/credentials.csv")
+            if os.path.exists(CREDENTIAL_FILE):
+                self.chat_client = ChatClientStream(credential_file=CREDENTIAL_FILE)
             else:
                 self.chat_client = ChatClientStream()
         else:
             self.chat_client = CompatibleChatClientStream()
 
         self.mcp_clients = {}  # 用户特定的MCP客户端
+        self.server_status = {}  # server_id -> connecting/ready/failed
+        self.server_tasks = {}  # server_id -> 正在连接的后台任务
         self.last_active = datetime.now()
         self.session_id = str(uuid.uuid4())
+        # 正在处理的请求数，大于0时不会被淘汰
+        self.active_requests = 0
         # self.lock = asyncio.Lock()  # 用于同步会话内的操作
 
+    def release(self):
+        """一个请求处理结束，活跃请求数减一"""
+        self.active_requests -= 1
+
     async def cleanup(self):
         """清理用户会话资源"""
+        for task in self.server_tasks.values():
+            task.cancel()
+        self.server_tasks = {}
         cleanup_tasks = []
         client_ids = list(self.mcp_clients.keys())
         for client_id in client_ids:
@@ -106,6 +141,31 @@ class UserSession:
         if cleanup_tasks:
             await asyncio.gather(*cleanup_tasks)
             logger.info(f"用户 {self.user_id} 的 {len(cleanup_tasks)} 个MCP客户端已清理")
+
+    async def load_history(self):
+        """从会话存储恢复历史，请求可能被其他worker处理过"""
+        try:
+            state = await session_store.load_history(self.user_id)
+        except Exception as e:
+            session_store.errors += 1
+            logger.error(f"加载用户 {self.user_id} 的会话历史失败: {e}")
+            return
+        if state is not None:
+            self.chat_client.restore_state(state)
+
+    async def save_history(self):
+        """请求结束后把历史和prompt cache状态写回会话存储"""
+        try:
+            await session_store.save_history(self.user_id, self.chat_client.export_state())
+        except Exception as e:
+            session_store.errors += 1
+            logger.error(f"保存用户 {self.user_id} 的会话历史失败: {e}")
+
+    def update_size(self):
+        """重新估算会话占用的内存，超出预算时唤醒清理任务"""
+        user_sessions.resize(self.user_id, estimate_session_bytes(self))
+        if user_sessions.over_budget():
+            session_budget_exceeded.set()
     
     async def process_audio(self, audio_data: bytes):
         """处理用户的音频数据"""
@@ -144,53 +204,121 @@ async def get_api_key(auth: HTTPAuthorizationCredentials = Security(security)):
     raise HTTPException(status_code=403, detail="Could not validate credentials")
 
             
+async def connect_user_server(session: UserSession, server_id: str, config: dict):
+    """在截止时间内连接单个用户MCP服务器并更新其状态"""
+    def on_status(status):
+        session.server_status[server_id] = status
+
+    # 优先使用预热池中已经启动好的实例
+    mcp_client = warm_pool.take(config, name=f"{session.user_id}_{server_id}", on_status=on_status)
+    try:
+        if mcp_client is None:
+            mcp_client = MCPClient(name=f"{session.user_id}_{server_id}")
+            await asyncio.wait_for(mcp_client.connect_with_config(config, on_status=on_status, timeout=MCP_CONNECT_TIMEOUT),
+                                   timeout=MCP_CONNECT_TIMEOUT)
+        # 添加到用户的客户端列表
+        session.mcp_clients[server_id] = mcp_client
+        session.server_status[server_id] = "ready"
+        # config是本次初始化时刚从存储读到的，未变化时不必重写
+        await save_user_server_config(session.user_id, server_id, config, previous=config)
+        logger.info(f"User Id {session.user_id} initialize server {server_id}")
+    except Exception as e:
+        session.server_status[server_id] = "failed"
+        if isinstance(e, asyncio.TimeoutError):
+            logger.error(f"User Id  {session.user_id} initialize server {server_id} timed out after {MCP_CONNECT_TIMEOUT}s")
+        else:
+            logger.error(f"User Id  {session.user_id} initialize server {server_id} failed: {e}")
+        try:
+            await mcp_client.cleanup()
+        except Exception as cleanup_error:
+            logger.error(f"清理失败连接资源出错: {cleanup_error}")
+    finally:
+        session.server_tasks.pop(server_id, None)
+
+def register_lazy_user_server(session: UserSession, server_id: str, config: dict) -> MCPClient:
+    """注册延迟连接的用户MCP服务器，首次get_tool_config/call_tool时才启动；预热池中有实例时直接使用"""
+    def on_status(status):
+        session.server_status[server_id] = status
+        if status == "ready":
+            # 记录最近使用时间，供下次创建会话时决定预热哪些服务器
+            asyncio.create_task(save_user_server_config(session.user_id, server_id, {**config, "last_used": int(time.time())}))
+
+    mcp_client = warm_pool.take(config, name=f"{session.user_id}_{server_id}", on_status=on_status)
+    if mcp_client is not None:
+        session.mcp_clients[server_id] = mcp_client
+        session.server_status[server_id] = "ready"
+        return mcp_client
+    mcp_client = MCPClient(name=f"{session.user_id}_{server_id}")
+    mcp_client.defer_connect(config, timeout=MCP_CONNECT_TIMEOUT, on_status=on_status)
+    session.mcp_clients[server_id] = mcp_client
+    session.server_status[server_id] = "idle"
+    return mcp_client
+
+async def warm_user_server(session: UserSession, server_id: str, mcp_client: MCPClient):
+    """后台预热最近使用过的服务器"""
+    try:
+        await mcp_client.ensure_connected()
+    except BaseException as e:
+        logger.warning(f"User Id {session.user_id} warm up server {server_id} failed: {e!r}")
+    finally:
+        session.server_tasks.pop(server_id, None)
+
 async def initialize_user_servers(session: UserSession):
-    """初始化用户特有的MCP服务器"""
+    """初始化用户特有的MCP服务器
+
+    各服务器在后台并发连接，每个都有独立的截止时间；不依赖慢服务器的请求无需等待。
+    """
     user_id = session.user_id
     
     # 获取用户服务器配置（现在是异步方法）
     server_configs = await get_user_server_configs(user_id)
     
+    # 标记为无状态的全局服务器由进程内共享的实例池提供，不再为每个用户单独启动子进程
+    for server_id, shared_server in (await shared_server_pool.get_clients()).items():
+        if server_id not in session.mcp_clients:
+            session.mcp_clients[server_id] = shared_server.for_session(user_id)
+        session.server_status[server_id] = "ready"
+    # 有状态的全局服务器（浏览器、工作目录等）与用户服务器一样，每个用户单独启动
     global_server_configs = get_global_server_configs()
-    # 合并全局和用户的servers
-    server_configs = {**server_configs, **global_server_configs}
+    server_configs = {server_id: config for server_id, config in {**server_configs, **global_server_configs}.items()
+                      if not shared_server_pool.is_shared(server_id)}
     
     logger.info(f"server_configs:{server_configs}")
+    if MCP_LAZY_CONNECT:
+        recent = sorted([server_id for server_id, config in server_configs.items() if config.get("last_used")],
+                        key=lambda server_id: server_configs[server_id]["last_used"], reverse=True)[:MCP_WARM_RECENT]
+        for server_id, config in server_configs.items():
+            if server_id in session.mcp_clients or server_id in session.server_tasks:
+                continue
+            mcp_client = register_lazy_user_server(session, server_id, config)
+            if server_id in recent:
+                session.server_tasks[server_id] = asyncio.create_task(warm_user_server(session, server_id, mcp_client))
+        return
+
     # 初始化服务器连接
     for server_id, config in server_configs.items():
-        if server_id in session.mcp_clients:  # 跳过已存在的服务器
+        # 跳过已存在或正在连接的服务器
+        if server_id in session.mcp_clients or server_id in session.server_tasks:
             continue
-            
-        try:
-            # 创建并连接MCP服务器
-            mcp_client = MCPClient(name=f"{session.user_id}_{server_id}")
-            server_url = config.get('url',"")
-            
-            await mcp_client.connect_to_server(
-                command=config.get('command'),
-                server_url=server_url,
-                http_type= "sse" if is_endpoint_sse(server_url) else "streamable_http" ,
-                token=config.get('token', None),
-                server_script_args=config.get("args", []),
-                server_script_envs=config.get("env", {})
-            )
-            
-            # 添加到用户的客户端列表
-            session.mcp_clients[server_id] = mcp_client
-            await save_user_server_config(user_id, server_id, config)
-            logger.info(f"User Id {session.user_id} initialize server {server_id}")
-            
-        except Exception as e:
-            logger.error(f"User Id  {session.user_id} initialize server {server_id} failed: {e}")
-    # 保存配置        
-    # await save_user_mcp_configs()
+        session.server_status[server_id] = "connecting"
+        session.server_tasks[server_id] = asyncio.create_task(connect_user_server(session, server_id, config))
+
+async def wait_for_user_servers(session: UserSession, server_ids: list):
+    """等待本次请求用到的、仍在连接中的服务器（各自受连接截止时间约束）"""
+    tasks = [session.server_tasks[server_id] for server_id in server_ids or [] if server_id in session.server_tasks]
+    if tasks:
+        await asyncio.wait(tasks)
 
 async def get_or_create_user_session(
     request: Request,
     auth: HTTPAuthorizationCredentials = Security(security),
-    create_new = True
+    create_new = True,
+    hold = False
 ):
-    """获取或创建用户会话，优先使用X-User-ID头，并自动初始化用户服务器"""
+    """获取或创建用户会话，优先使用X-User-ID头，并自动初始化用户服务器
+
+    hold为True时在第一次await之前把会话计为活跃，会话在请求使用前不会被清理；调用方负责减一。
+    """
     # 先验证API密钥
     await get_api_key(auth)
     
@@ -203,43 +331,51 @@ async def get_or_create_user_session(
         return None
         
     if is_new_session:
-        user_sessions[user_id] = UserSession(user_id)
+        user_sessions.add(user_id, UserSession(user_id))
         logger.info(f"为用户 {user_id} 创建新会话: {user_sessions[user_id].session_id}")
     
     # 更新最后活跃时间
+    user_sessions.touch(user_id)
     user_sessions[user_id].last_active = datetime.now()
     session = user_sessions[user_id]
+    if hold:
+        session.active_requests += 1
     
-    # 如果是新会话，初始化用户的MCP服务器
-    if is_new_session:
-        await initialize_user_servers(session)
-    elif not session.mcp_clients:# 如果用户的MCP服务器已经为空，则重新初始化
-        await initialize_user_servers(session)
-        
+    try:
+        # 如果是新会话，初始化用户的MCP服务器
+        if is_new_session:
+            await initialize_user_servers(session)
+            session.update_size()
+        elif not session.mcp_clients:# 如果用户的MCP服务器已经为空，则重新初始化
+            await initialize_user_servers(session)
+            session.update_size()
+    except BaseException:
+        if hold:
+            session.release()
+        raise
     
     return session
 
 async def cleanup_inactive_sessions():
-    """定期清理不活跃的用户会话"""
+    """清理不活跃或超出预算的用户会话，只检查最久未用的一端"""
     while True:
-        await asyncio.sleep(10)  # 每10s检查一次
-        current_time = datetime.now()
-        inactive_users = []
-        
-        # 找出不活跃的用户
-        with session_lock:
-            for user_id, session in user_sessions.items():
-                if (current_time - session.last_active) > timedelta(minutes=INACTIVE_TIME):
-                    inactive_users.append(user_id)
+        # 每10s检查一次，超出预算时立即检查
+        try:
+            await asyncio.wait_for(session_budget_exceeded.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            pass
+        session_budget_exceeded.clear()
+        inactive_users = user_sessions.select_evictions(INACTIVE_TIME * 60,
+                                                        is_busy=lambda session: session.active_requests > 0)
         
-        for user_id in inactive_users:
-            with session_lock:
-                if user_id in user_sessions:
-                    session = user_sessions.pop(user_id)
-                    try:
-                        await session.cleanup()
-                    except Exception as e:
-                        logger.error(f"清理用户 {user_id} 会话失败: {e}")
+        for user_id, session in inactive_users:
+            try:
+                await session.cleanup()
+                # 进程内存储的历史随会话一起释放；共享存储中的历史留给其他worker
+                if not session_store.shared:
+                    await session_store.delete_history(user_id)
+            except Exception as e:
+                logger.error(f"清理用户 {user_id} 会话失败: {e}")
         
         if inactive_users:
             logger.info(f"已清理 {len(inactive_users)} 个不活跃用户会话")
@@ -293,7 +429,7 @@ class ChatResponse(BaseModel):
     created: int
     model: str
     choices: List[Dict[str, Any]]
-    usage: Dict[str, int]
+    usage: Dict[str, Any]
 
 class AddMCPServerRequest(BaseModel):
     server_id: str = ''
@@ -309,9 +445,43 @@ class AddMCPServerResponse(BaseModel):
     data: Dict[str, Any] = Field(default_factory=dict)
 
 
+def load_server_config(conf_file: str):
+    """加载全局MCP服务器和模型配置"""
+    with open(conf_file, 'r') as f:
+        conf = json.load(f)
+    # 加载全局MCP服务器配置
+    for server_id, server_conf in conf.get('mcpServers', {}).items():
+        if server_conf.get('status') == 0:
+            continue
+        shared_mcp_server_list[server_id] = server_conf.get('description', server_id)
+        save_global_server_config(server_id, server_conf)
+
+    # 加载模型配置
+    for model_conf in conf.get('models', []):
+        llm_model_list[model_conf['model_id']] = model_conf['model_name']
+
+async def watch_remote_stops():
+    """定期检查会话存储中针对本worker上流式请求的停止请求"""
+    while True:
+        await asyncio.sleep(STOP_POLL_INTERVAL)
+        if not local_streams:
+            continue
+        try:
+            stopped = await session_store.stopped_streams(list(local_streams))
+        except Exception as e:
+            logger.error(f"Error checking stop requests in session store: {e}")
+            continue
+        for stream_id in stopped:
+            session = local_streams.get(stream_id)
+            if session is not None and session.chat_client.stop_stream(stream_id):
+                logger.info(f"Stopped stream {stream_id} on request from another worker")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """服务器启动时执行的任务"""
+    # 加载全局MCP服务器和模型配置
+    if MCP_CONF_FILE:
+        load_server_config(MCP_CONF_FILE)
     # 加载持久化的用户MCP配置
     await load_user_mcp_configs()
     # 启动其他初始化任务
@@ -322,8 +492,21 @@ async def lifespan(app: FastAPI):
     
 async def startup_event():
     """服务器启动时执行的任务"""
+    # 预先构建共享的Bedrock client和凭证池，避免首个请求承担构建开销
+    if os.environ.get('use_bedrock',"1") in [1,'1']:
+        try:
+            client_registry.warm_up(CREDENTIAL_FILE)
+        except Exception as e:
+            logger.error(f"初始化Bedrock client失败: {e}")
+    # 启动全局MCP服务器的共享实例
+    await shared_server_pool.start(get_global_server_configs())
+    # 启动stdio MCP服务器预热池的空闲实例回收
+    warm_pool.start()
     # 启动会话清理任务
     asyncio.create_task(cleanup_inactive_sessions())
+    # 会话存储被多个worker共享时，停止请求可能落在其他worker上
+    if session_store.shared:
+        asyncio.create_task(watch_remote_stops())
 
 async def shutdown_event():
     """服务器关闭时执行的任务"""
@@ -347,6 +530,14 @@ async def shutdown_event():
         await asyncio.gather(*cleanup_tasks)
         logger.info(f"已清理所有 {len(cleanup_tasks)} 个用户会话")
 
+    # 关闭全局MCP服务器的共享实例
+    await shared_server_pool.close_all()
+    await warm_pool.close_all()
+    await http_pool.close_all()
+    await session_store.close()
+    # 写入尚未刷新到DynamoDB的用户配置
+    await ddb_config_store.close()
+
 
 app = FastAPI(lifespan=lifespan)
 
@@ -394,14 +585,50 @@ async def list_mcp_server(
     # 合并全局和用户特定的服务器列表
     server_list = {**shared_mcp_server_list}
     
-    # 添加用户特有的服务器
-    for server_id in session.mcp_clients:
+    # 添加用户特有的服务器（包括仍在连接中的）
+    for server_id in list(session.mcp_clients) + list(session.server_status):
         if server_id not in server_list:
             server_list[server_id] = f"User-specific server: {server_id}"
     
+    # 每个服务器的工具调用并发/超时/取消计数
     return JSONResponse(content={"servers": [{
         "server_id": sid, 
-        "server_name": name} for sid, name in server_list.items()]})
+        "server_name": name,
+        "status": session.server_status.get(sid, "ready" if sid in session.mcp_clients else "failed"),
+        "call_stats": session.mcp_clients[sid].call_stats() if sid in session.mcp_clients else None} for sid, name in server_list.items()]})
+
+@list_router.get("/v1/stats")
+async def get_stats(
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """获取服务运行统计信息（限流/重试计数等）"""
+    await get_api_key(auth)
+    return JSONResponse(content={
+        "throttle": throttle_scheduler.stats(),
+        "bedrock_clients": client_registry.stats(),
+        "credentials": credential_balancer.stats(),
+        "prompt_cache": prompt_cache_metrics.stats(),
+        "usage": usage_counter.summary(),
+        "mcp_shared_servers": shared_server_pool.stats(),
+        "tool_result_cache": tool_result_cache.stats(),
+        "mcp_warm_pool": warm_pool.stats(),
+        "mcp_http_pool": http_pool.stats(),
+        "session_store": session_store.stats(),
+        "sessions": user_sessions.stats(),
+        "blob_store": blob_store.stats(),
+        "ddb_config_store": ddb_config_store.stats(),
+    })
+
+@list_router.get("/v1/usage")
+async def get_usage(
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """获取当前用户的token用量（滚动窗口和累计）"""
+    await get_api_key(auth)
+    user_id = request.headers.get("X-User-ID", auth.credentials)
+    return JSONResponse(content=usage_counter.stats(user_id))
 
 # 将stop_router包含在主应用中, 注意这个顺序必须在接口定义之后
 app.include_router(list_router)
@@ -414,6 +641,8 @@ async def remove_history(
 ):
     # 获取用户会话
     session = await get_or_create_user_session(request, auth,create_new=False)
+    # 历史可能由其他worker保存在会话存储中，一并删除
+    await session_store.delete_history(request.headers.get("X-User-ID", auth.credentials))
     if not session:
         # 没有找到session立即返回响应给客户端
         return JSONResponse(
@@ -447,56 +676,54 @@ async def stop_stream(
     auth: HTTPAuthorizationCredentials = Security(security)
 ):
     """停止正在进行的模型输出流"""
-    global active_streams
-    logger.info(f"stopping request:{stream_id} in {active_streams}")
+    logger.info(f"stopping request:{stream_id}")
     
     try:
-        # 获取用户会话
-        session = await get_or_create_user_session(request, auth)
-        user_id = session.user_id
+        # 流可能在其他worker上，这里不为停止请求创建新会话
+        await get_api_key(auth)
+        user_id = request.headers.get("X-User-ID", auth.credentials)
         
         # 检查流是否存在且属于当前用户
         authorized = True
-        async with active_streams_lock:
-            if stream_id in active_streams:
-                if active_streams[stream_id] != user_id:
-                    authorized = False
-            else:
-                # 流ID不在活跃列表中，但我们仍然尝试停止它
-                logger.warning(f"Stream {stream_id} not found in active_streams but still trying to stop it")
+        # 流的归属记录在会话存储中，任一worker都能校验
+        owner = await session_store.stream_owner(stream_id)
+        if owner is not None:
+            if owner != user_id:
+                authorized = False
+        else:
+            # 流ID不在活跃列表中，但我们仍然尝试停止它
+            logger.warning(f"Stream {stream_id} not found in session store but still trying to stop it")
         
         if not authorized:
             return JSONResponse(content={"errno": -1, "msg": "Not authorized to stop this stream"})
         
         # 使用BackgroundTasks处理停止流的操作，确保即使客户端断开连接，流也能被正确停止
-        def stop_stream_task(stream_id, session):
+        async def stop_stream_task(stream_id):
             try:
                 # 调用流停止功能，即使流可能已经结束
-                success = session.chat_client.stop_stream(stream_id)
+                session = local_streams.get(stream_id) or user_sessions.get(user_id)
+                success = session is not None and session.chat_client.stop_stream(stream_id)
                 if success:
                     logger.info(f"Successfully initiated stop for stream {stream_id}")
                     
-                    # 在异步任务中安全地更新共享状态
+                    # 更新会话存储中的流归属记录
                     try:
-                        if stream_id in active_streams:
-                            active_streams.pop(stream_id, None)
-                            logger.info(f"Removed {stream_id} from active_streams")
+                        await session_store.release_stream(stream_id)
+                        logger.info(f"Released {stream_id} in session store")
                     except Exception as e:
-                        logger.error(f"Error removing stream from active_streams: {e}")
+                        logger.error(f"Error releasing stream in session store: {e}")
+                elif owner is not None and session_store.shared:
+                    # 流由其他worker处理，通过会话存储通知该worker停止
+                    await session_store.request_stop(stream_id)
+                    logger.info(f"Forwarded stop of stream {stream_id} to its worker")
                 else:
                     logger.warning(f"Failed to stop stream {stream_id}")
-                    # 即使返回失败也尝试从活跃流列表中移除，防止僵尸流
-                    try:
-                        if stream_id in active_streams:
-                            active_streams.pop(stream_id, None)
-                    except Exception as e:
-                        logger.error(f"Error removing stream from active_streams: {e}")
                         
             except Exception as e:
                 logger.error(f"Error in background task stopping stream {stream_id}: {e}")
         
         # 添加后台任务
-        background_tasks.add_task(stop_stream_task, stream_id, session)
+        background_tasks.add_task(stop_stream_task, stream_id)
         
         # 立即返回响应给客户端
         return JSONResponse(
@@ -552,15 +779,18 @@ async def websocket_user_audio(websocket: WebSocket):
         # 检查用户会话是否存在
         if user_id in user_sessions:
             user_session = user_sessions[user_id]
+            user_sessions.touch(user_id)
             user_session.last_active = datetime.now()
         else:
             # 创建新会话
             user_session = UserSession(user_id)
-            user_sessions[user_id] = user_session
+            user_sessions.add(user_id, user_session)
             logger.info(f"为WebSocket客户端 {client_id} 创建新用户会话: {user_id}")
             
             # 初始化用户的MCP服务器
             await initialize_user_servers(user_session)
+            user_session.update_size()
+        await wait_for_user_servers(user_session, mcp_server_ids)
         
         # 注册连接到连接管理器
         await connection_manager.connect(websocket, client_id)
@@ -657,7 +887,7 @@ async def add_mcp_server(
     
     # 使用会话锁确保操作是线程安全的
     # async with session.lock:
-    if data.server_id in session.mcp_clients:
+    if data.server_id in session.mcp_clients or data.server_id in session.server_tasks:
         return JSONResponse(content=AddMCPServerResponse(
             errno=-1,
             msg="MCP server id exists for this user!"
@@ -686,7 +916,6 @@ async def add_mcp_server(
         server_url = config_json[server_id].get("url","")
         server_script_args = config_json[server_id].get("args",[])
         server_script_envs = config_json[server_id].get('env',{})
-        http_type= "sse" if is_endpoint_sse(server_url) else "streamable_http"
         token=config_json[server_id].get('token', None)
         
     # 连接MCP服务器
@@ -695,23 +924,7 @@ async def add_mcp_server(
         # 创建客户端对象移到try块内
         mcp_client = MCPClient(name=f"{session.user_id}_{server_id}")
         
-        # 添加超时控制
-        connect_task = mcp_client.connect_to_server(
-            command=server_cmd,
-            server_url=server_url,
-            http_type=http_type,
-            token=token,
-            server_script_args=server_script_args,
-            server_script_envs=server_script_envs
-        )
-        
-        # 设置30秒超时
-        await asyncio.wait_for(connect_task, timeout=30.0)
-        
-        tool_conf = await mcp_client.get_tool_config(server_id=server_id)
-        logger.info(f"User {session.user_id} connected to MCP server {server_id}, tools={tool_conf}")
-        
-        # 保存用户服务器配置以便将来恢复
+        # 保存用户服务器配置以便将来恢复，断线重连时也使用同一份配置
         server_config = {
             "url":server_url,
             "command": server_cmd,
@@ -720,10 +933,29 @@ async def add_mcp_server(
             "description": server_desc,
             "token":token,
         }
+
+        def on_status(status):
+            session.server_status[server_id] = status
+
+        # 预热池中有相同配置的实例时直接接管，否则冷启动
+        warm_client = warm_pool.take(server_config, name=mcp_client.name, on_status=on_status)
+        if warm_client is not None:
+            mcp_client = warm_client
+        else:
+            # 添加超时控制
+            connect_task = mcp_client.connect_with_config(server_config, on_status=on_status)
+            
+            # 设置30秒超时
+            await asyncio.wait_for(connect_task, timeout=30.0)
+        
+        tool_conf = await mcp_client.get_tool_config(server_id=server_id)
+        logger.info(f"User {session.user_id} connected to MCP server {server_id}, tools={tool_conf}")
+        
         await save_user_server_config(user_id, server_id, server_config)
         
         # 成功连接后才将客户端添加到用户会话
         session.mcp_clients[server_id] = mcp_client
+        session.server_status[server_id] = "ready"
         
     except asyncio.TimeoutError:
         logger.error(f"连接MCP服务器 {server_id} 超时")
@@ -780,6 +1012,8 @@ async def remove_mcp_server(
         await session.mcp_clients[server_id].disconnect_to_server()
         # 移除服务器
         del session.mcp_clients[server_id]
+        session.server_status.pop(server_id, None)
+        session.chat_client.tool_names.forget_server(server_id)
 
         # 从用户配置中删除
         await delete_user_server_config(user_id, server_id)
@@ -802,18 +1036,16 @@ async def remove_mcp_server(
 async def stream_chat_response(data: ChatCompletionRequest, session: UserSession, stream_id: str = None) -> AsyncGenerator[str, None]:
     """为特定用户生成流式聊天响应"""
     # 注册流式请求，便于后续可能的停止操作
-    global active_streams
-    
-    # 注册流
     if stream_id:
         try:
-            # 先在ChatClientStream中注册流，然后再添加到active_streams
-            # session.chat_client.register_stream(stream_id)
-            active_streams[stream_id] = session.user_id
-            # logger.info(f"Stream {stream_id} registered for user {session.user_id}")
-            logger.info(f"active_streams:{active_streams}")
+            # 流的归属写入会话存储，stop请求可能落在其他worker上
+            local_streams[stream_id] = session
+            await session_store.claim_stream(stream_id, session.user_id)
+            logger.info(f"Stream {stream_id} registered for user {session.user_id}")
         except Exception as e:
             logger.error(f"Error registering stream {stream_id}: {e}")
+    if data.keep_session:
+        await session.load_history()
     # Process messages with possible structured content
     messages = []
     for file_idx, msg in enumerate(data.messages):
@@ -841,7 +1073,8 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                             if len(parts) == 2:
                                 img_format = parts[0].split("/")[1]
                                 base64_data = parts[1]
-                                img_bytes = base64.b64decode(base64_data)
+                                # 相同的图片在所有会话中只保存一份
+                                img_bytes = blob_store.intern(base64.b64decode(base64_data))
                                 
                                 message_content.append({
                                     "image": {
@@ -863,7 +1096,7 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                     # Handle base64 encoded file data
                     if file_obj.file_data:
                         try:
-                            file_data = base64.b64decode(file_obj.file_data)
+                            file_data = blob_store.intern(base64.b64decode(file_obj.file_data))
                             filename = file_obj.filename or "unnamed_file"
                             # Determine file format from filename or mime type
                             file_ext = os.path.splitext(filename)[1].lower().replace(".", "")
@@ -919,14 +1152,24 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
     # bedrock's first turn cannot be assistant
     if messages and messages[0]['role'] == 'assistant':
         messages = messages[1:]
+    request_usage = UsageAccumulator()
+    # 帧模板按流预先生成，可按请求合并连续的文本delta
+    encoder = SSEEncoder.from_params(data.model, data.extra_params)
+
+    def usage_chunk():
+        # 最后一个chunk携带本次请求所有轮次累计的用量
+        return encoder.chunk(extras={"usage": request_usage.openai_usage()})
+
+    events = None
     try:
         current_content = ""
         thinking_start = False
         thinking_text_index = 0
         tooluse_start = False
+        end_turn = False
         
         # 使用用户特定的chat_client和mcp_clients
-        async for response in session.chat_client.process_query_stream(
+        events = session.chat_client.process_query_stream(
                 model_id=data.model,
                 max_tokens=data.max_tokens,
                 temperature=data.temperature,
@@ -938,23 +1181,22 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                 extra_params=data.extra_params,
                 keep_session=data.keep_session,
                 stream_id=stream_id,
-                ):
-            
-            event_data = {
-                "id": f"chat{time.time_ns()}",
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": data.model,
-                "choices": [{
-                    "index": 0,
-                    "delta": {},
-                    "finish_reason": None
-                }]
-            }
+                )
+        # 按时间合并文本时，等待下一个事件以合并文本的刷新时间为上限，超时即发送已合并的文本；
+        # 不按时间合并（默认）时直接迭代，不为每个事件额外创建任务
+        if encoder.coalesce_delay:
+            events = iterate_with_deadline(events, encoder.flush_delay)
+        async for response in events:
+            if response is None:
+                pending = encoder.flush()
+                if pending:
+                    yield pending
+                continue
+            frame = b''
             
             # 处理不同的事件类型
             if response["type"] == "message_start":
-                event_data["choices"][0]["delta"] = {"role": "assistant"}
+                frame = encoder.chunk({"role": "assistant"})
             
             elif response["type"] == "block_delta":
                 if "text" in response["data"]["delta"]:
@@ -964,7 +1206,7 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                         text = "</thinking>"
                     text += response["data"]["delta"]["text"]
                     current_content += text
-                    event_data["choices"][0]["delta"] = {"content": text}
+                    frame += encoder.content(text)
                     thinking_text_index = 0
                     
                 if "toolUse" in response["data"]["delta"]:
@@ -974,7 +1216,7 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                         text = "<tool_input>"
                     text += response["data"]["delta"]["toolUse"]['input']
                     current_content += text
-                    event_data["choices"][0]["delta"] = {"content": text}
+                    frame += encoder.content(text)
                     
                 if "reasoningContent" in response["data"]["delta"]:
                     if 'text' in response["data"]["delta"]["reasoningContent"]:
@@ -983,7 +1225,7 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                             thinking_start = True
                         else:
                             text = response["data"]["delta"]["reasoningContent"]["text"]
-                        event_data["choices"][0]["delta"] = {"content": text}
+                        frame += encoder.content(text)
                         thinking_text_index += 1
 
             elif response["type"] == "block_stop":
@@ -991,72 +1233,77 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                     text =  "</tool_input>"
                     current_content += text
                     tooluse_start = False
-                    event_data["choices"][0]["delta"] = {"content": text}
+                    frame = encoder.content(text)
                     
             elif response["type"] == "message_stop":
-                event_data["choices"][0]["finish_reason"] = response["data"]["stopReason"]
+                message_extras = None
                 if response["data"].get("tool_results"):
-                    event_data["choices"][0]["message_extras"] = {
+                    message_extras = {"message_extras": {
                         "tool_use": json.dumps(response["data"]["tool_results"],ensure_ascii=False)
-                    }
+                    }}
+                frame = encoder.chunk(finish_reason=response["data"]["stopReason"], choice_extras=message_extras)
+
+            elif response["type"] == "tool_progress":
+                # 工具执行中的进度/日志通知，和tool_use一样放在message_extras中
+                frame = encoder.chunk(choice_extras={"message_extras": {
+                    "tool_progress": json.dumps(response["data"], ensure_ascii=False, default=str)
+                }})
+
+            elif response["type"] == "metadata":
+                usage = response["data"].get("usage")
+                if usage:
+                    request_usage.add(usage)
+                    frame = encoder.chunk(extras={"usage": UsageAccumulator.to_openai(usage)})
 
             elif response["type"] == "error":
-                event_data["choices"][0]["finish_reason"] = "error"
-                event_data["choices"][0]["delta"] = {
-                    "content": f"Error: {response['data']['error']}"
-                }
+                frame = encoder.chunk({"content": f"Error: {response['data']['error']}"}, finish_reason="error")
 
-            # 发送事件
-            yield f"data: {json.dumps(event_data)}\n\n"
+            # 发送事件，没有内容的事件不再发送空帧
+            if frame:
+                yield frame
 
             # 手动停止流式响应
             if response["type"] == "stopped":
-                event_data = {
-                    "id": f"stop{time.time_ns()}",
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": data.model,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {},
-                        "finish_reason": "stop_requested"
-                    }]
-                }
-                yield f"data: {json.dumps(event_data)}\n\n"
-                yield "data: [DONE]\n\n"
+                yield encoder.chunk(finish_reason="stop_requested")
+                yield usage_chunk()
+                yield SSE_DONE
                 break
 
-            # 发送结束标记
+            # 结束标记在最后一轮的metadata之后发送
             if response["type"] == "message_stop" and response["data"]["stopReason"] == 'end_turn':
-                yield "data: [DONE]\n\n"
+                end_turn = True
+
+        if end_turn:
+            yield usage_chunk()
+            yield SSE_DONE
+        else:
+            pending = encoder.flush()
+            if pending:
+                yield pending
 
     except Exception as e:
         logger.error(f"Stream error for user {session.user_id}: {e}")
-        error_data = {
-            "id": f"error{time.time_ns()}",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": data.model,
-            "choices": [{
-                "index": 0,
-                "delta": {"content": f"Error: {str(e)}"},
-                "finish_reason": "error"
-            }]
-        }
-        yield f"data: {json.dumps(error_data)}\n\n"
-        yield "data: [DONE]\n\n"
+        yield encoder.chunk({"content": f"Error: {str(e)}"}, finish_reason="error")
+        yield usage_chunk()
+        yield SSE_DONE
         
     finally:
+        # 客户端断开或出错时也关闭事件生成器，释放其中的Bedrock流
+        if events is not None:
+            await events.aclose()
+        usage_counter.record(session.user_id, request_usage)
         # 清除活跃流列表中的请求
         try:
             if stream_id:
-                # 清理同步：先从ChatClientStream中删除，再从active_streams中删除
+                # 清理同步：先从ChatClientStream中删除，再从会话存储中删除
                 session.chat_client.unregister_stream(stream_id)
-                if stream_id in active_streams:
-                    del active_streams[stream_id]
-                    logger.info(f"Stream {stream_id} unregistered")
+                local_streams.pop(stream_id, None)
+                await session_store.release_stream(stream_id)
+                logger.info(f"Stream {stream_id} unregistered")
         except Exception as e:
             logger.error(f"Error cleaning up stream {stream_id}: {e}")
+        await session.save_history()
+        session.update_size()
 
 @app.post("/v1/chat/completions")
 async def chat_completions(
@@ -1065,12 +1312,26 @@ async def chat_completions(
     background_tasks: BackgroundTasks,
     auth: HTTPAuthorizationCredentials = Security(security)
 ):
-    # 获取用户会话
-    session = await get_or_create_user_session(request, auth)
+    # 获取用户会话，会话在请求结束前计为活跃，不会被清理
+    session = await get_or_create_user_session(request, auth, hold=True)
+    streaming = False
+    try:
+        response = await handle_chat_completions(data, session)
+        # 流式响应的计数由SSEStreamingResponse在响应结束时释放，客户端提前断开也会释放
+        streaming = isinstance(response, StreamingResponse)
+        return response
+    finally:
+        if not streaming:
+            session.release()
+
+
+async def handle_chat_completions(data: ChatCompletionRequest, session: UserSession):
     # 记录会话活动
     session.last_active = datetime.now()
 
     logger.info(f'keep_session:{data.keep_session}')
+    # 只等待本次请求选中的、仍在连接的服务器
+    await wait_for_user_servers(session, data.mcp_server_ids)
 
     if not data.messages:
         return JSONResponse(content=ChatResponse(
@@ -1089,8 +1350,9 @@ async def chat_completions(
     if data.stream:
         # 为流式请求生成唯一ID
         stream_id = f"stream_{session.user_id}_{time.time_ns()}"
-        return StreamingResponse(
+        return SSEStreamingResponse(
             stream_chat_response(data, session, stream_id),
+            on_close=session.release,
             media_type="text/event-stream",
             headers={"X-Stream-ID": stream_id}  # 添加流ID到响应头，便于前端跟踪
         )
@@ -1122,7 +1384,8 @@ async def chat_completions(
                             if len(parts) == 2:
                                 img_format = parts[0].split("/")[1]
                                 base64_data = parts[1]
-                                img_bytes = base64.b64decode(base64_data)
+                                # 相同的图片在所有会话中只保存一份
+                                img_bytes = blob_store.intern(base64.b64decode(base64_data))
                                 
                                 message_content.append({
                                     "image": {
@@ -1144,7 +1407,7 @@ async def chat_completions(
                     # Handle base64 encoded file data
                     if file_obj.file_data:
                         try:
-                            file_data = base64.b64decode(file_obj.file_data)
+                            file_data = blob_store.intern(base64.b64decode(file_obj.file_data))
                             filename = file_obj.filename or "unnamed_file"
                             filename = hash_filename(filename)
                             # Determine file format from filename or mime type
@@ -1202,6 +1465,9 @@ async def chat_completions(
         system = messages[0]['content'] if messages[0]['content'] else []
         messages = messages[1:]
 
+    if data.keep_session:
+        await session.load_history()
+    request_usage = UsageAccumulator()
     try:
         tool_use_info = {}
         # async with session.lock:  # 确保当前用户的请求按顺序处理
@@ -1216,6 +1482,7 @@ async def chat_completions(
                 mcp_server_ids=data.mcp_server_ids,
                 extra_params=data.extra_params,
                 keep_session=data.keep_session,
+                usage=request_usage,
                 ):
             logger.info(f"response body for user {session.user_id}: {response}")
             is_tool_use = any([bool(x.get('toolUse')) for x in response['content']])
@@ -1274,17 +1541,17 @@ async def chat_completions(
                         "finish_reason": "stop", 
                     }
                 ],
-                usage={
-                    "prompt_tokens": 0, 
-                    "completion_tokens": 0,
-                    "total_tokens": 0,
-                }
+                usage=request_usage.openai_usage()
             )
+            usage_counter.record(session.user_id, request_usage)
+            await session.save_history()
             
             return JSONResponse(content=chat_response.model_dump())
     except Exception as e:
         logger.error(f"Error processing request for user {session.user_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        session.update_size()
 
 
 def generate_self_signed_cert(cert_dir='certificates'):
@@ -1334,27 +1601,17 @@ if __name__ == '__main__':
     parser.add_argument('--cert-dir', default='certificates', help="证书目录")
     parser.add_argument('--ssl-keyfile', default='', help="SSL密钥文件路径")
     parser.add_argument('--ssl-certfile', default='', help="SSL证书文件路径")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker进程数，大于1时需要通过SESSION_STORE配置共享的会话存储")
     args = parser.parse_args()
     
-    # 设置用户配置文件路径环境变量
+    # 设置用户配置文件路径环境变量，worker进程通过环境变量读取配置
     os.environ['USER_MCP_CONFIG_FILE'] = args.user_conf
+    os.environ['MCP_CONF_FILE'] = args.mcp_conf
+    MCP_CONF_FILE = args.mcp_conf
     
     try:
         loop = asyncio.new_event_loop()
-
-        if args.mcp_conf:
-            with open(args.mcp_conf, 'r') as f:
-                conf = json.load(f)
-                # 加载全局MCP服务器配置
-                for server_id, server_conf in conf.get('mcpServers', {}).items():
-                    if server_conf.get('status') == 0:
-                        continue
-                    shared_mcp_server_list[server_id] = server_conf.get('description', server_id)
-                    save_global_server_config(server_id, server_conf)
-
-                # 加载模型配置
-                for model_conf in conf.get('models', []):
-                    llm_model_list[model_conf['model_id']] = model_conf['model_name']
         
         # 配置HTTPS
         ssl_keyfile = None
@@ -1386,9 +1643,18 @@ if __name__ == '__main__':
         else:
             logger.info(f"使用HTTP，服务器将在 http://{args.host}:{args.port} 上运行")
         
-        config = uvicorn.Config(**config_kwargs)
-        server = uvicorn.Server(config)
-        loop.run_until_complete(server.serve())
+        if args.workers > 1:
+            # 多进程模式：每个worker重新导入main并在lifespan中加载配置
+            if not session_store.shared:
+                logger.warning("SESSION_STORE为memory时各worker的会话历史和流式请求互不可见，keep_session和停止请求可能失效")
+            config_kwargs.pop("loop")
+            config_kwargs["app"] = "main:app"
+            config_kwargs["workers"] = args.workers
+            uvicorn.run(**config_kwargs)
+        else:
+            config = uvicorn.Config(**config_kwargs)
+            server = uvicorn.Server(config)
+            loop.run_until_complete(server.serve())
     finally:
         # 确保退出时清理资源并保存用户配置
         cleanup_tasks = []
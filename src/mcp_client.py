@@ -6,18 +6,24 @@ SPDX-License-Identifier: MIT-0
 MCP Client maintains Multi-MCP-Servers
 """
 import os
+import time
 import logging
 import asyncio
-from typing import Optional, Dict
+import anyio
+from collections import OrderedDict
+from typing import Callable, Optional, Dict
 from contextlib import AsyncExitStack
 from pydantic import ValidationError
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client, get_default_environment
-from mcp.types import Resource, Tool, TextContent, ImageContent, EmbeddedResource,CallToolResult,NotificationParams
+from mcp.types import Resource, Tool, TextContent, ImageContent, EmbeddedResource,CallToolResult,NotificationParams,ServerNotification,ToolListChangedNotification,LoggingMessageNotificationParams
 from mcp.shared.exceptions import McpError
 from dotenv import load_dotenv
 from mcp.client.sse import sse_client
 from mcp.client.streamable_http import streamablehttp_client
+from utils import is_endpoint_sse
+from mcp_http_pool import http_pool
+from tool_result_cache import tool_result_cache, tool_call_key, MCP_TOOL_RESULT_CACHE, MCP_TOOL_RESULT_CACHE_TTL
 
 
 load_dotenv()  # load environment variables from .env
@@ -27,9 +33,79 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
 )
 logger = logging.getLogger(__name__)
+# 工具列表缓存的有效期（秒），服务器发送tools/list_changed通知或重连时会提前失效
+MCP_TOOL_CACHE_TTL = float(os.environ.get("MCP_TOOL_CACHE_TTL", 300))
+# 每轮对话拉取单个服务器工具列表的超时时间（秒），超时的服务器本轮被跳过
+MCP_TOOL_CONFIG_TIMEOUT = float(os.environ.get("MCP_TOOL_CONFIG_TIMEOUT", 10))
+# 单个服务器同时进行的工具调用上限，以及工具调用的默认截止时间（秒），均可在服务器配置中覆盖
+MCP_SERVER_MAX_CONCURRENCY = int(os.environ.get("MCP_SERVER_MAX_CONCURRENCY", 8))
+MCP_TOOL_CALL_TIMEOUT = float(os.environ.get("MCP_TOOL_CALL_TIMEOUT", 120))
+# 连接监护：心跳间隔/超时（秒，间隔<=0时不发送心跳），连续失败多少次判定连接已断开
+MCP_PING_INTERVAL = float(os.environ.get("MCP_PING_INTERVAL", 30))
+MCP_PING_TIMEOUT = float(os.environ.get("MCP_PING_TIMEOUT", 10))
+MCP_PING_FAILURES = int(os.environ.get("MCP_PING_FAILURES", 2))
+# 连接（含重连）单次尝试的截止时间（秒），未单独指定时使用
+MCP_CONNECT_TIMEOUT = float(os.environ.get("MCP_CONNECT_TIMEOUT", 30))
+# 断线重连的指数退避（秒）和最大尝试次数，工具调用等待重连的最长时间（秒）
+MCP_RECONNECT_BASE_DELAY = float(os.environ.get("MCP_RECONNECT_BASE_DELAY", 1))
+MCP_RECONNECT_MAX_DELAY = float(os.environ.get("MCP_RECONNECT_MAX_DELAY", 30))
+MCP_RECONNECT_MAX_ATTEMPTS = int(os.environ.get("MCP_RECONNECT_MAX_ATTEMPTS", 10))
+MCP_RECONNECT_WAIT = float(os.environ.get("MCP_RECONNECT_WAIT", 15))
+# 这些异常说明传输层已经关闭（如stdio子进程退出）
+TRANSPORT_ERRORS = (anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream)
+# 每个会话的工具名注册表最多保留的映射数量
+MCP_TOOL_NAME_REGISTRY_SIZE = int(os.environ.get("MCP_TOOL_NAME_REGISTRY_SIZE", 2048))
 delimiter = "___"
-tool_name_mapping = {}
-tool_name_mapping_r = {}
+
+
+class ToolNameRegistry:
+    """Per-session two-way map between LLM tool names and (server_id, MCP tool name).
+
+    Names are namespaced by server id and normalized for the LLM; when two tools
+    normalize to the same name, later ones get a numeric suffix. The map is bounded,
+    evicting the least recently registered tools, and `version` changes whenever a
+    name may have gone away so that memoized tool lists can be rebuilt.
+    """
+
+    def __init__(self, max_size: int = MCP_TOOL_NAME_REGISTRY_SIZE):
+        self.max_size = max_size
+        self.version = 0
+        self._names: "OrderedDict[tuple, str]" = OrderedDict()  # (server_id, tool_name) -> llm name
+        self._keys: Dict[str, tuple] = {}  # llm name -> (server_id, tool_name)
+
+    def register(self, server_id: str, tool_name: str, ns_delimiter: str = delimiter) -> str:
+        """LLM-facing name of an MCP tool, stable for the lifetime of the registry"""
+        key = (server_id, tool_name)
+        name = self._names.get(key)
+        if name is not None:
+            self._names.move_to_end(key)
+            return name
+        base = MCPClient.normalize_tool_name(server_id + ns_delimiter + tool_name)
+        name, suffix = base, 1
+        while name in self._keys:
+            suffix += 1
+            name = f"{base}_{suffix}"
+        self._names[key] = name
+        self._keys[name] = key
+        while len(self._names) > self.max_size:
+            _, evicted = self._names.popitem(last=False)
+            del self._keys[evicted]
+            self.version += 1
+        return name
+
+    def resolve(self, tool_name4llm: str) -> tuple:
+        """(server_id, MCP tool name) of an LLM tool name; ("", "") if unknown"""
+        return self._keys.get(tool_name4llm, ("", ""))
+
+    def forget_server(self, server_id: str):
+        for key in [key for key in self._names if key[0] == server_id]:
+            del self._keys[self._names.pop(key)]
+        self.version += 1
+
+    def __len__(self):
+        return len(self._names)
+
+
 class MCPClient:
     """Manage MCP sessions.
 
@@ -49,36 +125,65 @@ class MCPClient:
         # self.sessions: Dict[str, Optional[ClientSession]] = {}
         self.session = None
         self.exit_stack = AsyncExitStack()
+        # server_id -> (expire time, bedrock tool config)
+        self._tool_config_cache = {}
+        self.tools = []
+        # 每次工具列表失效时递增，供上层判断合并后的工具列表是否仍然有效
+        self.tool_config_version = 0
+        # 按配置连接时，连接由后台监护任务持有：心跳检测断线并按退避重连
+        self.config = None
+        self.connect_timeout = None
+        self._on_status = None
+        self._connect_task = None
+        self._first_connect = None
+        self._connected = asyncio.Event()
+        self._lost = asyncio.Event()
+        self.reconnects = 0
+        # 工具结果缓存：配置中显式指定的工具，或带readOnlyHint且不带destructiveHint注解的工具
+        self.cache_tools = set()
+        self.cache_ttl = MCP_TOOL_RESULT_CACHE_TTL
+        self.cache_scope = name
+        # 工具调用的并发上限和截止时间
+        self.max_concurrency = MCP_SERVER_MAX_CONCURRENCY
+        self.call_timeout = MCP_TOOL_CALL_TIMEOUT
+        self.tool_timeouts = {}
+        self._call_semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.call_counters = {"calls": 0, "in_flight": 0, "waiting": 0, "timeouts": 0, "cancelled": 0, "errors": 0}
+        # 进行中调用的进度回调；服务器的日志通知只在不被多个会话共享的连接上转发给唯一的进行中调用
+        self.relay_logs = True
+        self._progress_listeners = set()
 
     @staticmethod
     def normalize_tool_name( tool_name):
         return tool_name.replace('-', '_').replace('/', '_').replace(':', '_')
     
-    @staticmethod
-    def get_tool_name4llm( server_id, tool_name, norm=True, ns_delimiter=delimiter):
-        """Convert MCP server tool name to llm tool call"""
-        global tool_name_mapping, tool_name_mapping_r
-        # prepend server prefix namespace to support multi-mcp-server
-        tool_key = server_id + ns_delimiter + tool_name
-        tool_name4llm = tool_key if not norm else MCPClient.normalize_tool_name(tool_key)
-        tool_name_mapping[tool_key] = tool_name4llm
-        tool_name_mapping_r[tool_name4llm] = tool_key
-        return tool_name4llm
-    
-    @staticmethod
-    def get_tool_name4mcp( tool_name4llm, ns_delimiter=delimiter):
-        """Convert llm tool call name to MCP server original name"""
-        global  tool_name_mapping_r
-        server_id, tool_name = "", ""
-        tool_name4mcp = tool_name_mapping_r.get(tool_name4llm, "")
-        if len(tool_name4mcp.split(ns_delimiter)) == 2:
-            server_id, tool_name = tool_name4mcp.split(ns_delimiter)
-        return server_id, tool_name
-
     async def disconnect_to_server(self):
         logger.info(f"\nDisconnecting to server [{self.name}]")
         await self.cleanup()
 
+    def invalidate_tool_cache(self):
+        """Drop the cached tool catalog so that the next get_tool_config lists tools again"""
+        self._tool_config_cache = {}
+        self.tool_config_version += 1
+
+    async def _handle_message(self, message):
+        """Handle server notifications; tools/list_changed invalidates the tool catalog"""
+        if isinstance(message, ServerNotification) and isinstance(message.root, ToolListChangedNotification):
+            logger.info(f"{self.name} tools list changed")
+            self.invalidate_tool_cache()
+
+    async def _handle_log(self, params: LoggingMessageNotificationParams):
+        """Forward a server log message to the tool call in flight on this connection.
+
+        Log notifications are not tied to a request, so they are only relayed while
+        exactly one call with a listener is running.
+        """
+        logger.info(f"{self.name} server log [{params.level}]: {params.data}")
+        if not self.relay_logs or len(self._progress_listeners) != 1:
+            return
+        on_progress = next(iter(self._progress_listeners))
+        on_progress({"kind": "log", "level": params.level, "logger": params.logger, "data": params.data})
+
     async def handle_resource_change(params: NotificationParams):
         print(f"资源变更类型: {params['changeType']}")
         print(f"受影响URI: {params['resourceURIs']}")
@@ -129,10 +234,12 @@ class MCPClient:
             if server_url:
                 headers = { "Authorization": f"Bearer {token}"} if token else None
                 logger.info(f"http_type: %s" % http_type)
+                # 同一origin的远程服务器共享进程级连接池
                 if http_type == 'streamable_http':
-                    transport_client = streamablehttp_client(server_url,headers=headers)
+                    transport_client = streamablehttp_client(server_url,headers=headers,
+                                                             **http_pool.transport_kwargs(streamablehttp_client))
                 else:
-                    transport_client = sse_client(server_url,headers=headers)
+                    transport_client = sse_client(server_url,headers=headers, **http_pool.transport_kwargs(sse_client))
             else:
                 transport_client = stdio_client(StdioServerParameters(
                     command=command, args=server_script_args, env=env
@@ -143,14 +250,221 @@ class MCPClient:
         logger.info(f"\nAdding server %s %s" % (command, server_script_args))
         try:
             _stdio, _write, *_= await self.exit_stack.enter_async_context(transport_client)
-            self.session = await self.exit_stack.enter_async_context(ClientSession(_stdio, _write))
+            self.session = await self.exit_stack.enter_async_context(
+                ClientSession(_stdio, _write, message_handler=self._handle_message, logging_callback=self._handle_log))
+            self.invalidate_tool_cache()
             await self.session.initialize()
             logger.info(f"\n{self.name} session initialize done")
         except Exception as e:
             logger.error(f"\n{self.name} session initialize failed: {e}")
             raise ValueError(f"Invalid server script or command. {e}")   
         await self.list_mcp_server()
+
+    async def connect_with_config(self, config: Dict, on_status=None, timeout: Optional[float] = None):
+        """Connect using a server config entry (command/args/env or url/token).
+
+        The connection is opened and owned by a supervisor task, which keeps it alive
+        and reconnects with the same config when the transport dies. Each connect
+        attempt is bounded by `timeout` (default MCP_CONNECT_TIMEOUT).
+        """
+        self.defer_connect(config, timeout=timeout or self.connect_timeout or MCP_CONNECT_TIMEOUT,
+                           on_status=on_status or self._on_status)
+        await self.ensure_connected()
+
+    async def _open(self):
+        config = self.config
+        self.cache_tools = set(config.get("cache_tools", []))
+        self.cache_ttl = float(config.get("cache_ttl", MCP_TOOL_RESULT_CACHE_TTL))
+        self.set_call_limits(max_concurrency=config.get("max_concurrency"),
+                             call_timeout=config.get("call_timeout"),
+                             tool_timeouts=config.get("tool_timeouts"))
+        server_url = config.get('url', "")
+        await self.connect_to_server(
+            command=config.get('command'),
+            server_url=server_url,
+            http_type="sse" if is_endpoint_sse(server_url) else "streamable_http",
+            token=config.get('token', None),
+            server_script_args=config.get("args", []),
+            server_script_envs=config.get("env", {})
+        )
         
+    def defer_connect(self, config: Dict, timeout: Optional[float] = None, on_status=None):
+        """Connect on the first get_tool_config/call_tool instead of now.
+
+        `on_status` is called with "connecting", "ready", "reconnecting" or "failed".
+        """
+        self.config = config
+        self.connect_timeout = timeout
+        self._on_status = on_status
+
+    def adopt(self, name: str, on_status=None):
+        """Hand a connected client (e.g. from the warm pool) over under a new name"""
+        self.name = name
+        self.cache_scope = name
+        self._on_status = on_status
+
+    def _report(self, status: str):
+        if self._on_status:
+            self._on_status(status)
+
+    def start_connect(self) -> asyncio.Future:
+        """Start the supervisor unless it is running; the future resolves on its first connect"""
+        if self._connect_task is None or self._connect_task.done():
+            self._first_connect = asyncio.get_running_loop().create_future()
+            # 没有调用方等待时也不产生"exception was never retrieved"告警
+            self._first_connect.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self._connect_task = asyncio.create_task(self._supervise())
+        return self._first_connect
+
+    async def ensure_connected(self):
+        if self._connected.is_set() or not self.config:
+            return
+        if self._connect_task is not None and not self._connect_task.done() and self._first_connect.done():
+            # 断线后正在重连：在有限时间内等待重连完成，而不是立即失败
+            try:
+                await asyncio.wait_for(self._connected.wait(), timeout=MCP_RECONNECT_WAIT)
+            except asyncio.TimeoutError:
+                raise ConnectionError(f"MCP server {self.name} is reconnecting") from None
+            return
+        # shield: 调用方超时不会中断仍在进行的连接，后续请求可以直接复用
+        await asyncio.shield(self.start_connect())
+
+    async def _supervise(self):
+        """Own the connection: open it, watch it and reopen it with backoff when it dies.
+
+        A failed first connect is reported to the waiters and ends the supervisor;
+        after MCP_RECONNECT_MAX_ATTEMPTS failed reconnects it gives up as well, and the
+        next ensure_connected starts over.
+        """
+        attempt = 0
+        while True:
+            self._report("reconnecting" if self._first_connect.done() else "connecting")
+            opened = asyncio.get_running_loop().create_future()
+            holder = asyncio.create_task(self._hold(opened))
+            try:
+                await asyncio.wait({holder, opened}, timeout=self.connect_timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not opened.done():
+                    raise holder.exception() if holder.done() and not holder.cancelled() and holder.exception() \
+                        else asyncio.TimeoutError(f"connect timed out after {self.connect_timeout}s")
+            except asyncio.CancelledError:
+                await self._release(holder)
+                self._first_connect.cancel()
+                raise
+            except Exception as e:
+                await self._release(holder)
+                if not self._first_connect.done():
+                    logger.error(f"{self.name} connect failed: {e!r}")
+                    self._first_connect.set_exception(e)
+                    self._report("failed")
+                    return
+                attempt += 1
+                if attempt > MCP_RECONNECT_MAX_ATTEMPTS:
+                    logger.error(f"{self.name} reconnect given up after {MCP_RECONNECT_MAX_ATTEMPTS} attempts: {e!r}")
+                    self._report("failed")
+                    return
+                delay = min(MCP_RECONNECT_BASE_DELAY * 2 ** (attempt - 1), MCP_RECONNECT_MAX_DELAY)
+                logger.warning(f"{self.name} reconnect attempt {attempt} failed: {e!r}, retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+
+            attempt = 0
+            self._lost.clear()
+            self._connected.set()
+            if self._first_connect.done():
+                self.reconnects += 1
+                logger.info(f"{self.name} reconnected")
+            else:
+                self._first_connect.set_result(None)
+            self._report("ready")
+            try:
+                await self._watch(holder)
+            finally:
+                self._connected.clear()
+                # 让仍在等待旧连接响应的请求立即失败并重试
+                self._lost.set()
+                await self._release(holder)
+            logger.warning(f"{self.name} connection lost, reconnecting")
+
+    async def _hold(self, opened: asyncio.Future):
+        """Open the transport and keep it open until this task is cancelled.
+
+        The transport's anyio task group cancels the task that entered it when the
+        server goes away, so it gets a task of its own rather than the supervisor's.
+        """
+        try:
+            await self._open()
+            opened.set_result(None)
+            await asyncio.Event().wait()
+        finally:
+            await self._close_transport()
+
+    @staticmethod
+    async def _release(holder: asyncio.Task):
+        holder.cancel()
+        await asyncio.wait({holder})
+        if not holder.cancelled() and holder.exception() is not None:
+            logger.debug(f"transport task ended with {holder.exception()!r}")
+
+    async def _watch(self, holder: asyncio.Task):
+        """Return once the transport is dead: its task ended, a call reported it or pings keep failing"""
+        failures = 0
+        lost = asyncio.ensure_future(self._lost.wait())
+        try:
+            while True:
+                await asyncio.wait({holder, lost}, timeout=MCP_PING_INTERVAL if MCP_PING_INTERVAL > 0 else None,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if holder.done() or lost.done():
+                    return
+                try:
+                    await asyncio.wait_for(self.session.send_ping(), timeout=MCP_PING_TIMEOUT)
+                    failures = 0
+                except TRANSPORT_ERRORS as e:
+                    logger.warning(f"{self.name} transport closed: {e!r}")
+                    return
+                except Exception as e:
+                    failures += 1
+                    logger.warning(f"{self.name} ping failed ({failures}/{MCP_PING_FAILURES}): {e!r}")
+                    if failures >= MCP_PING_FAILURES:
+                        return
+        finally:
+            lost.cancel()
+
+    async def _close_transport(self):
+        """Close the session and transport; only called from the task that opened them"""
+        self.session = None
+        try:
+            await self.exit_stack.aclose()
+        except Exception as e:
+            # 子进程已经退出时关闭stdio传输会报错，忽略即可
+            logger.debug(f"{self.name} close transport error: {e!r}")
+        self.exit_stack = AsyncExitStack()
+
+    async def _until_lost(self, coro):
+        """Await a request on the current session, failing it with ClosedResourceError
+        as soon as the transport is found dead (pending requests are not failed by the
+        MCP session itself when a stdio child exits)"""
+        if self._connect_task is None or self._connect_task.done():
+            return await coro
+        call = asyncio.ensure_future(coro)
+        lost = asyncio.ensure_future(self._lost.wait())
+        try:
+            await asyncio.wait({call, lost}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        finally:
+            lost.cancel()
+        if call.done():
+            return call.result()
+        call.cancel()
+        raise anyio.ClosedResourceError()
+
+    def connection_lost(self):
+        """Hand a dead transport found by a caller over to the supervisor"""
+        if self._connect_task is not None and not self._connect_task.done():
+            self._connected.clear()
+            self._lost.set()
+
     async def list_mcp_server(self):
         try:
             resource = await self.session.list_resources()
@@ -160,39 +474,168 @@ class MCPClient:
         # List available tools
         response = await self.session.list_tools()
         tools = response.tools
+        self.tools = tools
         logger.info(f"\nConnected to server [{self.name}] with tools: " + str([tool for tool in tools]))
         
         
     async def get_tool_config(self, model_provider='bedrock', server_id : str = ''):
         """Get llm's tool usage config via MCP server"""
+        cached = self._tool_config_cache.get(server_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
         # list tools via mcp server
         try:
-            response = await self.session.list_tools()
+            await self.ensure_connected()
+            try:
+                response = await self._until_lost(self.session.list_tools())
+            except TRANSPORT_ERRORS:
+                # 连接已断开：交给监护任务重连后再取一次
+                self.connection_lost()
+                await self.ensure_connected()
+                response = await self.session.list_tools()
             if not response:
                 logger.error('list_tools returns empty')
                 raise ValueError('list_tools returns empty')
         except Exception as e:
             logger.error(f'{e}')
             return None
+        self.tools = response.tools
 
         # for bedrock tool config
         tool_config = {"tools": []}
         tool_config["tools"].extend([{
             "toolSpec":{
-                # mcp tool's original name to llm tool name (with server id namespace)
-                "name": MCPClient.get_tool_name4llm(server_id, tool.name, norm=True),
+                # mcp tool's original name; gather_tool_config maps it to the session's llm tool name
+                "name": tool.name,
                 "description": tool.description, 
                 "inputSchema": {"json": tool.inputSchema}
             }
         } for tool in response.tools])
 
+        if self._tool_config_cache.get(server_id) is not None:
+            # TTL到期后重新拉取，版本号递增
+            self.tool_config_version += 1
+        self._tool_config_cache[server_id] = (time.monotonic() + MCP_TOOL_CACHE_TTL, tool_config)
         return tool_config
 
-    async def call_tool(self, tool_name, tool_args):
-        """Call tool via MCP server"""
+    def set_call_limits(self, max_concurrency: Optional[int] = None, call_timeout: Optional[float] = None,
+                        tool_timeouts: Optional[Dict[str, float]] = None):
+        """Override the per-server concurrency limit and the default/per-tool call deadlines"""
+        if max_concurrency and max_concurrency != self.max_concurrency:
+            self.max_concurrency = int(max_concurrency)
+            self._call_semaphore = asyncio.Semaphore(self.max_concurrency)
+        if call_timeout:
+            self.call_timeout = float(call_timeout)
+        if tool_timeouts:
+            self.tool_timeouts = {name: float(timeout) for name, timeout in tool_timeouts.items()}
+
+    def call_stats(self) -> Dict[str, int]:
+        return {**self.call_counters, "max_concurrency": self.max_concurrency, "reconnects": self.reconnects}
+
+    @property
+    def connected(self) -> bool:
+        return self.session is not None and (not self.config or self._connected.is_set())
+
+    def is_cacheable(self, tool_name) -> bool:
+        """Whether results of the tool may be served from the result cache"""
+        if tool_name in self.cache_tools:
+            return True
+        if not MCP_TOOL_RESULT_CACHE:
+            return False
+        for tool in self.tools:
+            if tool.name == tool_name:
+                annotations = getattr(tool, 'annotations', None)
+                # idempotentHint只对写操作有意义：重复写入同一值无副作用，但其结果不能代替实际写入
+                return bool(annotations and annotations.readOnlyHint is True and not annotations.destructiveHint)
+        return False
+
+    def is_read_only(self, tool_name) -> bool:
+        for tool in self.tools:
+            if tool.name == tool_name:
+                annotations = getattr(tool, 'annotations', None)
+                return bool(annotations and annotations.readOnlyHint is True)
+        return False
+
+    async def _call_session(self, tool_name, tool_args, progress_callback):
+        """tools/call on the current session.
+
+        If the transport turns out to be dead, the call is retried once on the reconnected
+        session only when it never reached the transport or the tool is read-only. Otherwise
+        it may already have run on the server, so after the reconnect ConnectionError is
+        raised instead of running a write twice.
+        """
+        for retry in (False, True):
+            if self._lost.is_set():
+                # 已知连接断开：先等待重连，不在旧连接上发送
+                await self.ensure_connected()
+            session = self.session
+            if session is None:
+                raise ConnectionError(f"MCP server {self.name} is not connected")
+            try:
+                return await self._until_lost(session.call_tool(tool_name, tool_args, progress_callback=progress_callback))
+            except TRANSPORT_ERRORS as e:
+                if retry or self._connect_task is None or self._connect_task.done():
+                    raise ConnectionError(f"MCP server {self.name} connection closed") from e
+                # BrokenResourceError来自写入请求时传输层已关闭，请求没有发出；其他情况下请求可能已被执行
+                sent = not isinstance(e, anyio.BrokenResourceError)
+                logger.warning(f"{self.name} transport closed during {tool_name}: {e!r}, waiting for reconnect")
+                self.connection_lost()
+                await self.ensure_connected()
+                if sent and not self.is_read_only(tool_name):
+                    raise ConnectionError(f"MCP server {self.name} connection lost during {tool_name}; "
+                                          f"not retried since the call may have run") from e
+
+    async def call_tool(self, tool_name, tool_args, on_progress: Optional[Callable[[Dict], None]] = None,
+                        cache_scope: Optional[str] = None):
+        """Call tool via MCP server.
+
+        `on_progress` receives the server's notifications/progress and log messages
+        for the call as dicts with kind "progress" or "log" while it runs.
+        `cache_scope` overrides the client's result cache scope for this call.
+        """
+        await self.ensure_connected()
+        cache_key = tool_call_key(cache_scope or self.cache_scope, tool_name, tool_args) \
+            if self.is_cacheable(tool_name) else None
+        if cache_key:
+            cached = tool_result_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"{self.name} tool {tool_name} result served from cache")
+                return cached
+        timeout = self.tool_timeouts.get(tool_name, self.call_timeout)
+        counters = self.call_counters
+        counters["calls"] += 1
         try:
-            result = await self.session.call_tool(tool_name, tool_args)
+            # 截止时间覆盖整个调用，包括排队等待并发名额的时间；被取消（停止/断开连接）时同样放弃等待
+            async with asyncio.timeout(timeout):
+                # 每个服务器的并发调用受信号量限制
+                counters["waiting"] += 1
+                try:
+                    await self._call_semaphore.acquire()
+                finally:
+                    counters["waiting"] -= 1
+                counters["in_flight"] += 1
+                progress_callback = None
+                if on_progress is not None:
+                    async def progress_callback(progress, total, message):
+                        on_progress({"kind": "progress", "progress": progress, "total": total, "message": message})
+                    self._progress_listeners.add(on_progress)
+                try:
+                    result = await self._call_session(tool_name, tool_args, progress_callback)
+                finally:
+                    counters["in_flight"] -= 1
+                    self._call_semaphore.release()
+                    self._progress_listeners.discard(on_progress)
+            if cache_key and not result.isError:
+                tool_result_cache.put(cache_key, result, ttl=self.cache_ttl)
             return result
+        except asyncio.TimeoutError:
+            counters["timeouts"] += 1
+            logger.error(f"{self.name} tool {tool_name} timed out after {timeout}s")
+            raise TimeoutError(f"tool {tool_name} timed out after {timeout}s")
+        except asyncio.CancelledError:
+            counters["cancelled"] += 1
+            logger.info(f"{self.name} tool {tool_name} call cancelled")
+            raise
         except ValidationError as e:
             # Extract the actual tool result from the validation error
             raw_data = e.errors() if hasattr(e, 'errors') else None
@@ -202,10 +645,18 @@ class MCPClient:
                 
                 return CallToolResult.model_validate(tool_result)
             # Re-raise the exception if the result cannot be extracted
+            counters["errors"] += 1
+            raise
+        except Exception:
+            counters["errors"] += 1
             raise
 
     async def cleanup(self):
         """Clean up resources"""
+        if self._connect_task is not None and not self._connect_task.done():
+            # 由监护任务在自己的任务中关闭连接
+            self._connect_task.cancel()
+            await asyncio.wait({self._connect_task})
         try:
             await self.exit_stack.aclose()
         except RuntimeError as e:
@@ -217,3 +668,73 @@ class MCPClient:
             else:
                 # Re-raise if it's a different error
                 raise
+
+
+async def gather_tool_config(mcp_clients: Dict, mcp_server_ids: list, tool_names: ToolNameRegistry,
+                             cache: Optional[Dict] = None, timeout: float = MCP_TOOL_CONFIG_TIMEOUT):
+    """Assemble the bedrock tool config of several servers concurrently.
+
+    Tool names are namespaced through the session's `tool_names` registry, which is
+    also used to route the LLM's tool calls back with `tool_names.resolve`.
+
+    Each server gets its own deadline, so one hung server is skipped instead of blocking
+    the turn. A lazily connected server is first given its connect deadline to come up,
+    so a cold start is not cut short by the tool listing deadline. When `cache` (owned by the session) is given, the merged tool list is
+    memoized per sorted server-id set and the exact same list is returned while no
+    server's catalog version has changed.
+
+    Returns (tool_config, failed_server_ids). Timed out servers are skipped but not
+    reported as failed.
+    """
+    server_ids = tuple(sorted(set(mcp_server_ids)))
+
+    def catalog_versions():
+        return (tool_names.version,) + tuple((server_id, id(mcp_clients.get(server_id)), getattr(mcp_clients.get(server_id), 'tool_config_version', None))
+                     for server_id in server_ids)
+
+    if cache is not None:
+        cached = cache.get(server_ids)
+        if cached and cached[0] == catalog_versions() and cached[1] > time.monotonic():
+            return cached[2], []
+
+    async def fetch(server_id):
+        mcp_client = mcp_clients.get(server_id)
+        if mcp_client is None:
+            logger.error(f"mcp_client is None, server_id:{server_id}")
+            return server_id, None, False
+        ensure_connected = getattr(mcp_client, "ensure_connected", None)
+        if ensure_connected is not None:
+            # 延迟连接的服务器在这里首次启动（如冷启动的uvx/npx），按连接超时等待，而不是按获取工具列表的超时
+            connect_timeout = getattr(mcp_client, "connect_timeout", None) or MCP_CONNECT_TIMEOUT
+            try:
+                await asyncio.wait_for(ensure_connected(), timeout=connect_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Connect to {server_id} timed out after {connect_timeout}s, skipped")
+                return server_id, None, True
+            except Exception as e:
+                logger.error(f"Connect to {server_id} failed: {e}")
+                return server_id, None, False
+        try:
+            tool_config = await asyncio.wait_for(mcp_client.get_tool_config(server_id=server_id), timeout=timeout)
+            return server_id, tool_config, False
+        except asyncio.TimeoutError:
+            logger.warning(f"Get tool config from {server_id} timed out after {timeout}s, skipped")
+            return server_id, None, True
+
+    results = await asyncio.gather(*[fetch(server_id) for server_id in server_ids])
+    tool_config = {"tools": []}
+    failed_server_ids = []
+    complete = True
+    for server_id, server_tool_config, timed_out in results:
+        if server_tool_config:
+            tool_config["tools"].extend([{"toolSpec": {**tool["toolSpec"],
+                                                       "name": tool_names.register(server_id, tool["toolSpec"]["name"])}}
+                                         for tool in server_tool_config["tools"]])
+        else:
+            complete = False
+            if not timed_out:
+                failed_server_ids.append(server_id)
+
+    if cache is not None and complete:
+        cache[server_ids] = (catalog_versions(), time.monotonic() + MCP_TOOL_CACHE_TTL, tool_config)
+    return tool_config, failed_server_ids
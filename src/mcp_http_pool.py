@@ -0,0 +1,133 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Process-wide pooled HTTP connections for remote (streamable HTTP / SSE) MCP servers
+"""
+import os
+import sys
+import inspect
+import logging
+from typing import Any, Callable, Dict, Optional
+import httpx
+from dotenv import load_dotenv
+
+try:
+    import h2  # noqa: F401
+except ImportError:  # h2为可选依赖，缺失时只使用HTTP/1.1
+    h2 = None
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 是否让所有远程MCP会话共享按origin划分的连接池
+MCP_HTTP_POOL = os.environ.get("MCP_HTTP_POOL", "1") in ["1", "true", "True"]
+# 每个origin的连接上限（仅HTTP/2时生效）、保持的空闲连接数及其过期时间（秒）
+# HTTP/1.1下每个SSE/streamable HTTP会话的长连接GET独占一个连接，限制连接数会让超出的会话排队等待，因此不设上限
+MCP_HTTP_MAX_CONNECTIONS = int(os.environ.get("MCP_HTTP_MAX_CONNECTIONS", 100))
+MCP_HTTP_MAX_KEEPALIVE = int(os.environ.get("MCP_HTTP_MAX_KEEPALIVE", 20))
+MCP_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("MCP_HTTP_KEEPALIVE_EXPIRY", 30))
+# 服务端支持时使用HTTP/2（需要安装h2）
+MCP_HTTP2 = os.environ.get("MCP_HTTP2", "1") in ["1", "true", "True"]
+
+
+class _OriginRouter(httpx.AsyncBaseTransport):
+    """Send each request through the pooled transport of its origin.
+
+    Closing an AsyncClient closes its transport, so closing is a no-op here: the
+    pooled connections outlive the per-session clients and are closed by the pool.
+    """
+
+    def __init__(self, pool: "HTTPConnectionPool"):
+        self.pool = pool
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.pool.transport_for(request.url).handle_async_request(request)
+
+    async def aclose(self) -> None:
+        return
+
+
+class HTTPConnectionPool:
+    """One keep-alive (and, with h2 installed, HTTP/2) connection pool per origin.
+
+    max_connections only applies over HTTP/2, where sessions multiplex their streams on
+    a few connections. Over HTTP/1.1 each session's long-lived streaming GET holds a
+    connection of its own, so the number of connections is left unbounded and only the
+    idle ones kept alive are capped.
+    """
+
+    def __init__(self, max_connections: int = MCP_HTTP_MAX_CONNECTIONS,
+                 max_keepalive: int = MCP_HTTP_MAX_KEEPALIVE,
+                 keepalive_expiry: float = MCP_HTTP_KEEPALIVE_EXPIRY,
+                 http2: bool = MCP_HTTP2):
+        self.http2 = http2 and h2 is not None
+        if http2 and h2 is None:
+            logger.warning("h2 is not installed, pooled MCP HTTP connections use HTTP/1.1 without a connection cap")
+        self.limits = httpx.Limits(max_connections=max_connections if self.http2 else None,
+                                   max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=keepalive_expiry)
+        self.transports: Dict[str, httpx.AsyncHTTPTransport] = {}
+        self.requests: Dict[str, int] = {}
+        self._router = _OriginRouter(self)
+        self._installed = set()
+
+    def transport_for(self, url: httpx.URL) -> httpx.AsyncHTTPTransport:
+        origin = f"{url.scheme}://{url.netloc.decode('ascii')}"
+        transport = self.transports.get(origin)
+        if transport is None:
+            transport = httpx.AsyncHTTPTransport(limits=self.limits, http2=self.http2)
+            self.transports[origin] = transport
+            logger.info(f"Created pooled MCP HTTP transport for {origin} (http2={self.http2})")
+        self.requests[origin] = self.requests.get(origin, 0) + 1
+        return transport
+
+    def client_factory(self, headers: Optional[Dict[str, str]] = None, timeout: Optional[httpx.Timeout] = None,
+                       auth: Optional[httpx.Auth] = None) -> httpx.AsyncClient:
+        """Same defaults as mcp's create_mcp_http_client, over the shared connections"""
+        return httpx.AsyncClient(follow_redirects=True, headers=headers, auth=auth,
+                                 timeout=timeout if timeout is not None else httpx.Timeout(30.0),
+                                 transport=self._router)
+
+    def transport_kwargs(self, transport_client: Callable) -> Dict[str, Any]:
+        """Extra kwargs for mcp's streamablehttp_client/sse_client to use the pool.
+
+        Newer mcp releases take an httpx_client_factory; older ones build their client
+        with the module-level create_mcp_http_client, which is pointed at the pool instead.
+        """
+        if not MCP_HTTP_POOL:
+            return {}
+        if "httpx_client_factory" in inspect.signature(transport_client).parameters:
+            return {"httpx_client_factory": self.client_factory}
+        module = sys.modules.get(transport_client.__module__)
+        if module is not None and transport_client.__module__ not in self._installed \
+                and hasattr(module, "create_mcp_http_client"):
+            module.create_mcp_http_client = self.client_factory
+            self._installed.add(transport_client.__module__)
+        return {}
+
+    async def close_all(self):
+        transports, self.transports = list(self.transports.values()), {}
+        for transport in transports:
+            try:
+                await transport.aclose()
+            except Exception as e:
+                logger.error(f"Close MCP HTTP transport failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "origins": len(self.transports),
+            "requests": dict(self.requests),
+        }
+
+
+# 进程内共享的远程MCP服务器HTTP连接池
+http_pool = HTTPConnectionPool()
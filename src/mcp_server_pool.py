@@ -0,0 +1,260 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Shared, multiplexed instances of the global MCP servers that are marked stateless
+"""
+import os
+import time
+import zlib
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+from mcp_client import MCPClient, MCP_CONNECT_TIMEOUT
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 每个全局MCP服务器常驻的实例数量
+MCP_SHARED_INSTANCES = int(os.environ.get("MCP_SHARED_INSTANCES", 2))
+# 单个实例上同时进行的工具调用上限
+MCP_SHARED_MAX_CONCURRENCY = int(os.environ.get("MCP_SHARED_MAX_CONCURRENCY", 32))
+# 启动失败后再次尝试的间隔（秒）
+MCP_SHARED_RETRY_INTERVAL = float(os.environ.get("MCP_SHARED_RETRY_INTERVAL", 30))
+
+
+class SharedMCPServer:
+    """A stateless global MCP server backed by N long-lived MCPClient instances.
+
+    Every user session gets a SharedMCPServerSession view of it in place of a per-user
+    MCPClient. An instance process is shared by many users and gives them no isolation,
+    which is why only servers marked `"stateless": true` are served from here. The calls of
+    one session go to the same instance (chosen by hashing the user id) to spread users
+    evenly and keep connection reuse local; when that instance is reconnecting or failing,
+    a call goes to the healthy instance with the fewest calls in flight. Each instance
+    bounds its own calls. Session cleanup does not close it; the instances live until the
+    pool is closed.
+    """
+    shared = True
+
+    def __init__(self, server_id: str, config: Dict, instances: int = MCP_SHARED_INSTANCES,
+                 max_concurrency: int = MCP_SHARED_MAX_CONCURRENCY, connect_timeout: float = MCP_CONNECT_TIMEOUT):
+        self.server_id = server_id
+        self.config = config
+        self.name = f"shared_{server_id}"
+        self.instances = max(1, instances)
+        self.max_concurrency = max_concurrency
+        self.connect_timeout = connect_timeout
+        self.clients: List[MCPClient] = []
+        self.failures: Dict[int, int] = {}
+        # counters
+        self.calls = 0
+        self.errors = 0
+
+    async def start(self):
+        """Connect all instances concurrently, each within connect_timeout; at least one must come up"""
+        async def connect(index):
+            mcp_client = MCPClient(name=f"{self.name}_{index}")
+            # 同一服务器的所有实例共享结果缓存，缓存按会话隔离（见call_tool）
+            mcp_client.cache_scope = self.name
+            # 实例被多个会话共享，服务器日志无法归属到具体调用，不转发
+            mcp_client.relay_logs = False
+            try:
+                await asyncio.wait_for(
+                    mcp_client.connect_with_config({"max_concurrency": self.max_concurrency, **self.config},
+                                                   timeout=self.connect_timeout),
+                    timeout=self.connect_timeout)
+                return mcp_client
+            except asyncio.TimeoutError:
+                logger.error(f"Shared MCP server {self.server_id} instance {index} start timed out after {self.connect_timeout}s")
+            except Exception as e:
+                logger.error(f"Shared MCP server {self.server_id} instance {index} failed to start: {e}")
+            try:
+                await mcp_client.cleanup()
+            except Exception:
+                pass
+            return None
+
+        results = await asyncio.gather(*[connect(i) for i in range(self.instances)])
+        self.clients = [c for c in results if c is not None]
+        if not self.clients:
+            raise ValueError(f"No instance of shared MCP server {self.server_id} could be started")
+        for mcp_client in self.clients:
+            self.failures[id(mcp_client)] = 0
+        logger.info(f"Shared MCP server {self.server_id} started with {len(self.clients)} instances")
+
+    def _healthy(self, mcp_client: MCPClient) -> bool:
+        return mcp_client.connected and self.failures[id(mcp_client)] == 0
+
+    def _pick(self, session_key: Optional[str] = None) -> MCPClient:
+        if session_key is not None:
+            # 同一会话优先使用同一个实例以均衡负载（不提供隔离），实例异常时临时改用其他实例
+            pinned = self.clients[zlib.crc32(session_key.encode('utf-8')) % len(self.clients)]
+            if self._healthy(pinned):
+                return pinned
+        # 优先选择连接正常（未在重连）且没有连续失败的实例，其次选择进行中调用最少的实例
+        return min(self.clients, key=lambda c: (not c.connected, self.failures[id(c)] > 0,
+                                                c.call_counters["in_flight"] + c.call_counters["waiting"]))
+
+    def for_session(self, session_key: str) -> "SharedMCPServerSession":
+        """The view of this server put into the mcp_clients of one user session"""
+        return SharedMCPServerSession(self, session_key)
+
+    @property
+    def tool_config_version(self) -> int:
+        return sum(c.tool_config_version for c in self.clients)
+
+    @property
+    def tools(self) -> list:
+        return self.clients[0].tools if self.clients else []
+
+    async def get_tool_config(self, model_provider='bedrock', server_id: str = ''):
+        """All instances run the same server, so any of them can describe the tools"""
+        return await self._pick().get_tool_config(model_provider=model_provider, server_id=server_id or self.server_id)
+
+    async def call_tool(self, tool_name, tool_args, on_progress=None, session_key: Optional[str] = None):
+        mcp_client = self._pick(session_key)
+        key = id(mcp_client)
+        self.calls += 1
+        # 结果可能依赖用户身份或会话状态，缓存不跨用户共享
+        cache_scope = f"{self.name}:{session_key}" if session_key is not None else None
+        try:
+            result = await mcp_client.call_tool(tool_name, tool_args, on_progress=on_progress, cache_scope=cache_scope)
+            self.failures[key] = 0
+            return result
+        except Exception:
+            self.errors += 1
+            self.failures[key] += 1
+            raise
+
+    async def disconnect_to_server(self):
+        """Sessions only release the shared server; the pool owns the instances"""
+        return
+
+    async def cleanup(self):
+        return
+
+    async def close(self):
+        for mcp_client in self.clients:
+            try:
+                await mcp_client.cleanup()
+            except Exception as e:
+                logger.error(f"Close shared MCP server {self.server_id} failed: {e}")
+        self.clients = []
+
+    def call_stats(self) -> Dict[str, int]:
+        """Call counters summed over all instances"""
+        totals = {}
+        for mcp_client in self.clients:
+            for field, value in mcp_client.call_stats().items():
+                totals[field] = totals.get(field, 0) + value
+        return totals
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "instances": len(self.clients),
+            "calls": self.calls,
+            "errors": self.errors,
+            **{f"instance_{field}": value for field, value in self.call_stats().items()
+               if field not in ("calls", "errors")},
+        }
+
+
+class SharedMCPServerSession:
+    """One session's handle on a SharedMCPServer; its tool calls prefer one instance"""
+    shared = True
+
+    def __init__(self, server: SharedMCPServer, session_key: str):
+        self.server = server
+        self.session_key = session_key
+
+    def __getattr__(self, name):
+        return getattr(self.server, name)
+
+    async def get_tool_config(self, model_provider='bedrock', server_id: str = ''):
+        return await self.server._pick(self.session_key).get_tool_config(
+            model_provider=model_provider, server_id=server_id or self.server.server_id)
+
+    async def call_tool(self, tool_name, tool_args, on_progress=None):
+        return await self.server.call_tool(tool_name, tool_args, on_progress=on_progress, session_key=self.session_key)
+
+    async def disconnect_to_server(self):
+        return
+
+    async def cleanup(self):
+        return
+
+
+def is_stateless(config: Dict) -> bool:
+    """Whether a global server config may be shared across users.
+
+    Servers that keep per-client state (browser pages, a working directory, temp files)
+    must stay per user, so sharing is opt-in with `"stateless": true`.
+    """
+    return config.get("stateless") is True
+
+
+class SharedMCPServerPool:
+    """Stateless global MCP servers shared by all user sessions of the process"""
+
+    def __init__(self, retry_interval: float = MCP_SHARED_RETRY_INTERVAL):
+        self.retry_interval = retry_interval
+        self.servers: Dict[str, SharedMCPServer] = {}
+        self.configs: Dict[str, Dict] = {}
+        self._failed_at: Dict[str, float] = {}
+        self._lock = asyncio.Lock()
+
+    def is_shared(self, server_id: str) -> bool:
+        return server_id in self.configs
+
+    async def _start_server(self, server_id: str):
+        server = SharedMCPServer(server_id, self.configs[server_id])
+        try:
+            await server.start()
+            self.servers[server_id] = server
+            self._failed_at.pop(server_id, None)
+        except Exception as e:
+            self._failed_at[server_id] = time.monotonic()
+            logger.error(f"Start shared MCP server {server_id} failed: {e}")
+
+    async def start(self, server_configs: Dict[str, Dict]):
+        """Register the stateless global server configs and start them concurrently.
+
+        Other global servers are left to the sessions, each of which starts its own instance.
+        """
+        server_configs = {server_id: config for server_id, config in server_configs.items() if is_stateless(config)}
+        self.configs.update(server_configs)
+        async with self._lock:
+            await asyncio.gather(*[self._start_server(server_id) for server_id in server_configs
+                                   if server_id not in self.servers])
+
+    async def get_clients(self) -> Dict[str, SharedMCPServer]:
+        """Started shared servers; ones that failed earlier are retried after the retry interval"""
+        now = time.monotonic()
+        retry = [server_id for server_id in self.configs
+                 if server_id not in self.servers and now - self._failed_at.get(server_id, 0) >= self.retry_interval]
+        if retry:
+            async with self._lock:
+                await asyncio.gather(*[self._start_server(server_id) for server_id in retry
+                                       if server_id not in self.servers])
+        return dict(self.servers)
+
+    async def close_all(self):
+        servers = list(self.servers.values())
+        self.servers = {}
+        for server in servers:
+            await server.close()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {server_id: server.stats() for server_id, server in self.servers.items()}
+
+
+# 进程内共享的全局MCP服务器池
+shared_server_pool = SharedMCPServerPool()
@@ -0,0 +1,203 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Warm pool of pre-started stdio MCP server processes for frequently used configs
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Dict, Optional
+from dotenv import load_dotenv
+from mcp_client import MCPClient
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 每个常用配置预先启动的实例数量，0表示关闭预热池
+MCP_WARM_POOL_SIZE = int(os.environ.get("MCP_WARM_POOL_SIZE", 1))
+# 同一配置被使用多少次后开始预热
+MCP_WARM_POOL_MIN_USES = int(os.environ.get("MCP_WARM_POOL_MIN_USES", 2))
+# 最多为多少个配置保留预热实例（按最近使用淘汰）
+MCP_WARM_POOL_MAX_CONFIGS = int(os.environ.get("MCP_WARM_POOL_MAX_CONFIGS", 8))
+# 预热实例空闲多久后关闭（秒），期间没有再被使用的配置也不再补充
+MCP_WARM_POOL_IDLE_TTL = float(os.environ.get("MCP_WARM_POOL_IDLE_TTL", 600))
+# 预热实例的启动超时（秒）
+MCP_WARM_POOL_CONNECT_TIMEOUT = float(os.environ.get("MCP_WARM_POOL_CONNECT_TIMEOUT", 60))
+
+# 决定进程行为的配置字段，描述等字段不影响复用
+_PROCESS_FIELDS = ("command", "args", "env")
+
+
+def config_key(config: Dict) -> Optional[str]:
+    """Hash of the fields that define the server process; None for non-stdio configs"""
+    if config.get("url") or not config.get("command"):
+        return None
+    payload = json.dumps({field: config.get(field) for field in _PROCESS_FIELDS}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class WarmServerPool:
+    """Pre-started, initialized MCPClient instances keyed by server config.
+
+    Every attach of a stdio server is counted; once a config has been used
+    MCP_WARM_POOL_MIN_USES times, the pool keeps `size` idle instances of it running.
+    A session takes one with `take`, which returns immediately, and the pool refills
+    in the background. Only the most recently used MCP_WARM_POOL_MAX_CONFIGS configs
+    are kept warm, and instances idle for longer than MCP_WARM_POOL_IDLE_TTL are closed.
+    """
+
+    def __init__(self, size: int = MCP_WARM_POOL_SIZE, min_uses: int = MCP_WARM_POOL_MIN_USES,
+                 max_configs: int = MCP_WARM_POOL_MAX_CONFIGS, idle_ttl: float = MCP_WARM_POOL_IDLE_TTL):
+        self.size = size
+        self.min_uses = min_uses
+        self.max_configs = max_configs
+        self.idle_ttl = idle_ttl
+        # key -> (config, uses, last used)
+        self.configs: "OrderedDict[str, tuple]" = OrderedDict()
+        # key -> deque of (started at, MCPClient)
+        self.idle: Dict[str, deque] = {}
+        self._filling: Dict[str, asyncio.Task] = {}
+        self._reaper = None
+        self._closing = set()
+        self._seq = 0
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.started = 0
+        self.failed = 0
+
+    def take(self, config: Dict, name: str, on_status=None) -> Optional[MCPClient]:
+        """A connected instance for `config` renamed to `name`, or None to connect cold"""
+        key = config_key(config)
+        if self.size <= 0 or key is None:
+            return None
+        _, uses, _ = self.configs.pop(key, (config, 0, 0))
+        self.configs[key] = (config, uses + 1, time.monotonic())
+        self._evict_configs()
+
+        mcp_client = None
+        idle = self.idle.get(key)
+        while idle:
+            _, candidate = idle.popleft()
+            if candidate.connected:
+                mcp_client = candidate
+                break
+            self._close_later(candidate)
+        if mcp_client is not None:
+            self.hits += 1
+            mcp_client.adopt(name, on_status=on_status)
+            logger.info(f"Warm MCP server instance handed over as {name}")
+        else:
+            self.misses += 1
+        if uses + 1 >= self.min_uses:
+            self._schedule_refill(key)
+        return mcp_client
+
+    def _schedule_refill(self, key: str):
+        task = self._filling.get(key)
+        if task is None or task.done():
+            self._filling[key] = asyncio.create_task(self._refill(key))
+
+    async def _refill(self, key: str):
+        while key in self.configs and len(self.idle.get(key, ())) < self.size:
+            config = self.configs[key][0]
+            self._seq += 1
+            mcp_client = MCPClient(name=f"warm_{self._seq}")
+            try:
+                await asyncio.wait_for(mcp_client.connect_with_config(config, timeout=MCP_WARM_POOL_CONNECT_TIMEOUT),
+                                       timeout=MCP_WARM_POOL_CONNECT_TIMEOUT)
+            except asyncio.CancelledError:
+                await self._close(mcp_client)
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f"Warm up MCP server {config.get('command')} failed: {e!r}")
+                await self._close(mcp_client)
+                return
+            if key not in self.configs:
+                # 配置在启动期间已被淘汰
+                await self._close(mcp_client)
+                return
+            self.started += 1
+            self.idle.setdefault(key, deque()).append((time.monotonic(), mcp_client))
+
+    def _evict_configs(self):
+        while len(self.configs) > self.max_configs:
+            key, _ = self.configs.popitem(last=False)
+            self._drop(key)
+
+    def _drop(self, key: str):
+        task = self._filling.pop(key, None)
+        if task is not None and not task.done():
+            task.cancel()
+        for _, mcp_client in self.idle.pop(key, ()):
+            self._close_later(mcp_client)
+
+    def _close_later(self, mcp_client: MCPClient):
+        task = asyncio.create_task(self._close(mcp_client))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    async def _close(mcp_client: MCPClient):
+        try:
+            await mcp_client.cleanup()
+        except Exception as e:
+            logger.error(f"Close warm MCP server {mcp_client.name} failed: {e}")
+
+    def reap(self):
+        """Close instances idle for too long and forget configs not used within the TTL"""
+        now = time.monotonic()
+        for key in [key for key, (_, _, last_used) in self.configs.items() if now - last_used > self.idle_ttl]:
+            del self.configs[key]
+            self._drop(key)
+        for key, idle in self.idle.items():
+            while idle and now - idle[0][0] > self.idle_ttl:
+                _, mcp_client = idle.popleft()
+                self._close_later(mcp_client)
+
+    async def _reap_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.reap()
+
+    def start(self, interval: float = 60):
+        if self._reaper is None and self.size > 0:
+            self._reaper = asyncio.create_task(self._reap_loop(interval))
+
+    async def close_all(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for task in self._filling.values():
+            task.cancel()
+        self._filling = {}
+        clients = [mcp_client for idle in self.idle.values() for _, mcp_client in idle]
+        self.idle = {}
+        self.configs.clear()
+        await asyncio.gather(*[self._close(mcp_client) for mcp_client in clients])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "configs": len(self.configs),
+            "idle": sum(len(idle) for idle in self.idle.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "started": self.started,
+            "failed": self.failed,
+        }
+
+
+# 进程内共享的stdio MCP服务器预热池
+warm_pool = WarmServerPool()
@@ -18,7 +18,7 @@ import time
 import inspect
 import io
 import numpy as np
-from mcp_client import MCPClient
+from mcp_client import MCPClient, ToolNameRegistry, gather_tool_config
 from rx.subject import Subject
 from rx import operators as ops
 from rx.scheduler.eventloop import AsyncIOScheduler
@@ -672,6 +672,7 @@ class WebSocketAudioProcessor:
         self.region = region
         self.mcp_clients = mcp_clients
         self.mcp_server_ids = mcp_server_ids
+        self.tool_names = ToolNameRegistry()
         self.stream_manager = None
         self.is_streaming = False
         self.last_text = {"USER": "", "ASSISTANT": ""}
@@ -695,12 +696,10 @@ class WebSocketAudioProcessor:
         # get tools from mcp server
         tools_config = []
         if self.mcp_clients is not None:
-            for mcp_server_id in self.mcp_server_ids:
-                tool_config_response = await self.mcp_clients[mcp_server_id].get_tool_config(server_id=mcp_server_id)
-                if tool_config_response:
-                    tools_config.extend(tool_config_response["tools"])
-                # else:
-                #     yield {"type": "stopped", "data": {"message": f"Get tool config from {mcp_server_id} failed, please restart the MCP server"}}
+            tool_config, failed_server_ids = await gather_tool_config(self.mcp_clients, self.mcp_server_ids, self.tool_names)
+            tools_config = tool_config["tools"]
+            if failed_server_ids:
+                logger.warning(f"Get tool config from {failed_server_ids} failed")
         logger.info(f"Tool config: {tools_config}")
         
         self.stream_manager = BedrockStreamManager(
@@ -721,13 +720,13 @@ class WebSocketAudioProcessor:
         return self
     
     async def processToolUse(self, toolName, toolUseContent):
-        server_id, llm_tool_name = MCPClient.get_tool_name4mcp(toolName)
+        server_id, llm_tool_name = self.tool_names.resolve(toolName)
         try:
             tool_name, tool_args = toolName, json.loads(toolUseContent)
             if tool_args == "":
                 tool_args = {}
             #parse the tool_name
-            server_id, llm_tool_name = MCPClient.get_tool_name4mcp(tool_name)
+            server_id, llm_tool_name = self.tool_names.resolve(tool_name)
             mcp_client = self.mcp_clients.get(server_id)
             if mcp_client is None:
                 raise Exception(f"mcp_client is None, server_id:{server_id}")
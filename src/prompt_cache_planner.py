@@ -0,0 +1,253 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Token-based placement of Bedrock prompt cache checkpoints
+"""
+import os
+import json
+import logging
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 单次请求最多允许的cachePoint数量（Bedrock限制）
+CACHE_MAX_CHECKPOINTS = 4
+# 没有真实token统计时，按字符数估算token数
+CACHE_CHARS_PER_TOKEN = float(os.environ.get("CACHE_CHARS_PER_TOKEN", 4))
+# 单张图片的估算token数
+CACHE_IMAGE_TOKENS = int(os.environ.get("CACHE_IMAGE_TOKENS", 1600))
+
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+
+def estimate_tokens(value: Any) -> int:
+    """Rough token count of a converse content block, message or list of them"""
+    if isinstance(value, list):
+        return sum(estimate_tokens(item) for item in value)
+    if isinstance(value, str):
+        return int(len(value) / CACHE_CHARS_PER_TOKEN)
+    if not isinstance(value, dict):
+        return 0
+    if "cachePoint" in value:
+        return 0
+    if "content" in value:
+        return estimate_tokens(value["content"])
+    if "text" in value and isinstance(value["text"], str):
+        return estimate_tokens(value["text"])
+    if "image" in value:
+        return CACHE_IMAGE_TOKENS
+    if "toolResult" in value:
+        return estimate_tokens(value["toolResult"].get("content", []))
+    if "document" in value:
+        source = value["document"].get("source", {})
+        return int(len(source.get("bytes", b"")) / CACHE_CHARS_PER_TOKEN)
+    return estimate_tokens(json.dumps(value, ensure_ascii=False, default=str))
+
+
+def _has_cache_point(message: Dict) -> bool:
+    content = message.get("content")
+    return isinstance(content, list) and any(isinstance(item, dict) and "cachePoint" in item for item in content)
+
+
+def _strip_cache_point(blocks: List) -> List:
+    return [item for item in blocks if not (isinstance(item, dict) and "cachePoint" in item)]
+
+
+class PromptCacheMetrics:
+    """Process-wide cache read/write token counters from converse metadata events"""
+
+    def __init__(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+
+    def record(self, usage: Dict):
+        self.calls += 1
+        self.input_tokens += usage.get("inputTokens", 0)
+        self.cache_read_tokens += usage.get("cacheReadInputTokens", 0)
+        self.cache_write_tokens += usage.get("cacheWriteInputTokens", 0)
+
+    def stats(self) -> Dict[str, Any]:
+        prompt_tokens = self.input_tokens + self.cache_read_tokens + self.cache_write_tokens
+        return {
+            "calls": self.calls,
+            "input_tokens": self.input_tokens,
+            "cache_read_tokens": self.cache_read_tokens,
+            "cache_write_tokens": self.cache_write_tokens,
+            "cache_read_share": round(self.cache_read_tokens / prompt_tokens, 4) if prompt_tokens else 0.0,
+        }
+
+
+class CachePointPlanner:
+    """Place up to four cachePoint markers on the prompt of one chat session.
+
+    The static prefix (tools, then system) gets a checkpoint at the end of each part
+    that adds at least `min_tokens` uncached tokens. The remaining budget is used for
+    rolling checkpoints on messages: a new one is added whenever the tokens since the
+    previous checkpoint reach `min_tokens`, and when the budget is full the oldest
+    message checkpoint is dropped, so the newest prefix is always written while the
+    previous one is still read.
+
+    Positions are measured with the real prompt size from converse metadata events
+    (inputTokens + cacheReadInputTokens + cacheWriteInputTokens); only the newest
+    tool results, which the model has not seen yet, are estimated.
+    """
+
+    def __init__(self, max_checkpoints: int = CACHE_MAX_CHECKPOINTS):
+        self.max_checkpoints = max_checkpoints
+        self.reset()
+        # counters
+        self.input_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+
+    def reset(self):
+        """Forget checkpoint positions, e.g. when the session history is cleared"""
+        self.min_tokens = 1024
+        self.static_checkpoints = 0
+        self.message_checkpoints: List[Dict] = []
+        self.prompt_tokens: Optional[int] = None
+        self.output_tokens = 0
+        self.checkpoint_position = 0
+        # 最近一次发送的prompt中，最后一个checkpoint之后的估算token数
+        self.tail_tokens = 0
+        self.pending = False
+
+    def export_state(self, messages: List[Dict]) -> Dict[str, Any]:
+        """Planner state as plain data; message checkpoints become indices into `messages`"""
+        checkpoint_ids = {id(m) for m in self.message_checkpoints}
+        return {
+            "min_tokens": self.min_tokens,
+            "static_checkpoints": self.static_checkpoints,
+            "message_checkpoints": [i for i, m in enumerate(messages) if id(m) in checkpoint_ids],
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "checkpoint_position": self.checkpoint_position,
+            "tail_tokens": self.tail_tokens,
+            "pending": self.pending,
+            "input_tokens": self.input_tokens,
+            "cache_read_tokens": self.cache_read_tokens,
+            "cache_write_tokens": self.cache_write_tokens,
+        }
+
+    def restore_state(self, state: Dict[str, Any], messages: List[Dict]):
+        """Inverse of export_state, against the restored copy of the messages"""
+        self.reset()
+        self.message_checkpoints = [messages[i] for i in state.get("message_checkpoints", []) if i < len(messages)]
+        for field in ("min_tokens", "static_checkpoints", "prompt_tokens", "output_tokens", "checkpoint_position",
+                      "tail_tokens", "pending", "input_tokens", "cache_read_tokens", "cache_write_tokens"):
+            if field in state:
+                setattr(self, field, state[field])
+
+    @property
+    def message_budget(self) -> int:
+        return max(0, self.max_checkpoints - self.static_checkpoints)
+
+    def _add_message_checkpoint(self, message: Dict):
+        message["content"] = _strip_cache_point(message["content"]) + [dict(CACHE_POINT)]
+        self.message_checkpoints = [m for m in self.message_checkpoints if m is not message] + [message]
+        while len(self.message_checkpoints) > self.message_budget:
+            oldest = self.message_checkpoints.pop(0)
+            oldest["content"] = _strip_cache_point(oldest["content"])
+
+    def plan_request(self, request_params: Dict, min_tokens: int = 1024):
+        """Add checkpoints to a new converse request in place, before its first turn"""
+        self.min_tokens = min_tokens
+        self.prompt_tokens = None
+        self.output_tokens = 0
+        self.static_checkpoints = 0
+        position = 0
+        last_checkpoint = 0
+
+        # 静态前缀：tools -> system
+        if 'toolConfig' in request_params:
+            tools = _strip_cache_point(request_params['toolConfig']['tools'])
+            position += estimate_tokens(tools)
+            if position - last_checkpoint >= min_tokens:
+                # tool_config可能是会话内缓存的共享对象，这里构造新的list
+                request_params['toolConfig'] = {**request_params['toolConfig'], "tools": tools + [dict(CACHE_POINT)]}
+                self.static_checkpoints += 1
+                last_checkpoint = position
+                logger.info(f"add checkpoint for tool config at ~{position} tokens")
+        system = _strip_cache_point(request_params.get('system') or [])
+        if system:
+            position += estimate_tokens(system)
+            if position - last_checkpoint >= min_tokens:
+                request_params['system'] = system + [dict(CACHE_POINT)]
+                self.static_checkpoints += 1
+                last_checkpoint = position
+                logger.info(f"add checkpoint for system prompt at ~{position} tokens")
+
+        # 历史消息中已有的checkpoint（例如keep_session保留的历史）
+        messages = request_params.get('messages') or []
+        self.message_checkpoints = [m for m in messages if _has_cache_point(m)]
+        while len(self.message_checkpoints) > self.message_budget:
+            oldest = self.message_checkpoints.pop(0)
+            oldest["content"] = _strip_cache_point(oldest["content"])
+
+        # 估算最后一个checkpoint之后的token数，足够长时在最新的消息上再放一个
+        tail = 0
+        for message in reversed(messages):
+            if _has_cache_point(message):
+                break
+            tail += estimate_tokens(message)
+        else:
+            tail += position - last_checkpoint
+        if messages and isinstance(messages[-1].get("content"), list) and tail >= min_tokens and self.message_budget:
+            self._add_message_checkpoint(messages[-1])
+            logger.info(f"add checkpoint for history messages, uncached ~{tail} tokens")
+            tail = 0
+        self.tail_tokens = tail
+        self.pending = True
+
+    def record_usage(self, usage: Dict):
+        """Read the real prompt size of the last turn from a metadata event"""
+        prompt_tokens = usage.get("inputTokens", 0) + usage.get("cacheReadInputTokens", 0) + usage.get("cacheWriteInputTokens", 0)
+        if self.pending:
+            self.checkpoint_position = prompt_tokens - self.tail_tokens
+            self.pending = False
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = usage.get("outputTokens", 0)
+        self.input_tokens += usage.get("inputTokens", 0)
+        self.cache_read_tokens += usage.get("cacheReadInputTokens", 0)
+        self.cache_write_tokens += usage.get("cacheWriteInputTokens", 0)
+        logger.info(f"Prompt cache read:{usage.get('cacheReadInputTokens', 0)} write:{usage.get('cacheWriteInputTokens', 0)} input:{usage.get('inputTokens', 0)}")
+
+    def plan_tool_result(self, message: Dict) -> bool:
+        """Add a rolling checkpoint to the tool result message of the next turn if worthwhile"""
+        new_tokens = estimate_tokens(message)
+        if self.prompt_tokens is None:
+            # 没有收到metadata时退回到纯估算
+            uncached = self.tail_tokens + new_tokens
+        else:
+            uncached = self.prompt_tokens + self.output_tokens + new_tokens - self.checkpoint_position
+        if uncached < self.min_tokens or not self.message_budget:
+            self.tail_tokens = uncached
+            self.pending = True
+            return False
+        self._add_message_checkpoint(message)
+        self.tail_tokens = 0
+        self.pending = True
+        logger.info(f"Write message cache: ~{uncached} tokens, message checkpoints:{len(self.message_checkpoints)}")
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        prompt_tokens = self.input_tokens + self.cache_read_tokens + self.cache_write_tokens
+        return {
+            "checkpoints": self.static_checkpoints + len(self.message_checkpoints),
+            "cache_read_share": round(self.cache_read_tokens / prompt_tokens, 4) if prompt_tokens else 0.0,
+        }
+
+
+# 进程内共享的缓存命中统计
+prompt_cache_metrics = PromptCacheMetrics()
@@ -0,0 +1,149 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+User sessions kept in least-recently-used order under a session count and memory budget
+"""
+import os
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Tuple
+from dotenv import load_dotenv
+from blob_store import BlobRef
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 同时保留的用户会话数上限，0表示不限制
+SESSION_MAX_COUNT = int(os.environ.get("SESSION_MAX_COUNT", 10000))
+# 所有会话估算内存的上限（MB），0表示不限制
+SESSION_MEMORY_BUDGET_MB = float(os.environ.get("SESSION_MEMORY_BUDGET_MB", 4096))
+# 每个会话私有的MCP服务器（子进程或连接）按多少MB计入预算
+SESSION_MCP_CLIENT_MB = float(os.environ.get("SESSION_MCP_CLIENT_MB", 32))
+# 会话对象本身的固定开销（字节）
+SESSION_BASE_BYTES = 64 * 1024
+
+
+def estimate_bytes(value: Any) -> int:
+    """Rough size of converse messages: text length plus image and document bytes"""
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, BlobRef):
+        # 转存到磁盘的内容不占内存；多个会话共享的内容按每个会话各算一份
+        return value.size if value.resident else 0
+    if isinstance(value, dict):
+        return sum(estimate_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_bytes(item) for item in value)
+    return 0
+
+
+def estimate_session_bytes(session) -> int:
+    """History of the chat client plus the private MCP clients of a UserSession"""
+    private_clients = sum(1 for c in session.mcp_clients.values() if not getattr(c, "shared", False))
+    return (SESSION_BASE_BYTES + estimate_bytes(session.chat_client.messages)
+            + int(private_clients * SESSION_MCP_CLIENT_MB * 1024 * 1024))
+
+
+class SessionLRU:
+    """User sessions ordered by last activity.
+
+    `touch` moves a session to the most recently used end in O(1). `select_evictions`
+    walks from the least recently used end and stops at the first session that is
+    neither expired nor needed to get back under the budget, so a cleanup pass costs
+    O(evicted) instead of a scan of every session.
+    """
+
+    def __init__(self, max_count: int = SESSION_MAX_COUNT, memory_budget_mb: float = SESSION_MEMORY_BUDGET_MB):
+        self.max_count = max_count
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.sessions: "OrderedDict[str, Any]" = OrderedDict()
+        # user_id -> 估算字节数 / 最近活跃时间（monotonic）
+        self.sizes: Dict[str, int] = {}
+        self.touched: Dict[str, float] = {}
+        self.total_bytes = 0
+        # counters
+        self.evicted_idle = 0
+        self.evicted_budget = 0
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.sessions
+
+    def __getitem__(self, user_id: str):
+        return self.sessions[user_id]
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def get(self, user_id: str, default=None):
+        return self.sessions.get(user_id, default)
+
+    def items(self):
+        return list(self.sessions.items())
+
+    def add(self, user_id: str, session):
+        self.pop(user_id)
+        self.sessions[user_id] = session
+        self.touched[user_id] = time.monotonic()
+        self.sizes[user_id] = SESSION_BASE_BYTES
+        self.total_bytes += SESSION_BASE_BYTES
+
+    def touch(self, user_id: str):
+        if user_id in self.sessions:
+            self.sessions.move_to_end(user_id)
+            self.touched[user_id] = time.monotonic()
+
+    def resize(self, user_id: str, nbytes: int):
+        """Record a new size estimate, e.g. after a request changed the history"""
+        if user_id in self.sessions:
+            self.total_bytes += nbytes - self.sizes.get(user_id, 0)
+            self.sizes[user_id] = nbytes
+
+    def pop(self, user_id: str):
+        session = self.sessions.pop(user_id, None)
+        if session is not None:
+            self.total_bytes -= self.sizes.pop(user_id, 0)
+            self.touched.pop(user_id, None)
+        return session
+
+    def over_budget(self) -> bool:
+        return ((self.max_count > 0 and len(self.sessions) > self.max_count)
+                or (self.memory_budget > 0 and self.total_bytes > self.memory_budget))
+
+    def select_evictions(self, idle_seconds: float, is_busy: Callable[[Any], bool]) -> List[Tuple[str, Any]]:
+        """Remove and return the sessions idle for longer than idle_seconds, then least recently
+        used ones until the budget is met. Busy sessions are skipped and count as just used."""
+        evicted = []
+        deadline = time.monotonic() - idle_seconds
+        for _ in range(len(self.sessions)):
+            user_id, session = next(iter(self.sessions.items()))
+            idle = self.touched[user_id] < deadline
+            if not idle and not self.over_budget():
+                break
+            if is_busy(session):
+                self.touch(user_id)
+                continue
+            self.pop(user_id)
+            evicted.append((user_id, session))
+            if idle:
+                self.evicted_idle += 1
+            else:
+                self.evicted_budget += 1
+        return evicted
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self.sessions),
+            "estimated_mb": round(self.total_bytes / 1024 / 1024, 2),
+            "max_count": self.max_count,
+            "memory_budget_mb": round(self.memory_budget / 1024 / 1024, 2),
+            "evicted_idle": self.evicted_idle,
+            "evicted_budget": self.evicted_budget,
+        }
@@ -0,0 +1,455 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Session state shared by all workers: conversation history, prompt cache checkpoints and stream ownership
+"""
+import os
+import json
+import time
+import base64
+import sqlite3
+import asyncio
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Set
+from urllib.parse import urlparse, unquote
+from dotenv import load_dotenv
+from blob_store import BlobRef
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 会话状态存储：memory（单进程），sqlite:///data/sessions.db（同机多worker），redis://host:port/db（多机）
+SESSION_STORE = os.environ.get("SESSION_STORE", "memory")
+# 会话历史在存储中的保留时间（秒）
+SESSION_HISTORY_TTL = int(os.environ.get("SESSION_HISTORY_TTL", 86400))
+# 流式请求归属记录的保留时间（秒），防止异常退出的worker留下僵尸记录
+SESSION_STREAM_TTL = int(os.environ.get("SESSION_STREAM_TTL", 3600))
+# 连接Redis和等待单条命令回复的超时时间（秒）
+SESSION_STORE_TIMEOUT = float(os.environ.get("SESSION_STORE_TIMEOUT", 5))
+
+
+def _encode_default(value):
+    if isinstance(value, BlobRef):
+        value = value.data
+    if isinstance(value, (bytes, bytearray)):
+        return {"__bytes__": base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode_hook(obj):
+    if len(obj) == 1 and "__bytes__" in obj:
+        return base64.b64decode(obj["__bytes__"])
+    return obj
+
+
+def dumps_state(state: Dict) -> bytes:
+    """JSON with image/document bytes kept as base64"""
+    return json.dumps(state, ensure_ascii=False, separators=(',', ':'), default=_encode_default).encode('utf-8')
+
+
+def loads_state(payload) -> Dict:
+    return json.loads(payload, object_hook=_decode_hook)
+
+
+class SessionStore(ABC):
+    """Interface of the session state store.
+
+    History entries are whatever ChatClient.export_state returns. Stream entries map a
+    stream id to the user that started it, so any worker can authorize a stop request;
+    a stop flag set with request_stop is picked up by the worker that runs the stream.
+    """
+    backend = "base"
+    # 是否被多个worker进程共享
+    shared = True
+
+    def __init__(self):
+        # counters
+        self.loads = 0
+        self.hits = 0
+        self.saves = 0
+        self.errors = 0
+
+    @abstractmethod
+    async def load_history(self, user_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    async def save_history(self, user_id: str, state: Dict, ttl: int = SESSION_HISTORY_TTL):
+        ...
+
+    @abstractmethod
+    async def delete_history(self, user_id: str):
+        ...
+
+    @abstractmethod
+    async def claim_stream(self, stream_id: str, user_id: str, ttl: int = SESSION_STREAM_TTL) -> bool:
+        """Record the owner of a stream; False if the stream id is already taken"""
+
+    @abstractmethod
+    async def stream_owner(self, stream_id: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def release_stream(self, stream_id: str):
+        """Forget the owner and the stop flag of a finished stream"""
+
+    @abstractmethod
+    async def request_stop(self, stream_id: str, ttl: int = SESSION_STREAM_TTL):
+        """Ask the worker running the stream to stop it"""
+
+    @abstractmethod
+    async def stopped_streams(self, stream_ids: List[str]) -> Set[str]:
+        """The ids among `stream_ids` that have a pending stop request"""
+
+    async def close(self):
+        return
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "loads": self.loads,
+            "hits": self.hits,
+            "saves": self.saves,
+            "errors": self.errors,
+        }
+
+
+class MemorySessionStore(SessionStore):
+    """Process-local store; the state objects are kept as they are, without serializing"""
+    backend = "memory"
+    shared = False
+
+    def __init__(self):
+        super().__init__()
+        # key -> (expires at, value)
+        self.history: Dict[str, tuple] = {}
+        self.streams: Dict[str, tuple] = {}
+        self.stops: Dict[str, tuple] = {}
+
+    @staticmethod
+    def _get(table: Dict[str, tuple], key: str):
+        entry = table.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            table.pop(key, None)
+            return None
+        return entry[1]
+
+    @staticmethod
+    def _prune(table: Dict[str, tuple]):
+        now = time.monotonic()
+        for key in [key for key, (expires, _) in table.items() if expires < now]:
+            del table[key]
+
+    async def load_history(self, user_id: str) -> Optional[Dict]:
+        self.loads += 1
+        state = self._get(self.history, user_id)
+        if state is not None:
+            self.hits += 1
+        return state
+
+    async def save_history(self, user_id: str, state: Dict, ttl: int = SESSION_HISTORY_TTL):
+        self.saves += 1
+        self.history[user_id] = (time.monotonic() + ttl, state)
+        if self.saves % 256 == 0:
+            self._prune(self.history)
+
+    async def delete_history(self, user_id: str):
+        self.history.pop(user_id, None)
+
+    async def claim_stream(self, stream_id: str, user_id: str, ttl: int = SESSION_STREAM_TTL) -> bool:
+        if self._get(self.streams, stream_id) is not None:
+            return False
+        self._prune(self.streams)
+        self.streams[stream_id] = (time.monotonic() + ttl, user_id)
+        return True
+
+    async def stream_owner(self, stream_id: str) -> Optional[str]:
+        return self._get(self.streams, stream_id)
+
+    async def release_stream(self, stream_id: str):
+        self.streams.pop(stream_id, None)
+        self.stops.pop(stream_id, None)
+
+    async def request_stop(self, stream_id: str, ttl: int = SESSION_STREAM_TTL):
+        self.stops[stream_id] = (time.monotonic() + ttl, True)
+
+    async def stopped_streams(self, stream_ids: List[str]) -> Set[str]:
+        return {stream_id for stream_id in stream_ids if self._get(self.stops, stream_id)}
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "sessions": len(self.history), "streams": len(self.streams)}
+
+
+class SQLiteSessionStore(SessionStore):
+    """Store in a local SQLite file, shared by the worker processes of one host"""
+    backend = "sqlite"
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # sqlite3连接在线程池中使用，由锁保证同一时刻只有一个线程访问
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS history (user_id TEXT PRIMARY KEY, state BLOB, expires REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS streams (stream_id TEXT PRIMARY KEY, user_id TEXT, expires REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS stops (stream_id TEXT PRIMARY KEY, expires REAL)")
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchone()
+
+    async def _run(self, sql: str, params: tuple = ()):
+        return await asyncio.to_thread(self._execute, sql, params)
+
+    async def load_history(self, user_id: str) -> Optional[Dict]:
+        self.loads += 1
+        row = await self._run("SELECT state FROM history WHERE user_id = ? AND expires > ?", (user_id, time.time()))
+        if row is None:
+            return None
+        self.hits += 1
+        return await asyncio.to_thread(loads_state, row[0])
+
+    async def save_history(self, user_id: str, state: Dict, ttl: int = SESSION_HISTORY_TTL):
+        self.saves += 1
+        payload = await asyncio.to_thread(dumps_state, state)
+        await self._run("INSERT OR REPLACE INTO history (user_id, state, expires) VALUES (?, ?, ?)",
+                        (user_id, payload, time.time() + ttl))
+        if self.saves % 256 == 0:
+            await self._run("DELETE FROM history WHERE expires <= ?", (time.time(),))
+
+    async def delete_history(self, user_id: str):
+        await self._run("DELETE FROM history WHERE user_id = ?", (user_id,))
+
+    def _claim(self, stream_id: str, user_id: str, ttl: int) -> bool:
+        now = time.time()
+        with self._lock:
+            self._db.execute("DELETE FROM streams WHERE expires <= ?", (now,))
+            self._db.execute("DELETE FROM stops WHERE expires <= ?", (now,))
+            cursor = self._db.execute("INSERT OR IGNORE INTO streams (stream_id, user_id, expires) VALUES (?, ?, ?)",
+                                      (stream_id, user_id, now + ttl))
+            return cursor.rowcount == 1
+
+    async def claim_stream(self, stream_id: str, user_id: str, ttl: int = SESSION_STREAM_TTL) -> bool:
+        return await asyncio.to_thread(self._claim, stream_id, user_id, ttl)
+
+    async def stream_owner(self, stream_id: str) -> Optional[str]:
+        row = await self._run("SELECT user_id FROM streams WHERE stream_id = ? AND expires > ?", (stream_id, time.time()))
+        return row[0] if row else None
+
+    def _release(self, stream_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM streams WHERE stream_id = ?", (stream_id,))
+            self._db.execute("DELETE FROM stops WHERE stream_id = ?", (stream_id,))
+
+    async def release_stream(self, stream_id: str):
+        await asyncio.to_thread(self._release, stream_id)
+
+    async def request_stop(self, stream_id: str, ttl: int = SESSION_STREAM_TTL):
+        await self._run("INSERT OR REPLACE INTO stops (stream_id, expires) VALUES (?, ?)", (stream_id, time.time() + ttl))
+
+    def _stopped(self, stream_ids: List[str]) -> Set[str]:
+        placeholders = ",".join("?" * len(stream_ids))
+        with self._lock:
+            rows = self._db.execute(f"SELECT stream_id FROM stops WHERE stream_id IN ({placeholders}) AND expires > ?",
+                                    (*stream_ids, time.time())).fetchall()
+        return {row[0] for row in rows}
+
+    async def stopped_streams(self, stream_ids: List[str]) -> Set[str]:
+        if not stream_ids:
+            return set()
+        return await asyncio.to_thread(self._stopped, list(stream_ids))
+
+    async def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class RESPError(Exception):
+    """Error reply of a Redis-protocol server"""
+
+
+class RESPConnection:
+    """Minimal asyncio client for the Redis serialization protocol (RESP2).
+
+    Commands are sent one at a time over a single connection; it is reopened
+    on the next command after an I/O error or a reply that did not arrive within
+    `timeout`, so one stalled reply cannot hold the connection lock forever.
+    """
+
+    def __init__(self, host: str, port: int, db: int = 0, password: Optional[str] = None,
+                 username: Optional[str] = None, timeout: float = SESSION_STORE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.username = username
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _pack(args) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, (bytes, bytearray)):
+                arg = str(arg).encode('utf-8')
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed by the session store")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode('utf-8')
+        if kind == b"-":
+            raise RESPError(body.decode('utf-8'))
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            count = int(body)
+            if count < 0:
+                return None
+            return [await self._read_reply() for _ in range(count)]
+        raise ConnectionError(f"unexpected reply from the session store: {line!r}")
+
+    async def _roundtrip(self, *args):
+        self._writer.write(self._pack(args))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def _send(self, *args):
+        return await asyncio.wait_for(self._roundtrip(*args), timeout=self.timeout)
+
+    async def _open(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), timeout=self.timeout)
+        if self.password:
+            await self._send(*(["AUTH", self.username, self.password] if self.username else ["AUTH", self.password]))
+        if self.db:
+            await self._send("SELECT", self.db)
+
+    async def _reset(self):
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def execute(self, *args):
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._open()
+                return await self._send(*args)
+            except RESPError:
+                raise
+            except BaseException:
+                # 回复可能只读了一半，连接不能再复用
+                await self._reset()
+                raise
+
+    async def close(self):
+        async with self._lock:
+            await self._reset()
+
+
+class RedisSessionStore(SessionStore):
+    """Store on any Redis-protocol server, shared by workers on all hosts"""
+    backend = "redis"
+
+    def __init__(self, url: str, prefix: str = "mcp_session:"):
+        super().__init__()
+        parsed = urlparse(url)
+        db = parsed.path.strip("/")
+        self.connection = RESPConnection(parsed.hostname or "localhost", parsed.port or 6379,
+                                         db=int(db) if db else 0,
+                                         password=unquote(parsed.password) if parsed.password else None,
+                                         username=unquote(parsed.username) if parsed.username else None)
+        self.prefix = prefix
+
+    def _key(self, kind: str, key: str) -> str:
+        return f"{self.prefix}{kind}:{key}"
+
+    async def load_history(self, user_id: str) -> Optional[Dict]:
+        self.loads += 1
+        payload = await self.connection.execute("GET", self._key("history", user_id))
+        if payload is None:
+            return None
+        self.hits += 1
+        return await asyncio.to_thread(loads_state, payload)
+
+    async def save_history(self, user_id: str, state: Dict, ttl: int = SESSION_HISTORY_TTL):
+        self.saves += 1
+        payload = await asyncio.to_thread(dumps_state, state)
+        await self.connection.execute("SET", self._key("history", user_id), payload, "EX", ttl)
+
+    async def delete_history(self, user_id: str):
+        await self.connection.execute("DEL", self._key("history", user_id))
+
+    async def claim_stream(self, stream_id: str, user_id: str, ttl: int = SESSION_STREAM_TTL) -> bool:
+        reply = await self.connection.execute("SET", self._key("stream", stream_id), user_id, "NX", "EX", ttl)
+        return reply == "OK"
+
+    async def stream_owner(self, stream_id: str) -> Optional[str]:
+        owner = await self.connection.execute("GET", self._key("stream", stream_id))
+        return owner.decode('utf-8') if owner is not None else None
+
+    async def release_stream(self, stream_id: str):
+        await self.connection.execute("DEL", self._key("stream", stream_id), self._key("stop", stream_id))
+
+    async def request_stop(self, stream_id: str, ttl: int = SESSION_STREAM_TTL):
+        await self.connection.execute("SET", self._key("stop", stream_id), "1", "EX", ttl)
+
+    async def stopped_streams(self, stream_ids: List[str]) -> Set[str]:
+        if not stream_ids:
+            return set()
+        stream_ids = list(stream_ids)
+        flags = await self.connection.execute("MGET", *[self._key("stop", stream_id) for stream_id in stream_ids])
+        return {stream_id for stream_id, flag in zip(stream_ids, flags) if flag is not None}
+
+    async def close(self):
+        await self.connection.close()
+
+
+def create_session_store(url: str = SESSION_STORE) -> SessionStore:
+    """Build the store named by a SESSION_STORE url"""
+    if not url or url == "memory":
+        return MemorySessionStore()
+    if url.startswith("sqlite:///"):
+        # 与SQLAlchemy一致：sqlite:///相对路径，sqlite:////绝对路径
+        return SQLiteSessionStore(url[len("sqlite:///"):])
+    if url.startswith("redis://"):
+        return RedisSessionStore(url)
+    raise ValueError(f"Unknown session store: {url}")
+
+
+# 进程内共享的会话状态存储，多worker部署时指向同一个sqlite文件或redis
+session_store = create_session_store()
@@ -0,0 +1,144 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Server-sent event encoder for chat.completion.chunk frames
+"""
+import os
+import json
+import time
+import logging
+from typing import Any, Callable, Dict, Optional
+from dotenv import load_dotenv
+from starlette.responses import StreamingResponse
+
+try:
+    import orjson
+except ImportError:  # orjson为可选依赖，缺失时退回标准库json
+    orjson = None
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 合并连续文本delta的时间和大小上限，0表示不合并；可通过请求的extra_params覆盖
+SSE_COALESCE_MS = float(os.environ.get("SSE_COALESCE_MS", 0))
+SSE_COALESCE_BYTES = int(os.environ.get("SSE_COALESCE_BYTES", 0))
+
+SSE_DONE = b"data: [DONE]\n\n"
+
+
+def dumps(obj: Any) -> bytes:
+    """Compact JSON serialization to bytes"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class SSEEncoder:
+    """Encode chat.completion.chunk frames of one stream from precomputed byte templates.
+
+    Everything except the chunk id, delta, finish_reason and extras is rendered once per
+    stream. Consecutive content deltas can be merged into one frame until it exceeds
+    `coalesce_bytes` or has been held for `coalesce_ms`; any other frame flushes the
+    pending text first, so the order of events is preserved. The caller waits for the next
+    event at most `flush_delay()` seconds and flushes on timeout, which bounds how long a
+    delta is held even when the model pauses.
+    """
+
+    def __init__(self, model: str, coalesce_ms: float = SSE_COALESCE_MS, coalesce_bytes: int = SSE_COALESCE_BYTES):
+        self.coalesce_delay = max(0.0, coalesce_ms) / 1000
+        self.coalesce_bytes = max(0, coalesce_bytes)
+        self.coalesce = bool(self.coalesce_delay or self.coalesce_bytes)
+        self._id_base = time.time_ns()
+        self._seq = 0
+        self._head = b'data: {"id":"chat'
+        self._body = (b'","object":"chat.completion.chunk","created":' + str(int(time.time())).encode()
+                      + b',"model":' + dumps(model) + b',"choices":[{"index":0,"delta":')
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = 0.0
+
+    @classmethod
+    def from_params(cls, model: str, extra_params: Optional[Dict] = None) -> "SSEEncoder":
+        """Build an encoder honouring per-request stream_coalesce_ms/stream_coalesce_bytes"""
+        extra_params = extra_params or {}
+        return cls(model,
+                   coalesce_ms=float(extra_params.get('stream_coalesce_ms', SSE_COALESCE_MS)),
+                   coalesce_bytes=int(extra_params.get('stream_coalesce_bytes', SSE_COALESCE_BYTES)))
+
+    def _frame(self, delta: bytes, finish_reason: Optional[str] = None,
+               choice_extras: Optional[Dict] = None, extras: Optional[Dict] = None) -> bytes:
+        self._seq += 1
+        parts = [self._head, str(self._id_base + self._seq).encode(), self._body, delta,
+                 b',"finish_reason":', dumps(finish_reason)]
+        for key, value in (choice_extras or {}).items():
+            parts += [b',', dumps(key), b':', dumps(value)]
+        parts.append(b'}]')
+        for key, value in (extras or {}).items():
+            parts += [b',', dumps(key), b':', dumps(value)]
+        parts.append(b'}\n\n')
+        return b''.join(parts)
+
+    def flush(self) -> bytes:
+        """Emit the merged pending content, if any"""
+        if not self._pending:
+            return b''
+        text = ''.join(self._pending)
+        self._pending = []
+        self._pending_bytes = 0
+        return self._frame(dumps({"content": text}))
+
+    def flush_delay(self) -> Optional[float]:
+        """Seconds until the pending content must be flushed, None if nothing is held by time"""
+        if not self._pending or not self.coalesce_delay:
+            return None
+        return max(0.0, self._pending_since + self.coalesce_delay - time.monotonic())
+
+    def content(self, text: str) -> bytes:
+        """Frame(s) for a content delta; empty while the delta is held for merging"""
+        if not self.coalesce:
+            return self._frame(dumps({"content": text}))
+        now = time.monotonic()
+        if not self._pending:
+            self._pending_since = now
+        self._pending.append(text)
+        self._pending_bytes += len(text)
+        if (self.coalesce_bytes and self._pending_bytes >= self.coalesce_bytes) or \
+                (self.coalesce_delay and now - self._pending_since >= self.coalesce_delay):
+            return self.flush()
+        return b''
+
+    def chunk(self, delta: Optional[Dict] = None, finish_reason: Optional[str] = None,
+              choice_extras: Optional[Dict] = None, extras: Optional[Dict] = None) -> bytes:
+        """Any other frame; pending content is flushed before it"""
+        return self.flush() + self._frame(dumps(delta or {}), finish_reason, choice_extras, extras)
+
+
+class SSEStreamingResponse(StreamingResponse):
+    """Streaming response that closes its body and calls `on_close` exactly once when the
+    response is done, whether the body was consumed, failed or the client went away before
+    the first chunk was sent (in which case the body generator never starts)
+    """
+
+    def __init__(self, content, on_close: Optional[Callable[[], None]] = None, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            try:
+                aclose = getattr(self.body_iterator, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+            finally:
+                on_close, self.on_close = self.on_close, None
+                if on_close is not None:
+                    on_close()
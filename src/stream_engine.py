@@ -0,0 +1,199 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Async streaming engine: run blocking SDK calls and event-stream iteration off the event loop
+"""
+import os
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 每个活跃的流在读取期间会占用一个线程，所以线程池大小决定了单进程可同时承载的流数量
+STREAM_WORKERS = int(os.environ.get("STREAM_WORKERS", 256))
+# 每个流在事件循环侧最多缓冲的事件数，超过后读取线程会等待（背压）
+STREAM_QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE_SIZE", 64))
+
+_stream_executor = ThreadPoolExecutor(max_workers=STREAM_WORKERS, thread_name_prefix="stream-engine")
+
+_END_OF_STREAM = object()
+
+
+class _StreamError:
+    """Wrap an exception raised inside the reader thread"""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+async def run_blocking(func: Callable, *args, **kwargs):
+    """Run a blocking call (e.g. boto3 converse_stream) in the stream thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_stream_executor, partial(func, *args, **kwargs))
+
+
+async def iterate_in_thread(iterable: Iterable, maxsize: int = STREAM_QUEUE_SIZE,
+                            on_close: Optional[Callable[[], None]] = None) -> AsyncIterator:
+    """Iterate a blocking iterable in a worker thread and yield its items on the event loop.
+
+    Items are handed over through an asyncio.Queue; the reader holds a slot of a semaphore of
+    `maxsize` per undelivered item, so at most `maxsize` items are buffered. When the consumer stops early
+    (break / aclose / cancellation), the reader thread is signalled and `on_close` is called
+    so that a blocked network read can be interrupted.
+    """
+    loop = asyncio.get_running_loop()
+    # 队列本身不设上限：数据由slots限流，结束标记和异常总能放入队列
+    queue = asyncio.Queue()
+    slots = threading.Semaphore(maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # event loop already closed
+            stopped.set()
+
+    def reader():
+        try:
+            for item in iterable:
+                # 等待队列空位，同时响应消费者的停止信号
+                while not slots.acquire(timeout=0.1):
+                    if stopped.is_set():
+                        return
+                if stopped.is_set():
+                    return
+                put(item)
+        except BaseException as e:
+            if not stopped.is_set():
+                put(_StreamError(e))
+            return
+        put(_END_OF_STREAM)
+
+    loop.run_in_executor(_stream_executor, reader)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END_OF_STREAM:
+                break
+            slots.release()
+            if isinstance(item, _StreamError):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+        if on_close:
+            try:
+                on_close()
+            except Exception as e:
+                logger.debug(f"close stream error: {e}")
+
+
+async def run_until_stopped(awaitable: Awaitable, stop_event: Optional[asyncio.Event]) -> Tuple[bool, Any]:
+    """Await `awaitable` unless `stop_event` is set first, in which case it is cancelled.
+
+    Returns (completed, result). Cancelling the caller (e.g. client disconnect) cancels
+    the awaitable as well before the CancelledError propagates.
+    """
+    if stop_event is None:
+        return True, await awaitable
+    task = asyncio.ensure_future(awaitable)
+    stopper = asyncio.ensure_future(stop_event.wait())
+    try:
+        await asyncio.wait({task, stopper}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        # 取消后不再等待结果，只消费掉异常避免"never retrieved"告警
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        raise
+    finally:
+        stopper.cancel()
+    if task.done():
+        return True, task.result()
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return False, None
+
+
+async def drain_until_done(task: asyncio.Future, queue: asyncio.Queue) -> AsyncIterator:
+    """Yield items put on `queue` while `task` runs, then the ones left after it finishes.
+
+    If the consumer stops early (break / aclose / cancellation) the task is cancelled.
+    """
+    getter = None
+    try:
+        while not task.done():
+            getter = asyncio.ensure_future(queue.get())
+            await asyncio.wait({task, getter}, return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                item, getter = getter.result(), None
+                yield item
+            else:
+                getter.cancel()
+                getter = None
+        while not queue.empty():
+            yield queue.get_nowait()
+    finally:
+        if getter is not None:
+            getter.cancel()
+        if not task.done():
+            task.cancel()
+
+
+async def iterate_with_deadline(aiterable: AsyncIterable, next_timeout: Callable[[], Optional[float]]) -> AsyncIterator:
+    """Yield the items of `aiterable`, and None whenever no item arrived within `next_timeout()` seconds.
+
+    `next_timeout` is asked again before every wait; None means wait without a deadline.
+    A pending item is not lost on timeout, it is yielded once it arrives.
+    """
+    iterator = aiterable.__aiter__()
+    task = None
+    try:
+        while True:
+            timeout = next_timeout()
+            if task is None and timeout is None:
+                # 没有截止时间时直接等待，不为这一项创建任务
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+                yield item
+                continue
+            if task is None:
+                task = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+            if not done:
+                yield None
+                continue
+            finished, task = task, None
+            try:
+                item = finished.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except BaseException:
+                pass
+        aclose = getattr(iterator, 'aclose', None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,168 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Asyncio throttling/backoff scheduler shared by all chat clients in the process
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Hashable
+from dotenv import load_dotenv
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 每个凭证+区域的请求准入速率(次/秒)和突发容量
+THROTTLE_RATE = float(os.environ.get("THROTTLE_RATE", 10))
+THROTTLE_BURST = float(os.environ.get("THROTTLE_BURST", 20))
+# 被限流后速率的下限，避免完全饿死
+THROTTLE_MIN_RATE = float(os.environ.get("THROTTLE_MIN_RATE", 0.2))
+
+
+class ThrottleState:
+    """Token bucket and throttle counters for one (credential, region) key"""
+
+    def __init__(self, rate: float, burst: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.consecutive_throttles = 0
+        # counters
+        self.admitted = 0
+        self.waiting = 0
+        self.throttles = 0
+        self.retries = 0
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "rate": round(self.rate, 3),
+            "tokens": round(self.tokens, 3),
+            "cooldown": round(max(0.0, self.blocked_until - time.monotonic()), 3),
+            "admitted": self.admitted,
+            "waiting": self.waiting,
+            "throttles": self.throttles,
+            "retries": self.retries,
+        }
+
+
+class ThrottleScheduler:
+    """Asyncio-native admission and retry scheduler.
+
+    Each key (normally credential + region) owns a token bucket. A throttle response
+    puts only that key into cool-down and halves its admission rate, so requests
+    waiting on other keys are not affected. Successful calls restore the rate additively.
+    """
+
+    def __init__(self, rate: float = THROTTLE_RATE, burst: float = THROTTLE_BURST,
+                 min_rate: float = THROTTLE_MIN_RATE):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.states: Dict[Hashable, ThrottleState] = {}
+
+    def _state(self, key: Hashable) -> ThrottleState:
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = ThrottleState(self.rate, self.burst)
+        return state
+
+    def is_blocked(self, key: Hashable) -> bool:
+        """Whether the key is currently cooling down after a throttle"""
+        state = self.states.get(key)
+        return bool(state) and state.blocked_until > time.monotonic()
+
+    async def acquire(self, key: Hashable):
+        """Wait for admission on the key, parking only the callers of this key"""
+        state = self._state(key)
+        state.waiting += 1
+        try:
+            while True:
+                now = time.monotonic()
+                if now < state.blocked_until:
+                    await asyncio.sleep(state.blocked_until - now)
+                    continue
+                state.refill(now)
+                if state.tokens >= 1:
+                    state.tokens -= 1
+                    state.admitted += 1
+                    return
+                await asyncio.sleep((1 - state.tokens) / state.rate)
+        finally:
+            state.waiting -= 1
+
+    def record_success(self, key: Hashable):
+        state = self._state(key)
+        state.consecutive_throttles = 0
+        state.rate = min(state.max_rate, state.rate + state.max_rate * 0.1)
+
+    def record_throttle(self, key: Hashable, base_delay: float, max_delay: float) -> float:
+        """Register a throttle on the key and return its cool-down delay in seconds"""
+        state = self._state(key)
+        delay = min(max_delay, base_delay * (2 ** state.consecutive_throttles))
+        delay += random.uniform(0, 0.1 * delay)  # 10% jitter
+        state.consecutive_throttles += 1
+        state.throttles += 1
+        state.rate = max(self.min_rate, state.rate / 2)
+        state.tokens = min(state.tokens, 0)
+        state.blocked_until = max(state.blocked_until, time.monotonic() + delay)
+        return delay
+
+    def record_retry(self, key: Hashable):
+        self._state(key).retries += 1
+
+    async def call(self, key: Hashable, func: Callable, *args,
+                   is_throttle: Callable[[Exception], bool],
+                   max_retries: int = 10, base_delay: float = 10, max_delay: float = 60, **kwargs):
+        """Await `func(*args, **kwargs)` with admission control and async backoff on throttling"""
+        attempt = 0
+        while True:
+            await self.acquire(key)
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if not is_throttle(e):
+                    raise
+                delay = self.record_throttle(key, base_delay, max_delay)
+                if attempt >= max_retries:
+                    logger.error(f"Maximum retry attempts ({max_retries}) reached. Throttling persists.")
+                    raise Exception("Maximum retry attempts reached. Service is still throttling requests.")
+                attempt += 1
+                self.record_retry(key)
+                logger.warning(f"Throttling exception encountered. Retrying in {delay:.2f} seconds (attempt {attempt}/{max_retries})")
+                continue
+            self.record_success(key)
+            return result
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {format_throttle_key(key): state.to_dict() for key, state in self.states.items()}
+
+
+def format_throttle_key(key: Hashable) -> str:
+    """Render a (credential, region) key without exposing the full credential"""
+    if isinstance(key, tuple) and len(key) == 2:
+        credential, region = key
+        credential = str(credential)
+        if len(credential) > 8:
+            credential = credential[:4] + '***' + credential[-4:]
+        return f"{credential}@{region}"
+    return str(key)
+
+
+# 进程内共享的调度器
+throttle_scheduler = ThrottleScheduler()
@@ -0,0 +1,105 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+TTL + LRU cache for results of read-only MCP tool calls
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+from dotenv import load_dotenv
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 是否按工具注解(readOnlyHint且非destructiveHint)缓存调用结果；服务器配置中的cache_tools不受此开关影响
+MCP_TOOL_RESULT_CACHE = os.environ.get("MCP_TOOL_RESULT_CACHE", "0") in ["1", "true", "True"]
+MCP_TOOL_RESULT_CACHE_TTL = float(os.environ.get("MCP_TOOL_RESULT_CACHE_TTL", 60))
+# 进程内缓存结果的总大小上限（字节）
+MCP_TOOL_RESULT_CACHE_BYTES = int(os.environ.get("MCP_TOOL_RESULT_CACHE_BYTES", 64 * 1024 * 1024))
+
+
+def tool_call_key(scope: str, tool_name: str, tool_args: Any) -> str:
+    """Canonical hash of (client scope, tool, args); argument order does not matter"""
+    payload = json.dumps([scope, tool_name, tool_args or {}], sort_keys=True, separators=(',', ':'),
+                         ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def result_size(result: Any) -> int:
+    """Approximate memory held by a CallToolResult"""
+    size = 0
+    for content in getattr(result, 'content', []) or []:
+        size += len(getattr(content, 'text', '') or '') + len(getattr(content, 'data', '') or '')
+        resource = getattr(content, 'resource', None)
+        if resource is not None:
+            size += len(getattr(resource, 'text', '') or '') + len(getattr(resource, 'blob', '') or '')
+    return size + 256
+
+
+class ToolResultCache:
+    """Byte-bounded LRU of tool results, each entry with its own expiry"""
+
+    def __init__(self, max_bytes: int = MCP_TOOL_RESULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (expire, size, result)
+        self.bytes = 0
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expire, size, result = entry
+        if expire <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key: Hashable, result: Any, ttl: float = MCP_TOOL_RESULT_CACHE_TTL):
+        size = result_size(result)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + ttl, size, result)
+        self.bytes += size
+        while self.bytes > self.max_bytes and self.entries:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# 进程内共享的工具结果缓存，键中包含MCPClient名称，不同用户/服务器之间互相隔离
+tool_result_cache = ToolResultCache()
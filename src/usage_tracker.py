@@ -0,0 +1,139 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Token usage accounting per request and per user
+"""
+import os
+import time
+import logging
+from collections import deque
+from typing import Any, Dict, Optional
+from dotenv import load_dotenv
+
+load_dotenv()  # load environment variables from .env
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 每个用户的滚动统计窗口（秒）
+USAGE_WINDOW_SECONDS = int(os.environ.get("USAGE_WINDOW_SECONDS", 3600))
+# 用户超过该时间（秒）没有请求后不再单独保留其统计，累计值并入全局总数
+USAGE_RETENTION_SECONDS = int(os.environ.get("USAGE_RETENTION_SECONDS", 86400))
+# 清理不活跃用户的最小间隔（秒）
+USAGE_PRUNE_INTERVAL = 60
+
+USAGE_FIELDS = ("inputTokens", "outputTokens", "cacheReadInputTokens", "cacheWriteInputTokens")
+
+
+class UsageAccumulator:
+    """Sum of the converse usage blocks of every turn of one request"""
+
+    def __init__(self):
+        self.turns = 0
+        self.totals = {field: 0 for field in USAGE_FIELDS}
+
+    def add(self, usage: Optional[Dict]):
+        if not usage:
+            return
+        self.turns += 1
+        for field in USAGE_FIELDS:
+            self.totals[field] += usage.get(field, 0) or 0
+
+    @staticmethod
+    def to_openai(usage: Dict) -> Dict[str, Any]:
+        """Convert a converse usage block to OpenAI's usage format, keeping cache counters"""
+        cache_read = usage.get("cacheReadInputTokens", 0) or 0
+        cache_write = usage.get("cacheWriteInputTokens", 0) or 0
+        prompt_tokens = (usage.get("inputTokens", 0) or 0) + cache_read + cache_write
+        completion_tokens = usage.get("outputTokens", 0) or 0
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cache_read},
+            "cache_read_input_tokens": cache_read,
+            "cache_write_input_tokens": cache_write,
+        }
+
+    def openai_usage(self) -> Dict[str, Any]:
+        return {**self.to_openai(self.totals), "turns": self.turns}
+
+
+class UserUsageCounter:
+    """Rolling per-user token counters over USAGE_WINDOW_SECONDS plus lifetime totals.
+
+    Users without a request for `retention` seconds are dropped; their lifetime totals
+    are kept only in the process-wide summary.
+    """
+
+    def __init__(self, window: int = USAGE_WINDOW_SECONDS, retention: int = USAGE_RETENTION_SECONDS):
+        self.window = window
+        self.retention = max(retention, window)
+        # user_id -> deque of (timestamp, totals)
+        self._recent: Dict[str, deque] = {}
+        self._lifetime: Dict[str, Dict[str, int]] = {}
+        self._last_seen: Dict[str, float] = {}
+        # 已清理用户的累计值
+        self._retired: Dict[str, int] = {}
+        self._retired_users = 0
+        self._last_prune = time.time()
+
+    def record(self, user_id: str, accumulator: UsageAccumulator):
+        if not accumulator.turns:
+            return
+        totals = dict(accumulator.totals, requests=1, turns=accumulator.turns)
+        self._recent.setdefault(user_id, deque()).append((time.time(), totals))
+        lifetime = self._lifetime.setdefault(user_id, {})
+        for field, value in totals.items():
+            lifetime[field] = lifetime.get(field, 0) + value
+        now = time.time()
+        self._last_seen[user_id] = now
+        self._expire(user_id)
+        if now - self._last_prune >= USAGE_PRUNE_INTERVAL:
+            self.prune(now)
+
+    def prune(self, now: Optional[float] = None):
+        """Drop users idle for longer than the retention period"""
+        now = now or time.time()
+        self._last_prune = now
+        cutoff = now - self.retention
+        for user_id in [u for u, seen in self._last_seen.items() if seen < cutoff]:
+            del self._last_seen[user_id]
+            self._recent.pop(user_id, None)
+            for field, value in self._lifetime.pop(user_id, {}).items():
+                self._retired[field] = self._retired.get(field, 0) + value
+            self._retired_users += 1
+
+    def _expire(self, user_id: str):
+        recent = self._recent.get(user_id)
+        cutoff = time.time() - self.window
+        while recent and recent[0][0] < cutoff:
+            recent.popleft()
+
+    def stats(self, user_id: str) -> Dict[str, Any]:
+        self._expire(user_id)
+        window = {}
+        for _, totals in self._recent.get(user_id, ()):
+            for field, value in totals.items():
+                window[field] = window.get(field, 0) + value
+        return {
+            "window_seconds": self.window,
+            "window": window,
+            "lifetime": dict(self._lifetime.get(user_id, {})),
+        }
+
+    def summary(self) -> Dict[str, Any]:
+        total = dict(self._retired)
+        for lifetime in self._lifetime.values():
+            for field, value in lifetime.items():
+                total[field] = total.get(field, 0) + value
+        return {"users": len(self._lifetime), "retired_users": self._retired_users, "lifetime": total}
+
+
+# 进程内共享的用户用量统计
+usage_counter = UserUsageCounter()
@@ -8,14 +8,21 @@ DynamoDB utility functions for the FastAPI server
 import os
 import json
 import logging
-import boto3
-from datetime import datetime
-from typing import Dict
+from typing import Dict, Optional
 import hashlib
 import re
+import asyncio
 import threading
+from collections import deque
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from urllib.parse import urlparse
+from ddb_config_store import ddb_config_store
+
+try:
+    import fcntl
+except ImportError:  # Windows下没有fcntl，此时只支持单进程写配置文件
+    fcntl = None
 
 # Initialize logger
 
@@ -26,133 +33,71 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 # 全局模型和服务器配置
 load_dotenv()  # load env vars from .env
-# DynamoDB 客户端
-dynamodb_client = None
-DDB_TABLE = os.environ.get("ddb_table")  # DynamoDB表名，用于存储用户配置
 user_mcp_server_configs = {}  # 用户特有的MCP服务器配置 user_id -> {server_id: config}
 global_mcp_server_configs = {}  # 全局MCP服务器配置 server_id -> config
 
 session_lock = threading.RLock()
+# 本进程最近一次读取或写入的用户配置文件修改时间，用于发现其他worker的写入
+user_config_file_mtime = None
 
-if DDB_TABLE:
-    try:
-        region = os.environ.get('AWS_REGION', 'us-east-1')
-        dynamodb_client = boto3.resource('dynamodb', region_name=region)
-        logger.info(f"已连接到DynamoDB, 表名: {DDB_TABLE}")
-    except Exception as e:
-        logger.error(f"DynamoDB连接失败: {e}")
+@contextmanager
+def config_file_lock(config_file: str):
+    """Exclusive lock shared by all worker processes writing the config file"""
+    if fcntl is None:
+        yield
+        return
+    with open(config_file + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-def save_configs_to_json(configs:dict):
+def update_configs_json(update) -> dict:
+    """Apply update(configs) to the user config file under the file lock and return the result.
+
+    The file is re-read inside the lock, so changes written by other workers are kept,
+    and replaced atomically, so readers never see a partial file. The in-memory configs
+    of all users are replaced with the result, since it includes those other changes.
+    """
+    global user_mcp_server_configs, user_config_file_mtime
     config_file = os.environ.get('USER_MCP_CONFIG_FILE', 'conf/user_mcp_configs.json')
-    with open(config_file, 'w') as f:
-        json.dump(configs, f, indent=2)
-        
-async def save_to_ddb(user_id: str, data: dict):
-    """将用户配置保存到DynamoDB"""
-    if not dynamodb_client or not DDB_TABLE:
-        return False
-    
-    try:
-        table = dynamodb_client.Table(DDB_TABLE)
-        response = table.put_item(
-            Item={
-                'userId': user_id,
-                'data': json.dumps(data),
-                'timestamp': datetime.now().isoformat()
-            }
-        )
-        logger.info(f"保存用户 {user_id} 配置到DynamoDB成功")
-        return True
-    except Exception as e:
-        logger.error(f"保存用户 {user_id} 配置到DynamoDB失败: {e}")
-        return False
+    with config_file_lock(config_file):
+        configs = {}
+        if os.path.exists(config_file):
+            with open(config_file, 'r') as f:
+                configs = json.load(f)
+        update(configs)
+        tmp_file = f"{config_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(configs, f, indent=2)
+        os.replace(tmp_file, config_file)
+        # 在文件锁内更新，多个写入按写文件的顺序生效
+        with session_lock:
+            user_mcp_server_configs = configs
+            user_config_file_mtime = os.stat(config_file).st_mtime_ns
+    return configs
 
-async def get_from_ddb(user_id: str) -> dict:
-    """从DynamoDB获取用户配置"""
-    if not dynamodb_client or not DDB_TABLE:
-        return {}
-    
+def reload_configs_json_if_changed():
+    """Pick up user config changes written by other workers since the last read"""
+    global user_mcp_server_configs, user_config_file_mtime
+    config_file = os.environ.get('USER_MCP_CONFIG_FILE', 'conf/user_mcp_configs.json')
     try:
-        table = dynamodb_client.Table(DDB_TABLE)
-        response = table.get_item(
-            Key={
-                'userId': user_id
-            }
-        )
-        
-        if 'Item' in response:
-            data = json.loads(response['Item'].get('data', '{}'))
-            logger.info(f"从DynamoDB获取用户 {user_id} 配置成功")
-            return data
-        else:
-            logger.info(f"用户 {user_id} 在DynamoDB中无配置")
-            return {}
-    except Exception as e:
-        logger.warning(f"从DynamoDB获取用户 {user_id} 配置失败: {e}")
-        return {}
-        
-async def delete_from_ddb(user_id: str) -> bool:
-    """从DynamoDB删除用户配置"""
-    if not dynamodb_client or not DDB_TABLE:
-        return False
-    
+        mtime = os.stat(config_file).st_mtime_ns
+    except OSError:
+        return
+    if mtime == user_config_file_mtime:
+        return
     try:
-        table = dynamodb_client.Table(DDB_TABLE)
-        response = table.delete_item(
-            Key={
-                'userId': user_id
-            }
-        )
-        logger.info(f"从DynamoDB删除用户 {user_id} 配置成功")
-        return True
+        with open(config_file, 'r') as f:
+            configs = json.load(f)
     except Exception as e:
-        logger.error(f"从DynamoDB删除用户 {user_id} 配置失败: {e}")
-        return False
-
-async def scan_all_from_ddb() -> dict:
-    """从DynamoDB扫描所有用户配置，处理分页"""
-    if not dynamodb_client or not DDB_TABLE:
-        return {}
-    
-    try:
-        # 使用scan操作获取所有用户的配置，并处理分页
-        table = dynamodb_client.Table(DDB_TABLE)
-        configs = {}
-        
-        # 初始化扫描参数
-        scan_params = {}
-        done = False
-        start_key = None
-        
-        # 处理分页
-        while not done:
-            if start_key:
-                scan_params['ExclusiveStartKey'] = start_key
-            
-            response = table.scan(**scan_params)
-            items = response.get('Items', [])
-            
-            # 处理当前页的结果
-            for item in items:
-                if 'userId' in item and 'data' in item:
-                    user_id = item['userId']
-                    try:
-                        user_data = json.loads(item['data'])
-                        configs[user_id] = user_data
-                    except json.JSONDecodeError as e:
-                        logger.error(f"解析用户 {user_id} 的DynamoDB数据失败: {e}")
-            
-            # 检查是否有更多页
-            start_key = response.get('LastEvaluatedKey')
-            done = start_key is None
+        logger.error(f"重新加载用户MCP配置失败: {e}")
+        return
+    with session_lock:
+        user_mcp_server_configs = configs
+        user_config_file_mtime = mtime
         
-        logger.info(f"已从DynamoDB扫描到 {len(configs)} 个用户的配置")
-        return configs
-    except Exception as e:
-        logger.error(f"从DynamoDB扫描用户配置失败: {e}")
-        return {}
-    
-
 # 保存全局MCP服务器配置
 def save_global_server_config( server_id: str, config: dict):
     """保存全局的MCP服务器配置"""
@@ -164,29 +109,30 @@ def save_global_server_config( server_id: str, config: dict):
 # 删除用户MCP服务器配置 
 async def delete_user_server_config(user_id: str, server_id: str):
     """删除用户的MCP服务器配置"""
-    with session_lock: 
-        if user_id in user_mcp_server_configs and server_id in user_mcp_server_configs[user_id]:
-            del user_mcp_server_configs[user_id][server_id]
-            # 如果配置了DynamoDB，也从DDB中更新用户配置
-            if DDB_TABLE and dynamodb_client:
-                # 获取当前用户的所有配置
-                user_configs = await get_user_server_configs(user_id)
-                if server_id in user_configs:
-                    del user_configs[server_id]
-                # 保存更新后的配置到DynamoDB
-                await save_to_ddb(user_id, user_configs)
-                logger.info(f"已更新用户 {user_id} 在DynamoDB中的配置")
-            else:
-                try:
-                    save_configs_to_json(user_mcp_server_configs)
-                    logger.info(f"为用户 {user_id} 删除服务器配置 {server_id}")
-                except Exception as e:
-                    logger.error(f"保存用户MCP配置到文件失败: {e}")
+    if ddb_config_store.enabled:
+        # 只更新该服务器对应的属性，由后台批量写入DynamoDB
+        with session_lock:
+            user_mcp_server_configs.get(user_id, {}).pop(server_id, None)
+        ddb_config_store.delete(user_id, server_id)
+        logger.info(f"为用户 {user_id} 删除服务器配置 {server_id}")
+        return
+    reload_configs_json_if_changed()
+    with session_lock:
+        if server_id not in user_mcp_server_configs.get(user_id, {}):
+            return
+        del user_mcp_server_configs[user_id][server_id]
+    # 写文件期间不持有session_lock，避免阻塞其他线程
+    try:
+        await asyncio.to_thread(update_configs_json,
+                                lambda configs: configs.get(user_id, {}).pop(server_id, None))
+        logger.info(f"为用户 {user_id} 删除服务器配置 {server_id}")
+    except Exception as e:
+        logger.error(f"保存用户MCP配置到文件失败: {e}")
 
 
 # 保存用户MCP服务器配置
-async def save_user_server_config(user_id: str, server_id: str, config: dict):
-    """保存用户的MCP服务器配置"""
+async def save_user_server_config(user_id: str, server_id: str, config: dict, previous: Optional[dict] = None):
+    """保存用户的MCP服务器配置，previous为本次调用中刚从存储读到的配置"""
     global user_mcp_server_configs
     
     with session_lock:
@@ -194,47 +140,41 @@ async def save_user_server_config(user_id: str, server_id: str, config: dict):
             user_mcp_server_configs[user_id] = {}
         
         user_mcp_server_configs[user_id][server_id] = config
-        # 如果配置了DynamoDB，也保存到DDB中
-        if DDB_TABLE and dynamodb_client:
-            #获取原有的记录
-            ddb_config = await get_from_ddb(user_id)
-            ddb_config[server_id] = config
-            await save_to_ddb(user_id, ddb_config)
-            logger.info(f"已保存用户 {user_id} 配置到DynamoDB")
-        else:
-            try:
-                save_configs_to_json(user_mcp_server_configs)
-                logger.info(f"已保存用户 {user_id} 配置到config_file")
-            except Exception as e:
-                logger.error(f"保存用户MCP配置到文件失败: {e}")
+    # 如果配置了DynamoDB，只在配置与刚读到的值不同时排队写入，由后台批量刷新
+    if ddb_config_store.enabled:
+        if ddb_config_store.put(user_id, server_id, config, previous=previous):
+            logger.info(f"已排队保存用户 {user_id} 配置到DynamoDB")
+        return
+    try:
+        await asyncio.to_thread(update_configs_json,
+                                lambda configs: configs.setdefault(user_id, {}).update({server_id: config}))
+        logger.info(f"已保存用户 {user_id} 配置到config_file")
+    except Exception as e:
+        logger.error(f"保存用户MCP配置到文件失败: {e}")
 
 # 获取用户MCP服务器配置
 async def get_user_server_configs(user_id: str) -> dict:
     """获取指定用户的所有MCP服务器配置"""
-    # 如果设置了DynamoDB表名，优先从DynamoDB读取
-    if DDB_TABLE and dynamodb_client:
-        # 尝试从DynamoDB获取
-        ddb_config = await get_from_ddb(user_id)
-        if ddb_config:
-            # 如果DynamoDB中有数据，更新内存缓存并返回
-            with session_lock:
-                user_mcp_server_configs[user_id] = ddb_config
-            return ddb_config
-        else:
-            return {}
+    # 如果设置了DynamoDB表名，优先从DynamoDB读取（包含尚未写入的修改）
+    if ddb_config_store.enabled:
+        ddb_config = await ddb_config_store.load(user_id)
+        with session_lock:
+            user_mcp_server_configs[user_id] = ddb_config
+        return ddb_config
     else: 
-        # 如果没有设置DynamoDB或无法从DynamoDB获取，从内存中读取
+        # 如果没有设置DynamoDB或无法从DynamoDB获取，从内存中读取（其他worker写过文件时先重新加载）
+        reload_configs_json_if_changed()
         return user_mcp_server_configs.get(user_id, {})
     
 async def load_user_mcp_configs():
     """加载用户MCP服务器配置"""
-    global user_mcp_server_configs
+    global user_mcp_server_configs, user_config_file_mtime
     # 如果设置了DynamoDB表名，从DynamoDB加载所有用户配置
-    if DDB_TABLE and dynamodb_client:
+    if ddb_config_store.enabled:
         logger.info(f"从DynamoDB加载所有用户MCP配置")
         try:
-            # 使用scan_all_from_ddb扫描所有用户配置
-            ddb_configs = await scan_all_from_ddb()
+            # 扫描所有用户配置
+            ddb_configs = await ddb_config_store.load_all()
             if ddb_configs:
                 # 如果DynamoDB中有数据，更新内存缓存
                 with session_lock:
@@ -248,6 +188,7 @@ async def load_user_mcp_configs():
             config_file = os.environ.get('USER_MCP_CONFIG_FILE', 'conf/user_mcp_configs.json')
             if os.path.exists(config_file):
                 with session_lock:
+                    user_config_file_mtime = os.stat(config_file).st_mtime_ns
                     with open(config_file, 'r') as f:
                         configs = json.load(f)
                         user_mcp_server_configs = configs
@@ -277,6 +218,88 @@ def filter_tool_use_result(
     filtered_messages = [message for message in messages if message['content'] != []]
     return filtered_messages
     
+class HistoryIndex:
+    """
+    Running index of tool_result image blocks and long text blocks of a message list.
+
+    Messages appended to the list are indexed lazily on the next pruning call, so each
+    agent turn only scans the new messages instead of the whole history. Pruning keeps
+    the chunked semantics of `maybe_filter_to_n_most_recent_images` and
+    `maybe_redact_old_text_content` to avoid breaking the implicit prompt cache.
+    """
+
+    def __init__(self, messages: list, text_length_threshold: int = 1000):
+        self.messages = messages
+        self.text_length_threshold = text_length_threshold
+        self.scanned = 0
+        # (tool_result, content) 按从旧到新的顺序保存仍在历史中的图片
+        self.images = deque()
+        # 超过阈值的长文本content，已截断的仍然计数
+        self.long_texts = []
+        self.redacted = 0
+
+    def _index_new_messages(self):
+        if len(self.messages) < self.scanned:
+            # 消息列表被截短，重新建立索引
+            self.scanned = 0
+            self.images.clear()
+            self.long_texts = []
+            self.redacted = 0
+        for message in self.messages[self.scanned:]:
+            content = message.get("content")
+            if not isinstance(content, list):
+                continue
+            for item in content:
+                if not (isinstance(item, dict) and "toolResult" in item):
+                    continue
+                tool_result = item["toolResult"]
+                for block in tool_result.get("content", []):
+                    if not isinstance(block, dict):
+                        continue
+                    if "image" in block:
+                        self.images.append((tool_result, block))
+                    elif "text" in block and len(block["text"]) > self.text_length_threshold:
+                        self.long_texts.append(block)
+        self.scanned = len(self.messages)
+
+    def filter_images(self, images_to_keep: int, min_removal_threshold: int) -> list:
+        """Remove all but the final `images_to_keep` images, in chunks of min_removal_threshold"""
+        if not images_to_keep:
+            return self.messages
+        self._index_new_messages()
+
+        images_to_remove = len(self.images) - images_to_keep
+        # for better cache behavior, we want to remove in chunks
+        images_to_remove -= images_to_remove % min_removal_threshold
+        if images_to_remove <= 0:
+            return self.messages
+
+        removed = {}
+        for _ in range(images_to_remove):
+            tool_result, block = self.images.popleft()
+            removed.setdefault(id(tool_result), (tool_result, set()))[1].add(id(block))
+        for tool_result, block_ids in removed.values():
+            tool_result["content"] = [block for block in tool_result.get("content", []) if id(block) not in block_ids]
+        return self.messages
+
+    def redact_old_text(self, window_size: int = 10, min_redaction_threshold: int = 1) -> list:
+        """Truncate long texts of all but the final `window_size` ones, in chunks of min_redaction_threshold"""
+        if not window_size:
+            return self.messages
+        self._index_new_messages()
+
+        # 计算需要截断的长文本数量
+        texts_to_redact = max(0, len(self.long_texts) - window_size)
+        # 为了更好的缓存行为，调整要截断的文本数量
+        texts_to_redact -= texts_to_redact % min_redaction_threshold
+
+        # 从旧到新截断，已截断过的文本不再处理
+        for block in self.long_texts[self.redacted:texts_to_redact]:
+            block["text"] = block["text"][:self.text_length_threshold] + " <redacted content>"
+        self.redacted = max(self.redacted, texts_to_redact)
+        return self.messages
+
+
 def maybe_redact_old_text_content(
     messages: list, 
     window_size: int = 10,
@@ -290,6 +313,8 @@ def maybe_redact_old_text_content(
     first `text_length_threshold` characters and append "<redacted content>".
     Redaction occurs with a chunk of min_redaction_threshold to reduce the amount we break 
     the implicit prompt cache.
+
+    For repeated calls on a growing history use `HistoryIndex.redact_old_text` instead.
     
     Args:
         messages: The list of messages to process
@@ -298,48 +323,8 @@ def maybe_redact_old_text_content(
         text_length_threshold: Only redact texts longer than this threshold (in characters),
                               and keep this many characters from the beginning
     """
-    if not window_size:
-        return messages
-
-    # 找出所有tool_result块
-    tool_result_blocks = [
-        item['toolResult']
-        for message in messages
-        for item in (
-            message["content"] if isinstance(message["content"], list) else []
-        )
-        if isinstance(item, dict) and "toolResult" in item
-    ]
-
-    # 找出所有长文本内容（超过阈值的）
-    long_text_contents = [
-        content
-        for tool_result in tool_result_blocks
-        for content in tool_result.get("content", [])
-        if isinstance(content, dict) 
-        and "text" in content 
-        and len(content["text"]) > text_length_threshold
-    ]
-
-    # 计算需要截断的长文本数量
-    texts_to_redact = max(0, len(long_text_contents) - window_size)
-    # 为了更好的缓存行为，调整要截断的文本数量
-    texts_to_redact -= texts_to_redact % min_redaction_threshold
-    
-    # 从前向后遍历（从旧到新），截断早期的文本内容
-    for tool_result in tool_result_blocks:
-        if isinstance(tool_result.get("content"), list):
-            for content in tool_result.get("content", []):
-                if (isinstance(content, dict) 
-                    and "text" in content 
-                    and len(content["text"]) > text_length_threshold):
-                    if texts_to_redact > 0:
-                        content["text"] = content["text"][:text_length_threshold] + " <redacted content>"
-                        texts_to_redact -= 1
-
-    return messages
-
-
+    return HistoryIndex(messages, text_length_threshold=text_length_threshold).redact_old_text(
+        window_size=window_size, min_redaction_threshold=min_redaction_threshold)
 
 
 def maybe_filter_to_n_most_recent_images(
@@ -352,41 +337,10 @@ def maybe_filter_to_n_most_recent_images(
     the conversation progresses, remove all but the final `images_to_keep` tool_result
     images in place, with a chunk of min_removal_threshold to reduce the amount we
     break the implicit prompt cache.
+
+    For repeated calls on a growing history use `HistoryIndex.filter_images` instead.
     """
-    if not images_to_keep :
-        return messages
-
-    tool_result_blocks =  [
-            item['toolResult']
-            for message in messages
-            for item in (
-                message["content"] if isinstance(message["content"], list) else []
-            )
-            if isinstance(item, dict) and "toolResult" in item
-        ]
-
-    total_images = sum(
-        1
-        for tool_result in tool_result_blocks
-        for content in tool_result.get("content", [])
-        if isinstance(content, dict) and  "image" in content
-    )
-
-    images_to_remove = total_images - images_to_keep
-    # for better cache behavior, we want to remove in chunks
-    images_to_remove -= images_to_remove % min_removal_threshold
-
-    for tool_result in tool_result_blocks:
-        if isinstance(tool_result.get("content"), list):
-            new_content = []
-            for content in tool_result.get("content", []):
-                if isinstance(content, dict) and "image" in content:
-                    if images_to_remove > 0:
-                        images_to_remove -= 1
-                        continue
-                new_content.append(content)
-            tool_result["content"] = new_content
-    return messages
+    return HistoryIndex(messages).filter_images(images_to_keep, min_removal_threshold)
             
 def remove_cache_checkpoint(messages: list) -> list:
     """
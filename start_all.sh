@@ -32,7 +32,7 @@ echo "React UI environment updated with backend URL: ${PROTOCOL}://${MCP_SERVICE
 # Start MCP service
 echo "Starting MCP service with ${PROTOCOL}..."
 nohup python src/main.py --mcp-conf conf/config.json --user-conf conf/user_mcp_config.json \
-    --host ${MCP_SERVICE_HOST} --port ${MCP_SERVICE_PORT} ${HTTPS_ARGS} > ${LOG_FILE1} 2>&1 &
+    --host ${MCP_SERVICE_HOST} --port ${MCP_SERVICE_PORT} --workers ${MCP_WORKERS:-1} ${HTTPS_ARGS} > ${LOG_FILE1} 2>&1 &
 
 # Start Chatbot service 
 # echo "Starting Chatbot service..."
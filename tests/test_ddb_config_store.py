@@ -0,0 +1,153 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+DynamoDB config store against moto's in-process DynamoDB stand-in
+"""
+import asyncio
+import json
+import threading
+import boto3
+import moto
+import pytest
+from ddb_config_store import DDBConfigStore
+
+TABLE = "mcp_user_config_test"
+
+
+@pytest.fixture
+def table(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_REGION", "us-east-1")
+    with moto.mock_aws():
+        resource = boto3.resource("dynamodb", region_name="us-east-1")
+        yield resource.create_table(TableName=TABLE, KeySchema=[{"AttributeName": "userId", "KeyType": "HASH"}],
+                                    AttributeDefinitions=[{"AttributeName": "userId", "AttributeType": "S"}],
+                                    BillingMode="PAY_PER_REQUEST")
+
+
+def make_store(**kwargs) -> DDBConfigStore:
+    # 刷新间隔足够长，后台刷新不会与测试里显式的flush交错
+    return DDBConfigStore(table_name=TABLE, endpoint_url="", **{"flush_interval": 60, **kwargs})
+
+
+def stored(table, user_id):
+    item = table.get_item(Key={"userId": user_id}).get("Item", {})
+    return {name[len("server:"):]: json.loads(value) for name, value in item.items() if name.startswith("server:")}
+
+
+def test_coalesced_writes_and_pending_reads(table):
+    async def run():
+        store = make_store()
+        store.put("u1", "s1", {"command": "a"})
+        store.put("u1", "s1", {"command": "b"})
+        store.put("u1", "s2", {"command": "c"})
+        assert await store.load("u1") == {"s1": {"command": "b"}, "s2": {"command": "c"}}
+        await store.flush()
+        assert store.writes == 1 and store.coalesced == 1
+        store.delete("u1", "s2")
+        await store.close()
+        return store
+
+    store = asyncio.run(run())
+    assert stored(table, "u1") == {"s1": {"command": "b"}}
+    assert store.stats()["pending"] == 0
+
+
+def test_legacy_item_is_migrated(table):
+    table.put_item(Item={"userId": "old", "data": json.dumps({"a": {"command": "x"}, "b": {"url": "http://y"}})})
+
+    async def run():
+        return await make_store().load_all()
+
+    assert asyncio.run(run()) == {"old": {"a": {"command": "x"}, "b": {"url": "http://y"}}}
+    item = table.get_item(Key={"userId": "old"})["Item"]
+    assert "data" not in item
+    assert stored(table, "old") == {"a": {"command": "x"}, "b": {"url": "http://y"}}
+
+
+def test_skips_only_against_a_value_read_in_the_same_call(table):
+    async def run():
+        store = make_store()
+        config = (await store.load("u1")).get("s1", {"command": "a"})
+        assert store.put("u1", "s1", config)
+        await store.flush()
+        # 另一个worker修改了同一配置，之前读到的值已经过时
+        table.update_item(Key={"userId": "u1"}, UpdateExpression="SET #s = :v",
+                          ExpressionAttributeNames={"#s": "server:s1"},
+                          ExpressionAttributeValues={":v": json.dumps({"command": "other"})})
+        assert store.put("u1", "s1", {"command": "a"})
+        config = (await store.load("u1"))["s1"]
+        assert config == {"command": "a"}
+        assert not store.put("u1", "s1", config, previous=config)
+        await store.close()
+        return store
+
+    store = asyncio.run(run())
+    assert stored(table, "u1") == {"s1": {"command": "a"}}
+    assert store.skipped == 1
+
+
+def test_put_during_inflight_write_is_not_lost(table):
+    async def run():
+        store = make_store()
+        store.put("u1", "s1", {"v": 0})
+        await store.flush()
+        entered, release = threading.Event(), threading.Event()
+        update_item = store._update_item
+
+        def slow_update_item(user_id, changes):
+            entered.set()
+            release.wait(5)
+            update_item(user_id, changes)
+
+        store._update_item = slow_update_item
+        store.put("u1", "s1", {"v": 1})
+        flush = asyncio.create_task(store.flush())
+        await asyncio.to_thread(entered.wait, 5)
+        assert store.stats()["inflight"] == 1
+        # 正在写入v1时改回v0，不能当作“未变化”跳过
+        assert store.put("u1", "s1", {"v": 0})
+        assert not store.put("u1", "s1", {"v": 0})
+        release.set()
+        await flush
+        store._update_item = update_item
+        await store.close()
+        return store
+
+    store = asyncio.run(run())
+    assert stored(table, "u1") == {"s1": {"v": 0}}
+    assert store.stats()["inflight"] == 0
+
+
+def test_failed_writes_back_off_and_are_retried(table):
+    async def run():
+        store = make_store(flush_interval=60, max_backoff=300)
+        update_item = store._update_item
+        attempts = []
+
+        def failing_update_item(user_id, changes):
+            attempts.append(user_id)
+            if len(attempts) <= 3:
+                raise RuntimeError("throttled")
+            update_item(user_id, changes)
+
+        store._update_item = failing_update_item
+        store.put("u1", "s1", {"command": "a"})
+        delays = []
+        for _ in range(3):
+            await store.flush()
+            delays.append(store._delay())
+        assert delays == [120, 240, 300]
+        assert store.stats()["pending"] == 1
+        await store.flush()
+        assert store.stats()["consecutive_failures"] == 0
+        assert store._delay() == 60
+        await store.close()
+        return store
+
+    store = asyncio.run(run())
+    assert stored(table, "u1") == {"s1": {"command": "a"}}
+    assert store.errors == 3
@@ -0,0 +1,137 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+HistoryIndex prunes a growing history exactly like the original whole-history walks
+"""
+import copy
+import random
+import pytest
+from utils import HistoryIndex, maybe_filter_to_n_most_recent_images, maybe_redact_old_text_content
+
+THRESHOLD = 50
+
+
+def tool_result_blocks(messages):
+    return [item['toolResult']
+            for message in messages
+            for item in (message["content"] if isinstance(message["content"], list) else [])
+            if isinstance(item, dict) and "toolResult" in item]
+
+
+def baseline_filter_images(messages, images_to_keep, min_removal_threshold):
+    """The original maybe_filter_to_n_most_recent_images, which rescans the whole history"""
+    if not images_to_keep:
+        return messages
+    blocks = tool_result_blocks(messages)
+    total_images = sum(1 for tool_result in blocks for content in tool_result.get("content", [])
+                       if isinstance(content, dict) and "image" in content)
+    images_to_remove = total_images - images_to_keep
+    images_to_remove -= images_to_remove % min_removal_threshold
+    for tool_result in blocks:
+        if isinstance(tool_result.get("content"), list):
+            new_content = []
+            for content in tool_result.get("content", []):
+                if isinstance(content, dict) and "image" in content:
+                    if images_to_remove > 0:
+                        images_to_remove -= 1
+                        continue
+                new_content.append(content)
+            tool_result["content"] = new_content
+    return messages
+
+
+def baseline_redact(messages, window_size=10, min_redaction_threshold=1, text_length_threshold=THRESHOLD):
+    """The original maybe_redact_old_text_content, which rescans the whole history"""
+    if not window_size:
+        return messages
+    blocks = tool_result_blocks(messages)
+    long_text_contents = [content for tool_result in blocks for content in tool_result.get("content", [])
+                          if isinstance(content, dict) and "text" in content
+                          and len(content["text"]) > text_length_threshold]
+    texts_to_redact = max(0, len(long_text_contents) - window_size)
+    texts_to_redact -= texts_to_redact % min_redaction_threshold
+    for tool_result in blocks:
+        if isinstance(tool_result.get("content"), list):
+            for content in tool_result.get("content", []):
+                if (isinstance(content, dict) and "text" in content
+                        and len(content["text"]) > text_length_threshold):
+                    if texts_to_redact > 0:
+                        content["text"] = content["text"][:text_length_threshold] + " <redacted content>"
+                        texts_to_redact -= 1
+    return messages
+
+
+def tool_turn(rng, turn):
+    """An assistant toolUse message and the user toolResult message answering it"""
+    tool_use_ids = [f"t{turn}_{i}" for i in range(rng.randint(1, 3))]
+    results = []
+    for tool_use_id in tool_use_ids:
+        content = []
+        for index in range(rng.randint(0, 3)):
+            kind = rng.choice(["image", "short", "long"])
+            if kind == "image":
+                content.append({"image": {"format": "png", "source": {"bytes": f"{tool_use_id}_{index}".encode()}}})
+            else:
+                length = THRESHOLD + rng.randint(1, 40) if kind == "long" else rng.randint(1, THRESHOLD)
+                content.append({"text": f"{tool_use_id}_{index}:" + "x" * length})
+        results.append({"toolResult": {"toolUseId": tool_use_id, "content": content}})
+    return [
+        {"role": "assistant", "content": [{"text": f"turn {turn}"}] +
+            [{"toolUse": {"toolUseId": tool_use_id, "name": "tool", "input": {}}} for tool_use_id in tool_use_ids]},
+        {"role": "user", "content": results},
+    ]
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("images_to_keep,min_removal_threshold", [(1, 1), (3, 3), (2, 5)])
+@pytest.mark.parametrize("window_size,min_redaction_threshold", [(2, 1), (3, 4), (10, 1)])
+def test_incremental_pruning_matches_the_original_walk(seed, images_to_keep, min_removal_threshold,
+                                                       window_size, min_redaction_threshold):
+    rng = random.Random(seed)
+    messages = [{"role": "user", "content": [{"text": "start"}]}]
+    expected = copy.deepcopy(messages)
+    index = HistoryIndex(messages, text_length_threshold=THRESHOLD)
+    # 每轮追加工具调用和结果后剪枝，与客户端的agent循环相同
+    for turn in range(rng.randint(5, 15)):
+        new_messages = tool_turn(rng, turn)
+        messages.extend(copy.deepcopy(new_messages))
+        expected.extend(copy.deepcopy(new_messages))
+        index.filter_images(images_to_keep, min_removal_threshold)
+        index.redact_old_text(window_size, min_redaction_threshold)
+        baseline_filter_images(expected, images_to_keep, min_removal_threshold)
+        baseline_redact(expected, window_size, min_redaction_threshold)
+        assert messages == expected
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_one_shot_helpers_match_the_original_walk(seed):
+    rng = random.Random(seed)
+    messages = [message for turn in range(10) for message in tool_turn(rng, turn)]
+    expected = copy.deepcopy(messages)
+    maybe_filter_to_n_most_recent_images(messages, 2, min_removal_threshold=2)
+    maybe_redact_old_text_content(messages, window_size=3, min_redaction_threshold=2, text_length_threshold=THRESHOLD)
+    baseline_filter_images(expected, 2, 2)
+    baseline_redact(expected, 3, 2)
+    assert messages == expected
+
+
+def test_truncated_history_is_reindexed():
+    rng = random.Random(7)
+    messages = [message for turn in range(6) for message in tool_turn(rng, turn)]
+    index = HistoryIndex(messages, text_length_threshold=THRESHOLD)
+    index.filter_images(1, 1)
+    index.redact_old_text(1, 1)
+    # 历史被截短（如清空会话）后再追加新的轮次
+    del messages[2:]
+    expected = copy.deepcopy(messages)
+    for turn in range(6, 10):
+        new_messages = tool_turn(rng, turn)
+        messages.extend(copy.deepcopy(new_messages))
+        expected.extend(copy.deepcopy(new_messages))
+        index.filter_images(1, 1)
+        index.redact_old_text(1, 1)
+        baseline_filter_images(expected, 1, 1)
+        baseline_redact(expected, 1, 1)
+        assert messages == expected
@@ -0,0 +1,245 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Session store backends against local stand-ins: memory, a SQLite file and a tiny RESP server
+"""
+import asyncio
+import time
+import pytest
+from session_store import (MemorySessionStore, RESPConnection, RedisSessionStore, SessionStore, SQLiteSessionStore,
+                           create_session_store, dumps_state, loads_state)
+
+STATE = {
+    "messages": [{"role": "user", "content": [{"text": "hi"},
+                                              {"image": {"format": "png", "source": {"bytes": b"\x89PNG\x00\xff"}}}]}],
+    "system": [{"text": "be brief"}],
+    "cache_planner": {"checkpoints": [0]},
+}
+
+
+class FakeRESPServer:
+    """Enough of a Redis server for the session store: GET/SET (NX, EX)/DEL/MGET/AUTH/SELECT"""
+
+    def __init__(self, password=None):
+        self.password = password
+        self.data = {}
+        self.commands = []
+        self.stall = False
+        self.server = None
+        self.writers = set()
+        self._closed = asyncio.Event()
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._closed.set()
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await self.server.wait_closed()
+
+    @staticmethod
+    def _bulk(value):
+        if value is None:
+            return b"$-1\r\n"
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def _get(self, key):
+        entry = self.data.get(key)
+        if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+            self.data.pop(key, None)
+            return None
+        return entry[0]
+
+    def _reply(self, args):
+        command = args[0].upper().decode()
+        self.commands.append(command)
+        if command == "AUTH":
+            return b"+OK\r\n" if args[-1].decode() == self.password else b"-WRONGPASS invalid password\r\n"
+        if command == "SELECT":
+            return b"+OK\r\n"
+        if command == "GET":
+            return self._bulk(self._get(args[1]))
+        if command == "MGET":
+            return b"*%d\r\n" % (len(args) - 1) + b"".join(self._bulk(self._get(key)) for key in args[1:])
+        if command == "DEL":
+            removed = sum(1 for key in args[1:] if self.data.pop(key, None) is not None)
+            return b":%d\r\n" % removed
+        if command == "SET":
+            key, value, options = args[1], args[2], [a.upper() for a in args[3:]]
+            expires = None
+            if b"EX" in options:
+                expires = time.monotonic() + int(options[options.index(b"EX") + 1])
+            if b"NX" in options and self._get(key) is not None:
+                return b"$-1\r\n"
+            self.data[key] = (value, expires)
+            return b"+OK\r\n"
+        return b"-ERR unknown command\r\n"
+
+    async def _serve(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                args = []
+                for _ in range(int(line[1:-2])):
+                    length = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2])
+                if self.stall:
+                    # 模拟卡住的服务器：收到命令但不回复
+                    await self._closed.wait()
+                    break
+                writer.write(self._reply(args))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+
+async def check_store(store):
+    """Behaviour every backend must share"""
+    assert await store.load_history("u1") is None
+    await store.save_history("u1", STATE)
+    loaded = await store.load_history("u1")
+    assert loaded["messages"][0]["content"][1]["image"]["source"]["bytes"] == b"\x89PNG\x00\xff"
+    assert loaded["system"] == STATE["system"]
+    await store.delete_history("u1")
+    assert await store.load_history("u1") is None
+
+    assert await store.claim_stream("s1", "u1") is True
+    assert await store.claim_stream("s1", "u2") is False
+    assert await store.stream_owner("s1") == "u1"
+    assert await store.stopped_streams(["s1", "s2"]) == set()
+    await store.request_stop("s1")
+    assert await store.stopped_streams(["s1", "s2"]) == {"s1"}
+    await store.release_stream("s1")
+    assert await store.stream_owner("s1") is None
+    assert await store.stopped_streams(["s1"]) == set()
+    assert await store.claim_stream("s1", "u2") is True
+
+
+def test_incomplete_backend_fails_on_creation():
+    class HistoryOnlyStore(SessionStore):
+        async def load_history(self, user_id):
+            return None
+
+    with pytest.raises(TypeError):
+        HistoryOnlyStore()
+
+
+def test_state_codec_round_trip():
+    assert loads_state(dumps_state(STATE)) == STATE
+
+
+def test_memory_store():
+    store = MemorySessionStore()
+    asyncio.run(check_store(store))
+    assert store.stats()["hits"] == 1
+
+
+def test_memory_store_expiry():
+    async def run():
+        store = MemorySessionStore()
+        await store.save_history("u1", STATE, ttl=-1)
+        assert await store.load_history("u1") is None
+        assert await store.claim_stream("s1", "u1", ttl=-1) is True
+        assert await store.claim_stream("s1", "u2") is True
+
+    asyncio.run(run())
+
+
+def test_sqlite_store(tmp_path):
+    async def run():
+        store = SQLiteSessionStore(str(tmp_path / "sessions.db"))
+        try:
+            await check_store(store)
+        finally:
+            await store.close()
+
+    asyncio.run(run())
+
+
+def test_sqlite_store_is_shared_between_connections(tmp_path):
+    async def run():
+        path = str(tmp_path / "nested" / "sessions.db")
+        first, second = SQLiteSessionStore(path), create_session_store(f"sqlite:///{path}")
+        try:
+            await first.save_history("u1", STATE)
+            assert (await second.load_history("u1"))["system"] == STATE["system"]
+            assert await first.claim_stream("s1", "u1") is True
+            assert await second.claim_stream("s1", "u2") is False
+            await second.request_stop("s1")
+            assert await first.stopped_streams(["s1"]) == {"s1"}
+        finally:
+            await first.close()
+            await second.close()
+
+    asyncio.run(run())
+
+
+def test_redis_store():
+    async def run():
+        server = FakeRESPServer(password="secret")
+        port = await server.start()
+        store = create_session_store(f"redis://:secret@127.0.0.1:{port}/2")
+        assert isinstance(store, RedisSessionStore)
+        try:
+            await check_store(store)
+            assert server.commands[:2] == ["AUTH", "SELECT"]
+        finally:
+            await store.close()
+            await server.stop()
+
+    asyncio.run(run())
+
+
+def test_redis_error_reply_keeps_connection():
+    async def run():
+        server = FakeRESPServer()
+        port = await server.start()
+        connection = RESPConnection("127.0.0.1", port)
+        try:
+            with pytest.raises(Exception, match="unknown command"):
+                await connection.execute("PING")
+            assert await connection.execute("SET", "k", "v") == "OK"
+            assert await connection.execute("GET", "k") == b"v"
+        finally:
+            await connection.close()
+            await server.stop()
+
+    asyncio.run(run())
+
+
+def test_redis_stalled_reply_times_out_and_reconnects():
+    async def run():
+        server = FakeRESPServer()
+        port = await server.start()
+        connection = RESPConnection("127.0.0.1", port, timeout=0.2)
+        try:
+            server.stall = True
+            started = time.monotonic()
+            with pytest.raises(asyncio.TimeoutError):
+                await connection.execute("GET", "k")
+            assert time.monotonic() - started < 2
+            # 超时的连接被丢弃，下一条命令重新连接
+            server.stall = False
+            assert await connection.execute("SET", "k", "v") == "OK"
+            assert await connection.execute("GET", "k") == b"v"
+        finally:
+            await connection.close()
+            await server.stop()
+
+    asyncio.run(run())
+
+
+def test_unknown_store_url():
+    with pytest.raises(ValueError):
+        create_session_store("mongodb://localhost")
@@ -0,0 +1,89 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+SSE streaming response: the on_close hook runs once however the response ends
+"""
+import asyncio
+import pytest
+from starlette.requests import ClientDisconnect
+from sse_encoder import SSEStreamingResponse, SSE_DONE
+
+
+def scope(spec_version="2.4"):
+    return {"type": "http", "asgi": {"version": "3.0", "spec_version": spec_version},
+            "method": "POST", "path": "/v1/chat/completions", "headers": []}
+
+
+class Body:
+    """An SSE body that records whether it started and whether its cleanup ran"""
+
+    def __init__(self):
+        self.started = False
+        self.closed = False
+
+    async def frames(self):
+        self.started = True
+        try:
+            yield b"data: {}\n\n"
+            yield SSE_DONE
+        finally:
+            self.closed = True
+
+
+def make_response(body, events):
+    def on_close():
+        events.append(("on_close", body.closed))
+
+    return SSEStreamingResponse(body.frames(), on_close=on_close, media_type="text/event-stream")
+
+
+def test_released_after_the_body_is_consumed():
+    body, events, sent = Body(), [], []
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(make_response(body, events)(scope(), receive, send))
+    assert sent[-2]["body"] == SSE_DONE
+    assert events == [("on_close", True)]
+
+
+def test_released_when_the_client_is_gone_before_the_first_chunk():
+    body, events = Body(), []
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        raise OSError("connection reset")
+
+    # 新版Starlette抛ClientDisconnect，旧版从任务组里抛出OSError
+    with pytest.raises((ClientDisconnect, OSError, BaseExceptionGroup)):
+        asyncio.run(make_response(body, events)(scope(), receive, send))
+    assert not body.started
+    assert events == [("on_close", False)]
+
+
+def test_released_when_a_disconnect_cancels_the_stream():
+    body, events = Body(), []
+
+    async def run():
+        stalled = asyncio.Event()
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            # 客户端不再读取，响应头都发不出去
+            await stalled.wait()
+
+        await make_response(body, events)(scope(spec_version="2.3"), receive, send)
+
+    asyncio.run(run())
+    assert not body.started
+    assert events == [("on_close", False)]